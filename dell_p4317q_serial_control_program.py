@@ -1,11 +1,31 @@
 #!/usr/bin/python
 
+import os
 import sys
+import time
+import errno
 import struct
-import serial
 import binascii
+try:
+    import fcntl
+except ImportError:
+    # No advisory locks on Windows; ports are opened unlocked there
+    fcntl = None
 
 debug=False
+# A p4317q_trace.WireTrace to record frames, timings and errors in, or None
+tracer=None
+# Error classes traced
+TRACE_ERROR_TIMEOUT=1
+TRACE_ERROR_CHECKSUM=2
+TRACE_ERROR_DISCARD=3
+TRACE_ERROR_FOREIGN=4
+TRACE_ERROR_BAD_REPLY=5
+# A p4317q_replay.SessionRecorder that every port opened is recorded through, or None
+recorder=None
+# Ports named like these play a recorded session back instead of opening a device
+REPLAY_PREFIX="replay:"
+REPLAY_FAST_PREFIX="replay-fast:"
 
 CMD_HEADER=bytearray([0x37, 0x51])
 CMD_READ=0xEB
@@ -14,6 +34,20 @@ CMD_WRITE=0xEA
 # Only get commands have a response.
 RSP_HEADER=bytearray([0x6F, 0x37])
 RSP_REPLY_CODE=0x02
+# Every response checksum starts with the XOR of the header
+RSP_HEADER_CHECKSUM=RSP_HEADER[0] ^ RSP_HEADER[1]
+
+DEFAULT_PORT="COM3"
+DEFAULT_BAUDRATE=9600
+# Give up on a reply that has not fully arrived after this many seconds
+DEFAULT_RESPONSE_TIMEOUT=1.0
+# Longest serial read before checking the reply deadline again
+READ_POLL_INTERVAL=0.05
+# No reply is longer than this; a bigger length byte means we are out of sync
+RSP_MAX_LEN=0x20
+# Idle time the monitor needs between pipelined frames, on top of the time
+# the frames themselves take on the wire
+PIPELINE_FRAME_GAP=0.0
 
 def print_debug(message):
     "Debug print message"
@@ -23,13 +57,45 @@ def print_debug(message):
 def print_usage():
     "Print program usage"
     print sys.argv[0] + " usage:"
-    print sys.argv[0] + "{get|set|reset} {command} [parameter]"
+    print sys.argv[0] + " [--port port | --monitor serial] [--format text|json|ndjson] {get|set|reset} {command} [parameter]"
+    print sys.argv[0] + " [--port port | --monitor serial] [--format text|json|ndjson] dump"
+    print sys.argv[0] + " [--port port | --monitor serial] batch [--cache] [--pipeline [--gap seconds]] [file]"
+    print sys.argv[0] + " [--port port | --monitor serial] apply [file]"
+    print sys.argv[0] + " [--port port | --monitor serial] fade {brightness|contrast|customcolor} target [--over duration]"
+    print ""
+    print "--monitor picks the monitor by serial number; its port is found with"
+    print "p4317q_discovery.py and remembered for the next run"
+    print "--format json prints get and dump results as JSON with typed values,"
+    print "ndjson prints one JSON record per line as each reply arrives"
+    print "--trace file, with any of the above, records every frame sent and"
+    print "received with timings and errors and writes them to file; read it"
+    print "back with p4317q_trace.py"
+    print "--record file saves every byte sent and received, with its timing;"
+    print "--port replay:file (or replay-fast:file, without the delays) then"
+    print "plays the monitor's side of the recording back"
+    print "A port is used by one process at a time; others wait for it.  get, set,"
+    print "reset, dump and fade are handed to p4317q_daemon.py when it has the port"
     print ""
     print "get   - Retrieves information from the monitor"
     print "set   - Sets a value in the monitor"
     print "reset - Resets a monitor capability"
+    print "dump  - Retrieves all information from the monitor"
+    print "batch - Runs get/set/reset commands read from file (or stdin),"
+    print "        one per line, over a single port open.  --cache answers"
+    print "        repeated gets from a cache that sets invalidate.  --pipeline"
+    print "        streams the commands back to back without waiting for"
+    print "        replies, --gap seconds apart on top of their wire time"
+    print "apply - Reads a desired state from file (or stdin), one set command"
+    print "        per line without the \"set\", and writes only the settings"
+    print "        that differ, e.g. \"pxpmode SxS\" and \"pxpsubinput 1 hdmi1\""
+    print "fade  - Changes brightness, contrast or customcolor (R:G:B) to target"
+    print "        in even steps over duration (e.g. 3s or 500ms, default 1s),"
+    print "        as many steps as the serial line allows.  A fade handed to"
+    print "        p4317q_daemon.py replaces the one it is running; without the"
+    print "        daemon a second fade waits for the first to finish"
     print ""
-    print " parameter is required only for set commands"
+    print " parameter is required only for set commands.  get pxpsubinput and"
+    print " get customcolor take an index, 0 if not given"
     print ""
     print "get commands:"
     print "    assettag, monitorname, monitorserial, backlighthours"
@@ -70,18 +136,30 @@ def print_usage():
     print "reset commands:"
     print "    power, color, osd, factory"
 
-def dump_info():
-    commands = ["monitorname", "monitorserial", "backlighthours", "powerstate", "powerled", "powerusb", "brightness", "contrast", "aspectratio", "sharpness", "inputcolorformat", "colorpresetcaps", "colorpreset", "customcolor", "autoselect", "videoinputcaps", "videoinput", "pxpmode", "pxpsubinput", "pxplocation", "osdtransparency", "osdlanguage", "osdtimer", "osdbuttonlock", "versionfirmware", "ddcci", "lcdconditioning"]
+DUMP_COMMANDS = ["monitorname", "monitorserial", "backlighthours", "powerstate", "powerled", "powerusb", "brightness", "contrast", "aspectratio", "sharpness", "inputcolorformat", "colorpresetcaps", "colorpreset", "customcolor", "autoselect", "videoinputcaps", "videoinput", "pxpmode", "pxpsubinput", "pxplocation", "osdtransparency", "osdlanguage", "osdtimer", "osdbuttonlock", "versionfirmware", "ddcci", "lcdconditioning"]
 
-    for command in commands:
+def dump_requests():
+    "List the (command, param) get requests that make up a dump"
+    requests = []
+    for command in DUMP_COMMANDS:
         if (command == "pxpsubinput"):
             for index in range(0,4):
-                p4317q_handle_command("get", command, index)
+                requests.append((command, index))
         else:
             param = None
             if (command == "customcolor"):
                 param = 0
-            p4317q_handle_command("get", command, param)
+            requests.append((command, param))
+    return requests
+
+def dump_info(session=None):
+    "Print every readable setting, using a single port open for the whole dump"
+    if (session is None):
+        with MonitorSession() as session:
+            return dump_info(session)
+
+    for (command, param) in dump_requests():
+        p4317q_handle_command("get", command, param, session)
 
 
 def p4317q_hex_format(message):
@@ -97,201 +175,945 @@ def p4317q_checksum(message, begin, length):
         #total += message[index]
         total ^= message[index]
         #total &= 0xFF
-        print_debug("DB:  total ^ 0x" + p4317q_hex_format(bytearray([message[index]])) + " = 0x" + p4317q_hex_format(bytearray([total&0xff])))
+        if (debug):
+            print_debug("DB:  total ^ 0x" + p4317q_hex_format(bytearray([message[index]])) + " = 0x" + p4317q_hex_format(bytearray([total&0xff])))
     total &= 0xFF
-    print_debug("DB:  " + str(total)+ " 0x" + p4317q_hex_format(bytearray([total])))
+    if (debug):
+        print_debug("DB:  " + str(total)+ " 0x" + p4317q_hex_format(bytearray([total])))
     # Compute 2's complement of the sum.  Comment out if this isn't needed
     # total = (~total+1) & 0xFF
-    print_debug("DB:  " + str(total)+ " 0x" + p4317q_hex_format(bytearray([total])))
+    if (debug):
+        print_debug("DB:  " + str(total)+ " 0x" + p4317q_hex_format(bytearray([total])))
     return total
 
 #0x6E, 0x51, 0x02, 0xEB, 0x01, D7p
 
 def p4317q_build_command(action, value, param):
     "Build a command to be sent to the monitor.  Assumed that param is a bytearray of the correct length"
-    cmd_tag = (ACTIONS_MAP[action])[value]
-    cmd_len = (ACTIONS_MAP[action])[value+"_len"]
-
-    print_debug("DEBUG:  Param is [" + str(param) + "].  Type is [" + str(type(param)) + "].")
-    command = CMD_HEADER + bytearray([cmd_len])
-    if (action == "set"):
-        cmd_act = CMD_WRITE
-        command = command + bytearray([cmd_act]) + bytearray([cmd_tag])
-        if (isinstance(param, bytearray)):
-            command += param
-        else:
-            command += bytearray([param])
-    else:
-        cmd_act = CMD_READ
-        command = command + bytearray([cmd_act]) + bytearray([cmd_tag])
-        if (param is not None): command += bytearray([param])
-
-    # compute the checksum and add that to the end
-    # checksum = p4317q_checksum(command, 2, cmd_len+1)
-    checksum = p4317q_checksum(command, 0, cmd_len+3)
-    command = command + bytearray([checksum])
-    return command
+    return COMMANDS[action][value].build(param)
 
 def p4317q_send_command(ser_port, command):
     ser_port.write(command)
 
-def p4317q_parse_response(response, command):
-    response_data = bytearray(response)
-    # Create an additional buffer with the header in it for the new checksum:
-    response_with_header = bytearray(response)
-    response_payload_bytes = len(response_data) - 1
-    print_debug("DEBUG: Response length is " + str(response_payload_bytes))
-    response_with_header.insert(0, response_payload_bytes)
-    response_with_header.insert(0, 0x37)
-    response_with_header.insert(0, 0x6f)
-
-    hex = p4317q_hex_format(bytearray([command]))
-    print_debug("Parsing response.  Expecting command [" + hex + "].")
-    # print_debug("Response data:\n    " + p4317q_hex_format(response_data))
-    print_debug("Response data:\n    " + p4317q_hex_format(response_with_header))
-    print_debug("Verifying checksum.")
-    # ckdata = bytearray([len(response_data)-1]) + response_data
-    # ckdata = bytearray([len(response_with_header)-1]) + response_with_header
-    #chksum = p4317q_checksum(response_data,0,len(response_data)-1)
-    # chksum = p4317q_checksum(ckdata,0,len(ckdata)-1)
-
-    # chksum = p4317q_checksum(response_data,0,len(response_data)-1)
-    # MC104 requires the checksum to be calculated with the header included
-    # for both commands and responses:
-    chksum = p4317q_checksum(response_with_header,0,len(response_with_header)-1)
-    if (chksum != response_data[len(response_data)-1]):
-        print_debug("ERROR.  CheckSum does not verify.  Calculated == " + p4317q_hex_format(bytearray([chksum])) + ".")
-        # Checksum verification doesn't seem to matter (or work)
+def p4317q_open_port(port_name, baudrate=DEFAULT_BAUDRATE, timeout=READ_POLL_INTERVAL):
+    "Open the serial port to a monitor.  pyserial is only imported here, so importing this module does not need it"
+    if (port_name.startswith(REPLAY_PREFIX) or port_name.startswith(REPLAY_FAST_PREFIX)):
+        import p4317q_replay
+        return p4317q_replay.open_replay(port_name, None, timeout)
+    import serial
+    port = serial.Serial(port_name, baudrate=baudrate, bytesize=8, parity='N', stopbits=1, timeout=timeout, xonxoff=0, rtscts=0)
+    if (recorder is not None):
+        port = recorder.wrap(port, port_name, baudrate)
+    return port
+
+# Longest wait for another process to let go of a port
+PORT_LOCK_TIMEOUT=10.0
+PORT_LOCK_POLL_INTERVAL=0.02
+# Where port lock files go: the first of these where the port's lock file
+# already is, else the first the user can create files in.  Root and members
+# of the dialout group then lock one file even where only root may write to
+# /run/lock.
+PORT_LOCK_DIRECTORIES = ("/run/lock", "/var/lock", "/tmp")
+
+class PortLockError(IOError):
+    "The port's lock file could not be opened"
+
+class PortBusy(PortLockError):
+    "Another process held the port for longer than the lock timeout"
+
+def p4317q_lock_path(port_name):
+    "The lock file for a port.  None for ports that are not locked"
+    if (fcntl is None or port_name.startswith(REPLAY_PREFIX) or port_name.startswith(REPLAY_FAST_PREFIX)):
+        return None
+    # Every name of the device, e.g. its /dev/serial/by-id link, shares one lock
+    device = os.path.realpath(port_name)
+    if (not os.path.exists(device)):
+        # Opening it fails anyway; leave no lock file behind
         return None
-    else:
-        print_debug("Checksum verified.")
+    name = "p4317q-" + device.strip("/").replace("/", "-") + ".lock"
+    paths = [os.path.join(directory, name) for directory in PORT_LOCK_DIRECTORIES if os.path.isdir(directory)]
+    for path in paths:
+        if (os.path.exists(path)):
+            return path
+    for path in paths:
+        if (os.access(os.path.dirname(path), os.W_OK | os.X_OK)):
+            return path
+    # Opening it will say why not
+    return paths[0]
 
-    if (response_data[0] != RSP_REPLY_CODE):
-        print "ERROR.  Reply code incorrect."
+def p4317q_open_lock_file(path):
+    "Open a lock file for reading and writing, creating it writable by every user.  Read only if another user's file allows no more"
+    while True:
+        try:
+            # Not O_CREAT on a file that exists: protected_regular refuses
+            # that for other users' files in a sticky directory like /tmp
+            return os.fdopen(os.open(path, os.O_RDWR), "r+")
+        except OSError as error:
+            if (error.errno == errno.EACCES):
+                break
+            if (error.errno != errno.ENOENT):
+                raise PortLockError("Cannot open lock file " + path + ": " + error.strerror)
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError as error:
+            if (error.errno == errno.EEXIST):
+                # Another process created it first
+                continue
+            raise PortLockError("Cannot create lock file " + path + ": " + error.strerror)
+        # Past the umask
+        os.fchmod(fd, 0666)
+        return os.fdopen(fd, "r+")
+    try:
+        return os.fdopen(os.open(path, os.O_RDONLY), "r")
+    except OSError as error:
+        raise PortLockError("Cannot open lock file " + path + ": " + error.strerror)
+
+def p4317q_port_owner(port_name):
+    "(pid, daemon socket or None) of the process holding port, or None if no process holds it"
+    path = p4317q_lock_path(port_name)
+    if (path is None or not os.path.exists(path)):
+        return None
+    try:
+        lock_file = p4317q_open_lock_file(path)
+    except PortLockError:
+        # Opening the port will say what is wrong
         return None
-    print_debug("Result code = " + p4317q_hex_format(bytearray([response_data[1]])))
-    # Probably could do with some operation on the result code here...
+    with lock_file:
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            # Nobody holds it; what is written there was left by a process that died
+            return None
+        except IOError as error:
+            if (error.errno not in (errno.EAGAIN, errno.EACCES)):
+                raise
+        lock_file.seek(0)
+        lines = lock_file.read().splitlines()
+    # The holder may not have written its details yet
+    pid = int(lines[0]) if len(lines) > 0 and lines[0].isdigit() else 0
+    socket_path = lines[1] if len(lines) > 1 and lines[1] != "" else None
+    return (pid, socket_path)
+
+def p4317q_busy_message(port_name, owner):
+    "Why port_name cannot be had, given its p4317q_port_owner"
+    if (owner is not None and owner[1] is not None):
+        return "%s is held by the control daemon (process %d) on %s; send commands through p4317q_daemon.py --socket %s" % (port_name, owner[0], owner[1], owner[1])
+    return "%s is in use by process %s" % (port_name, owner[0] if owner else "unknown")
+
+class PortLock(object):
+    "Advisory lock on a port, held by one process at a time across every tool that uses this module"
+
+    def __init__(self, port_name):
+        self.path = p4317q_lock_path(port_name)
+        self.lock_file = None
+
+    def acquire(self, timeout=PORT_LOCK_TIMEOUT, socket_path=None):
+        "Wait up to timeout seconds for the lock.  Returns True once it is held.  socket_path is where a daemon holding it takes commands"
+        if (self.path is None or self.lock_file is not None):
+            return True
+        lock_file = p4317q_open_lock_file(self.path)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError as error:
+                if (error.errno not in (errno.EAGAIN, errno.EACCES)):
+                    lock_file.close()
+                    raise
+            if (time.time() >= deadline):
+                lock_file.close()
+                return False
+            time.sleep(PORT_LOCK_POLL_INTERVAL)
+        if (lock_file.mode == "r+"):
+            # Say who holds it, so others can hand their commands over
+            lock_file.seek(0)
+            lock_file.truncate()
+            lock_file.write("%d\n%s\n" % (os.getpid(), socket_path or ""))
+            lock_file.flush()
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        if (self.lock_file is not None):
+            if (self.lock_file.mode == "r+"):
+                self.lock_file.seek(0)
+                self.lock_file.truncate()
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
 
-    if (response_data[2] != command):
-        print_debug("DEBUG " + str(response_data[2]) + " == " + str(command) + ".")
+def p4317q_wire_time(byte_count, baudrate=DEFAULT_BAUDRATE):
+    "Seconds byte_count bytes take on the wire at 8N1 (start + 8 data + stop bits each)"
+    return byte_count * 10.0 / baudrate
+
+def p4317q_check_response(data, command):
+    "Verify a response (payload plus checksum, as a bytearray) in place.  Returns True if it is a good reply to command"
+    end = len(data) - 1
+    if (end < 3):
+        print_debug("DEBUG:  Response too short")
+        return False
+    # MC104 requires the checksum to be calculated with the header included
+    # for both commands and responses.  Start from the header and length
+    # rather than copying them in front of the data.
+    chksum = RSP_HEADER_CHECKSUM ^ end
+    for index in range(0, end):
+        chksum ^= data[index]
+    if (chksum != data[end]):
+        if (debug):
+            print_debug("ERROR.  CheckSum does not verify.  Calculated == " + p4317q_hex_format(bytearray([chksum])) + ".")
+        return False
+
+    if (data[0] != RSP_REPLY_CODE):
+        print "ERROR.  Reply code incorrect."
+        return False
+    # Probably could do with some operation on the result code (data[1]) here...
+
+    if (data[2] != command):
+        if (debug):
+            print_debug("DEBUG " + str(data[2]) + " == " + str(command) + ".")
         print "ERROR.  Received incorrect command response."
+        return False
+    return True
+
+def p4317q_parse_response(response, command):
+    "Verify a response for the command tag and return its payload, or None"
+    data = response if isinstance(response, bytearray) else bytearray(response)
+    if (not p4317q_check_response(data, command)):
         return None
-    else:
-        print_debug("Command response is correct.")
-    print_debug("Response Data:        " + p4317q_hex_format(response_data[3:-1]))
-    if (command in (CMD_G_MONITOR_NAME_C, CMD_G_ASSET_TAG_C, CMD_G_MONITOR_SERIAL_C, CMD_G_VERSION_FIRMWARE_C)):
-        print_debug("ASCII Response Data:  " + response_data[3:-1])
-    print_debug("Done parsing.")
-    return response_data[3:-1]
-
-def p4317q_read_response(ser_port):
-    # Read 2 bytes, make sure they're == RSP_HEADER
-    resp_header = ser_port.read(2)
-    print_debug("DEBUG:  Response header received has " + str(len(resp_header)) + " bytes.")
-    print_debug("DEBUG:  Received response header = [" + p4317q_hex_format(resp_header) + "]")
-    print_debug("DEBUG:  Expected response header = [" + p4317q_hex_format(RSP_HEADER) + "]")
-    if (ord(resp_header[0]) != RSP_HEADER[0]):
-        print_debug(str(ord(resp_header[0])) + " == " + str(RSP_HEADER[0]))
-        print_debug("DEBUG:  1st byte of response header does not match " + p4317q_hex_format(RSP_HEADER))
-        return None
+    if (debug):
+        print_debug("Response Data:        " + p4317q_hex_format(data[3:-1]))
+    return data[3:-1]
 
-    if (ord(resp_header[1]) != RSP_HEADER[1]):
-        print_debug("DEBUG:  2nd byte of response header does not match " + p4317q_hex_format(RSP_HEADER))
+def p4317q_decode_response(response, command):
+    "Verify a response for the named get command and return its decoded value, or None"
+    entry = COMMANDS["get"][command]
+    data = response if isinstance(response, bytearray) else bytearray(response)
+    if (not p4317q_check_response(data, entry.tag)):
         return None
+    return entry.decode(data, 3, len(data) - 1)
+
+class ResponseFramer(object):
+    "Finds response frames in the bytes received from the monitor, resynchronizing after garbage"
+
+    def __init__(self, name=None):
+        self.buffer = bytearray()
+        # Port name for tracing
+        self.name = name
+        # When the first byte of the frame being received arrived, while tracing
+        self.first_byte = None
+        self.frames = 0
+        self.resyncs = 0
+        self.discarded_bytes = 0
+        self.checksum_errors = 0
+        self.timeouts = 0
+
+    def counters(self):
+        "Framing statistics as a dict"
+        return { "frames": self.frames, "resyncs": self.resyncs, "discarded_bytes": self.discarded_bytes,
+                 "checksum_errors": self.checksum_errors, "timeouts": self.timeouts }
 
-    # Read 1 byte of len
-    resp_len = ord(ser_port.read(1))
-    print_debug("DEBUG:  Received data length of " + str(resp_len))
-    # Read resp_len+1 bytes (message + checksum)
-    response = ser_port.read(resp_len+1)
+    def clear(self):
+        "Drop anything buffered"
+        self.discard(len(self.buffer))
+
+    def discard(self, count):
+        if (count > 0):
+            if (tracer is not None):
+                tracer.error(self.name, TRACE_ERROR_DISCARD, self.buffer[:count])
+            del self.buffer[:count]
+            self.discarded_bytes += count
+            if (len(self.buffer) == 0):
+                self.first_byte = None
+
+    def feed(self, data):
+        if (tracer is not None and self.first_byte is None and len(data) > 0):
+            self.first_byte = time.time()
+        self.buffer += data
+
+    def needed(self):
+        "Number of bytes still missing from the frame at the front of the buffer"
+        if (len(self.buffer) < 3):
+            return 3 - len(self.buffer)
+        return max(1, self.buffer[2] + 4 - len(self.buffer))
+
+    def next_frame(self):
+        "Remove and return the next complete frame as its payload plus checksum, or None"
+        buf = self.buffer
+        while True:
+            # Scan for the header
+            start = buf.find(RSP_HEADER)
+            if (start < 0):
+                # Keep a trailing first header byte, the second may be on its way
+                keep = 1 if (len(buf) > 0 and buf[-1] == RSP_HEADER[0]) else 0
+                if (len(buf) - keep > 0):
+                    self.resyncs += 1
+                    self.discard(len(buf) - keep)
+                return None
+            if (start > 0):
+                self.resyncs += 1
+                self.discard(start)
+            if (len(buf) < 3):
+                return None
+            resp_len = buf[2]
+            if (resp_len > RSP_MAX_LEN):
+                self.resyncs += 1
+                self.discard(1)
+                continue
+            if (len(buf) < resp_len + 4):
+                return None
+            checksum = 0
+            for index in range(0, resp_len + 3):
+                checksum ^= buf[index]
+            if (checksum != buf[resp_len + 3]):
+                # Either a corrupted reply or a false header in garbage.  Skip
+                # the header byte and look again.
+                self.checksum_errors += 1
+                self.resyncs += 1
+                if (tracer is not None):
+                    tracer.error(self.name, TRACE_ERROR_CHECKSUM, buf[:resp_len + 4])
+                self.discard(1)
+                continue
+            frame = buf[3:resp_len + 4]
+            if (tracer is not None):
+                tracer.receive(self.name, buf[:resp_len + 4], self.first_byte)
+            del buf[:resp_len + 4]
+            self.first_byte = time.time() if (tracer is not None and len(buf) > 0) else None
+            self.frames += 1
+            return frame
+
+    def read_frame(self, ser_port, timeout):
+        "Read from ser_port until a complete frame arrives or timeout seconds pass.  Returns None on timeout"
+        deadline = time.time() + timeout
+        while True:
+            frame = self.next_frame()
+            if (frame is not None):
+                return frame
+            if (time.time() >= deadline):
+                self.timeouts += 1
+                if (tracer is not None):
+                    tracer.error(self.name, TRACE_ERROR_TIMEOUT)
+                    # Whatever is left over is not the start of the next reply
+                    self.first_byte = None
+                print_debug("DEBUG:  Timed out waiting for a response")
+                return None
+            # Read the rest of the frame in one go, or whatever is waiting
+            self.feed(ser_port.read(max(self.needed(), ser_port.in_waiting)))
+
+    def poll_frame(self, ser_port):
+        "Return a frame if one has fully arrived, without waiting"
+        waiting = ser_port.in_waiting
+        if (waiting > 0):
+            self.feed(ser_port.read(waiting))
+        return self.next_frame()
+
+def p4317q_read_response(ser_port, framer=None, timeout=DEFAULT_RESPONSE_TIMEOUT):
+    "Read one response frame.  Returns its payload plus checksum, or None if none arrived in time"
+    if (framer is None):
+        framer = ResponseFramer()
+    response = framer.read_frame(ser_port, timeout)
+    if (response is not None and debug):
+        print_debug("DEBUG:  Received data length of " + str(len(response) - 1))
     return response
 
-def p4317q_handle_command(action, command, param):
-    cmd = p4317q_build_command(action, command, param)
-    print_debug("DEBUG:  Command:  [" + p4317q_hex_format(cmd) + "]")
+def take_option(args, name, default):
+    "Remove --name value from args and return value"
+    if (name in args):
+        index = args.index(name)
+        value = args[index+1]
+        del args[index:index+2]
+        return value
+    return default
+
+def take_flag(args, name):
+    "Remove --name from args and return whether it was there"
+    if (name in args):
+        args.remove(name)
+        return True
+    return False
+
+def p4317q_parse_command(args):
+    "Convert {get|set|reset} {command} [parameter] arguments to (action, command, param).  Returns None if invalid"
+    if (len(args) < 2):
+        print "ERROR:  No command specified"
+        return None
+    action = args[0]
+    command = args[1]
+    if (action not in COMMANDS):
+        print "ERROR:  Invalid action specified"
+        return None
+    if (command not in COMMANDS[action]):
+        print "ERROR:  Invalid command specified"
+        return None
+
+    param = None
+    try:
+        param = COMMANDS[action][command].parse(args[2:])
+    except (KeyError, ValueError, IndexError):
+        print "ERROR:  Invalid parameter specified"
+        return None
+    if (action == "set"):
+        problem = p4317q_check_limits(command, param)
+        if (problem is not None):
+            print "ERROR:  Invalid parameter specified: " + problem
+            return None
+    return (action, command, param)
+
+def run_batch(lines, session=None):
+    "Run one command per line over a single session, reporting each result and its time.  Returns the number of failed lines"
+    if (session is None):
+        with MonitorSession() as session:
+            return run_batch(lines, session)
+
+    count = 0
+    errors = 0
+    batch_start = time.time()
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if (line == "" or line.startswith("#")):
+            continue
+        count += 1
+        start = time.time()
+        if (line == "dump"):
+            dump_info(session)
+            status = "OK"
+        else:
+            parsed = p4317q_parse_command(line.split())
+            if (parsed is None):
+                status = "ERROR"
+            else:
+                (action, command, param) = parsed
+                try:
+                    response = p4317q_handle_command(action, command, param, session)
+                    status = "OK" if (response is not None or action != "get") else "NO RESPONSE"
+                except UnsupportedSetting as error:
+                    print "ERROR:  Invalid parameter specified: " + str(error)
+                    status = "ERROR"
+        if (status != "OK"):
+            errors += 1
+        print "[%d] %s: %s, %.2f ms" % (line_number, line, status, (time.time() - start) * 1000)
+
+    print "%d commands, %d errors, %.2f ms total" % (count, errors, (time.time() - batch_start) * 1000)
+    framer = session.framer
+    if (framer.resyncs or framer.timeouts):
+        print "%d resyncs, %d bytes discarded, %d checksum errors, %d timeouts" % (framer.resyncs, framer.discarded_bytes, framer.checksum_errors, framer.timeouts)
+    if (session.cache is not None):
+        cache = session.cache
+        print "cache: %d hits, %d misses, %d invalidations" % (cache.hits, cache.misses, cache.invalidations)
+    return errors
+
+def run_pipelined_batch(lines, session=None, gap=PIPELINE_FRAME_GAP):
+    "Like run_batch, but streams every command back to back with MonitorSession.pipeline.  Returns the number of failed lines"
+    if (session is None):
+        with MonitorSession() as session:
+            return run_pipelined_batch(lines, session, gap)
+
+    # (line_number, line, (action, command, param)) for every frame to send
+    requests = []
+    errors = 0
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if (line == "" or line.startswith("#")):
+            continue
+        if (line == "dump"):
+            for (command, param) in dump_requests():
+                requests.append((line_number, line, ("get", command, param)))
+            continue
+        parsed = p4317q_parse_command(line.split())
+        if (parsed is not None and parsed[0] == "set"):
+            try:
+                session.check_set(parsed[1], parsed[2])
+            except UnsupportedSetting as error:
+                print "ERROR:  Invalid parameter specified: " + str(error)
+                parsed = None
+        if (parsed is None):
+            errors += 1
+            print "[%d] %s: ERROR" % (line_number, line)
+            continue
+        requests.append((line_number, line, parsed))
+
+    start = time.time()
+    results = session.pipeline([parsed for (line_number, line, parsed) in requests], gap)
+    elapsed = time.time() - start
+
+    for ((line_number, line, (action, command, param)), response) in zip(requests, results):
+        status = "OK"
+        if (action == "get"):
+            if (response is None):
+                status = "NO RESPONSE"
+                errors += 1
+            else:
+                format_response(command, response, param)
+        print "[%d] %s: %s" % (line_number, line, status)
+
+    rate = len(requests) / elapsed if elapsed > 0 else 0
+    print "%d commands, %d errors, %.2f ms total, %.1f commands/s" % (len(requests), errors, elapsed * 1000, rate)
+    framer = session.framer
+    if (framer.resyncs or framer.timeouts):
+        print "%d resyncs, %d bytes discarded, %d checksum errors, %d timeouts" % (framer.resyncs, framer.discarded_bytes, framer.checksum_errors, framer.timeouts)
+    return errors
+
+# Order in which desired settings are written.  Changing the PxP mode
+# re-syncs the panel and can reset the window inputs and location, so it
+# goes before them.  Settings not listed follow in profile order.
+APPLY_ORDER = ["powerstate", "pxpmode", "videoinput", "pxpsubinput", "pxplocation"]
+
+# Settings that are always written when their parent is written, since the
+# value read beforehand may no longer hold
+APPLY_DEPENDENTS = {
+    "pxpmode": ("pxpsubinput", "pxplocation")
+}
+
+def p4317q_parse_profile(lines):
+    "Parse desired state lines of set arguments (e.g. \"pxpsubinput 1 hdmi1\") into (command, param, text) tuples.  Returns None if any line is invalid"
+    profile = []
+    for line in lines:
+        line = line.strip()
+        if (line == "" or line.startswith("#")):
+            continue
+        parsed = p4317q_parse_command(["set"] + line.split())
+        if (parsed is None):
+            print "ERROR:  Invalid profile line [" + line + "]"
+            return None
+        profile.append((parsed[1], parsed[2], line))
+    return profile
+
+def p4317q_param_bytes(command, param):
+    "The get index and the value bytes a set param should read back as"
+    if (command in ("pxpsubinput", "customcolor")):
+        return (param[0], param[1:])
+    if (isinstance(param, bytearray)):
+        return (None, param)
+    return (None, bytearray([param]))
+
+def apply_desired_state(profile, session):
+    "Write only the settings in profile that differ from the monitor, in a safe order.  Returns (command, text, written, current, forced_by) records.  Raises UnsupportedSetting, having written nothing, if the monitor does not support a setting"
+    for (command, param, text) in profile:
+        session.check_set(command, param)
+    def order(item):
+        (position, (command, param, text)) = item
+        rank = APPLY_ORDER.index(command) if command in APPLY_ORDER else len(APPLY_ORDER)
+        return (rank, p4317q_command_index(command, param), position)
+    ordered = [item for (position, item) in sorted(enumerate(profile), key=order)]
+
+    # Read everything first, as one pipelined stream over the session
+    resyncs = session.framer.resyncs
+    current = session.pipeline([("get", command, p4317q_param_bytes(command, param)[0]) for (command, param, text) in ordered])
+    if (session.framer.resyncs != resyncs):
+        # Bytes were lost or garbled on the way; no reply is trusted to skip
+        # a write, as writing a setting again does no harm
+        current = [None] * len(current)
+
+    records = []
+    written = set()
+    for ((command, param, text), payload) in zip(ordered, current):
+        (index, wanted) = p4317q_param_bytes(command, param)
+        forced = [parent for parent in written if command in APPLY_DEPENDENTS.get(parent, ())]
+        if (payload is not None and payload[:len(wanted)] == wanted and not forced):
+            records.append((command, text, False, payload, None))
+            continue
+        session.set(command, param)
+        written.add(command)
+        records.append((command, text, True, payload, forced[0] if forced else None))
+    return records
+
+def run_apply(lines, session=None):
+    "Bring the monitor to the desired state in lines, reporting what was written and skipped.  Returns False if the profile is invalid"
+    if (session is None):
+        with MonitorSession() as session:
+            return run_apply(lines, session)
+
+    profile = p4317q_parse_profile(lines)
+    if (profile is None):
+        return False
+    start = time.time()
+    records = apply_desired_state(profile, session)
+    for line in format_apply_records(records, time.time() - start):
+        print line
+    return True
+
+def format_apply_records(records, elapsed):
+    "Report lines for the records of apply_desired_state"
+    lines = []
+    for (command, text, written, payload, forced_by) in records:
+        if (payload is None):
+            was = "unknown"
+        else:
+            entry = COMMANDS["get"][command]
+            was = str(entry.show(entry.decode(payload, 0, len(payload))))
+        if (forced_by is not None):
+            was += ", rewritten after " + forced_by
+        lines.append(("set  " if written else "skip ") + text.ljust(28) + " (was " + was + ")")
+    writes = len([record for record in records if record[2]])
+    lines.append("%d written, %d skipped, %.2f ms" % (writes, len(records) - writes, elapsed * 1000))
+    return lines
+
+# How long a cached get reply stays good, in seconds.  None means it never
+# changes.  Anything not listed uses DEFAULT_CACHE_TTL.
+DEFAULT_CACHE_TTL=5.0
+CACHE_TTLS = {
+    "assettag": None,
+    "monitorname": None,
+    "monitorserial": None,
+    "colorpresetcaps": None,
+    "videoinputcaps": None,
+    "versionfirmware": None,
+    "backlighthours": 60.0,
+    "powerstate": 1.0
+}
+
+# Settings that may change as a side effect of setting another one
+CACHE_DEPENDENTS = {
+    "pxpmode": ("pxpsubinput", "pxplocation"),
+    "videoinput": ("pxpsubinput",),
+    "colorpreset": ("customcolor",),
+    "powerstate": ("videoinput", "pxpsubinput")
+}
+
+def p4317q_command_index(command, param):
+    "The index a set parameter addresses, matching the param of the corresponding get"
+    if (command in ("pxpsubinput", "customcolor") and isinstance(param, bytearray)):
+        return param[0]
+    return None
+
+class StateCache(object):
+    "Read-through cache of get replies, keyed by monitor, command and index"
+
+    def __init__(self, ttls=CACHE_TTLS, default_ttl=DEFAULT_CACHE_TTL):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def stats(self):
+        "Cache statistics as a dict"
+        return { "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations, "entries": len(self.entries) }
+
+    def lookup(self, monitor, command, param):
+        "Return the cached reply, or None if there is no fresh one"
+        key = (monitor, command, param)
+        entry = self.entries.get(key)
+        if (entry is not None):
+            (expires, response) = entry
+            if (expires is None or expires > time.time()):
+                self.hits += 1
+                return response
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def store(self, monitor, command, param, response):
+        ttl = self.ttls.get(command, self.default_ttl)
+        expires = None if ttl is None else time.time() + ttl
+        self.entries[(monitor, command, param)] = (expires, response)
+
+    def invalidate(self, monitor, action, command, param):
+        "Forget whatever a set or reset sent to monitor may have changed"
+        if (action == "reset"):
+            # Resets touch many settings, keep only the ones that never change
+            stale = [key for key in self.entries if key[0] == monitor and self.ttls.get(key[1], self.default_ttl) is not None]
+        else:
+            index = p4317q_command_index(command, param)
+            dependents = CACHE_DEPENDENTS.get(command, ())
+            stale = [key for key in self.entries
+                     if key[0] == monitor and ((key[1] == command and key[2] == index) or key[1] in dependents)]
+        for key in stale:
+            del self.entries[key]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.entries.clear()
+
+class UnsupportedSetting(ValueError):
+    "A set of a color preset or video input the monitor does not support"
+
+class MonitorSession(object):
+    "An open serial connection to the monitor that is reused across many commands"
+
+    def __init__(self, port=DEFAULT_PORT, baudrate=DEFAULT_BAUDRATE, timeout=DEFAULT_RESPONSE_TIMEOUT, cache=None,
+                 lock_timeout=PORT_LOCK_TIMEOUT, socket_path=None):
+        self.port_name = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.port = None
+        self.lock = PortLock(port)
+        self.lock_timeout = lock_timeout
+        # Where the daemon owning this session takes commands, for other processes to find
+        self.socket_path = socket_path
+        self.framer = ResponseFramer(port)
+        # Optional StateCache shared with other sessions
+        self.cache = cache
+        # CapabilityCache that sets are checked against, made by the first set that needs it
+        self.capabilities = None
 
-    # port = serial.Serial("COM3")
-    port = serial.Serial("COM3", baudrate=9600, bytesize=8, parity='N', stopbits=1, timeout=None, xonxoff=0, rtscts=0)
+    def __enter__(self):
+        return self.open()
 
-    p4317q_send_command(port, cmd)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
-    response = p4317q_read_response(port)
+    def open(self):
+        "Open the serial port, if it is not already open"
+        if (self.port is None):
+            print_debug("DEBUG:  Opening " + self.port_name)
+            if (not self.lock.acquire(self.lock_timeout, self.socket_path)):
+                raise PortBusy(p4317q_busy_message(self.port_name, p4317q_port_owner(self.port_name)))
+            try:
+                self.port = p4317q_open_port(self.port_name, self.baudrate, READ_POLL_INTERVAL)
+            except:
+                self.lock.release()
+                raise
+        return self
 
-    port.close()
+    def close(self):
+        "Close the serial port"
+        if (self.port is not None):
+            print_debug("DEBUG:  Closing " + self.port_name)
+            self.port.close()
+            self.port = None
+            self.lock.release()
 
-    if (response is not None):
-        print_debug("Response = [" + p4317q_hex_format(response) + "]")
-        parsedResponse = p4317q_parse_response(response, (ACTIONS_MAP[action])[command])
+    def command(self, action, command, param=None):
+        "Send one command.  Returns the response payload for get commands, None otherwise"
+        if (action == "get"):
+            response = self.fetch_reply(command, param)
+            if (response is None):
+                return None
+            return self.parse_reply(response, COMMANDS[action][command].tag)
+
+        if (action == "set"):
+            self.check_set(command, param)
+        started = time.time() if tracer is not None else None
+        cmd = p4317q_build_command(action, command, param)
+        self.open()
+        self.send_frame(cmd, started)
+        if (self.cache is not None):
+            self.cache.invalidate(self.port_name, action, command, param)
+        # Only get commands have a response.
+        return None
+
+    def check_set(self, command, param):
+        "Refuse a set of a preset or input the monitor does not support.  Raises UnsupportedSetting"
+        if (command not in CAPS_CHECKS):
+            return
+        if (self.capabilities is None):
+            # Imported here because it imports this module
+            import p4317q_capabilities
+            self.capabilities = p4317q_capabilities.CapabilityCache()
+        problem = self.capabilities.check(self, command, param)
+        if (problem is not None):
+            raise UnsupportedSetting(problem)
+
+    def fetch_reply(self, command, param):
+        "Send a get and return its raw reply, from the cache when there is a fresh one"
+        if (self.cache is not None):
+            response = self.cache.lookup(self.port_name, command, param)
+            if (response is not None):
+                return response
+
+        started = time.time() if tracer is not None else None
+        entry = COMMANDS["get"][command]
+        cmd = entry.build(param)
+        self.open()
+        self.send_frame(cmd, started)
+        response = self.read_reply(entry.tag)
+        if (response is not None and self.cache is not None):
+            self.cache.store(self.port_name, command, param, response)
+        return response
+
+    def send_frame(self, cmd, started=None):
+        "Write a built frame.  started is when building it began, while tracing"
+        if (debug):
+            print_debug("DEBUG:  Command:  [" + p4317q_hex_format(cmd) + "]")
+        if (tracer is None):
+            p4317q_send_command(self.port, cmd)
+            return
+        built = time.time()
+        p4317q_send_command(self.port, cmd)
+        tracer.transmit(self.port_name, cmd, built - (started or built), time.time() - built)
+
+    def parse_reply(self, response, tag):
+        "Verify a raw reply for tag and return its payload, or None"
+        if (tracer is None):
+            return p4317q_parse_response(response, tag)
+        started = time.time()
+        payload = p4317q_parse_response(response, tag)
+        tracer.parsed(self.port_name, tag, time.time() - started, payload is not None)
+        return payload
+
+    def read_reply(self, tag):
+        "Read the raw reply (payload plus checksum) for the get with this tag, or None on timeout"
+        # A reply to an earlier get that timed out may still arrive first;
+        # skip anything that is not for this command.
+        deadline = time.time() + self.timeout
+        while True:
+            response = p4317q_read_response(self.port, self.framer, max(0, deadline - time.time()))
+            if (response is None):
+                return None
+            if (debug):
+                print_debug("Response = [" + p4317q_hex_format(response) + "]")
+            if (response[2] == tag):
+                return response
+            if (tracer is not None):
+                tracer.error(self.port_name, TRACE_ERROR_FOREIGN, response)
+            print_debug("DEBUG:  Discarding response for another command")
+
+    def pipeline(self, commands, gap=PIPELINE_FRAME_GAP):
+        "Send parsed (action, command, param) commands back to back without waiting for replies.  Returns the payload (or None) of each get, None for the rest"
+        # Each frame goes out as soon as the line is free of the one before
+        # it, and of the reply to it if it was a get.  Replies only carry the
+        # command's tag, not its index (pxpsubinput, customcolor), so at most
+        # one get per tag is in flight: a get waits for the reply to the last
+        # one with its tag, or for that get to time out.  A reply that never
+        # comes then leaves its own get None rather than answering the next.
+        # Before anything is sent, so an unsupported set leaves the monitor as it was
+        for (action, command, param) in commands:
+            if (action == "set"):
+                self.check_set(command, param)
+        self.open()
+        results = [None] * len(commands)
+        # tag -> (position, deadline) of the get waiting for a reply
+        outstanding = {}
+        line_free = time.time()
+        for (position, (action, command, param)) in enumerate(commands):
+            entry = COMMANDS[action][command]
+            while True:
+                self.match_reply(self.framer.poll_frame(self.port), outstanding, results)
+                now = time.time()
+                self.expire_gets(outstanding, now)
+                wait = line_free - now
+                if (action == "get" and entry.tag in outstanding):
+                    wait = max(wait, min(READ_POLL_INTERVAL, outstanding[entry.tag][1] - now))
+                if (wait <= 0):
+                    break
+                time.sleep(min(wait, READ_POLL_INTERVAL))
+            started = time.time() if tracer is not None else None
+            cmd = entry.build(param)
+            self.send_frame(cmd, started)
+            busy = len(cmd)
+            if (action == "get"):
+                busy += entry.resp_length + 4
+            elif (self.cache is not None):
+                self.cache.invalidate(self.port_name, action, command, param)
+            line_free = time.time() + p4317q_wire_time(busy, self.baudrate) + gap
+            if (action == "get"):
+                outstanding[entry.tag] = (position, line_free + self.timeout)
+        while (len(outstanding) > 0):
+            wait = max([deadline for (position, deadline) in outstanding.values()]) - time.time()
+            response = p4317q_read_response(self.port, self.framer, max(0, wait))
+            if (response is None):
+                break
+            self.match_reply(response, outstanding, results)
+        return results
+
+    def match_reply(self, response, outstanding, results):
+        "Store a pipelined reply against the outstanding get with its tag"
+        if (response is None):
+            return
+        if (response[2] not in outstanding):
+            if (tracer is not None):
+                tracer.error(self.port_name, TRACE_ERROR_FOREIGN, response)
+            print_debug("DEBUG:  Discarding response for another command")
+            return
+        (position, deadline) = outstanding.pop(response[2])
+        results[position] = self.parse_reply(response, response[2])
+
+    def expire_gets(self, outstanding, now):
+        "Give up on outstanding gets whose reply is overdue"
+        for (tag, (position, deadline)) in outstanding.items():
+            if (now >= deadline):
+                if (tracer is not None):
+                    tracer.error(self.port_name, TRACE_ERROR_TIMEOUT)
+                del outstanding[tag]
+
+    def get_value(self, command, param=None):
+        "Read a setting and return its decoded value (int, bool, name, ...) or None"
+        response = self.fetch_reply(command, param)
+        if (response is None):
+            return None
+        return p4317q_decode_response(response, command)
+
+    def get(self, command, param=None):
+        "Read a value from the monitor.  Returns the response payload or None"
+        return self.command("get", command, param)
+
+    def set(self, command, param):
+        "Write a value to the monitor"
+        return self.command("set", command, param)
+
+    def reset(self, command):
+        "Reset a monitor capability"
+        return self.command("reset", command, None)
+
+def p4317q_handle_command(action, command, param, session=None):
+    "Run one command and print the result.  Opens a session for the command if none is given"
+    if (session is None):
+        with MonitorSession() as session:
+            return p4317q_handle_command(action, command, param, session)
+
+    parsedResponse = session.command(action, command, param)
 
     if (parsedResponse is not None and action == "get"):
         format_response(command, parsedResponse, param)
+    return parsedResponse
 
 
 def format_response(command, response, param):
-    if   (command == "assettag"):
-        print ""
-    elif (command == "monitorname"):
-        print "Monitor Name         = " + str(response)
-    elif (command == "monitorserial"):
-        print "Monitor Serial #     = " + str(response)
-    elif (command == "backlighthours"):
-        print "Backlight Hours      = " + str(struct.unpack("<h", response)[0])
-    elif (command == "powerstate"):
-        print "Power State          = " + ("ON" if response[0]==1 else "OFF")
-    elif (command == "powerled"):
-        print "Power LED            = " + ("ON" if response[0]==1 else "OFF")
-    elif (command == "powerusb"):
-        print "Power USB            = " + ("ON" if response[0]==1 else "OFF")
-    elif (command == "brightness"):
-        print "Brightness           = " + str(response[0])
-    elif (command == "contrast"):
-        print "Contrast             = " + str(response[0])
-    elif (command == "aspectratio"):
-        ratios = { v: k for k, v in aspect_ratios.items() }
-        print "Aspect Ratio         = " + ratios[response[0]]
-    elif (command == "sharpness"):
-        print "Sharpness            = " + str(response[0])
-    elif (command == "inputcolorformat"):
-        formats = { v: k for k, v in input_color_formats.items() }
-        print "Input Color Format   = " + formats[response[0]]
-    elif (command == "colorpresetcaps"):
-        print "Color Preset Caps    = " + p4317q_hex_format(response)
-    elif (command == "colorpreset"):
-        print "Color Preset         = " + color_preset_inv[struct.unpack("<h", response[0:2])[0]]
-    elif (command == "customcolor"):
-        print "Custom Color [R:G:B] = [" + str(response[0]) + ":" + str(response[1]) + ":" + str(response[2]) + "]"
-    elif (command == "autoselect"):
-        print "Input Auto Select    = " + ("ON" if response[0]==1 else "OFF")
-    elif (command == "videoinputcaps"):
-        print "Video Input Caps     = " + p4317q_hex_format(response)
-    elif (command == "videoinput"):
-        inputs = { v[0]: k for k, v in pxp_input.items() }
-        print "Video Input          = " + inputs[int(response[0])]
-    elif (command == "pxpmode"):
-        modes = { v: k for k, v in pxp_mode.items() }
-        print "PxP/PiP Mode         = " + modes[response[0]]
-    elif (command == "pxpsubinput"):
-        inputs = { v[0]: k for k, v in pxp_input.items() }
-        print "PxP/PiP Sub Input[" + str(param+1) + "] = " + inputs[int(response[0])]
-    elif (command == "pxplocation"):
-        locations = { v: k for k, v in pxp_locations.items() }
-        print "PiP Window Location  = " + locations[int(response[0])]
-    elif (command == "osdtransparency"):
-        print "OSD Transparency     = " + str(response[0])
-    elif (command == "osdlanguage"):
-        languages = { v: k for k, v in osd_language.items() }
-        print "OSD Language         = " + languages[int(response[0])]
-    elif (command == "osdtimer"):
-        print "OSD Timer            = " + str(response[0])
-    elif (command == "osdbuttonlock"):
-        print "OSD Button Lock      = " + ("ON" if response[0]==1 else "OFF")
-    elif (command == "versionfirmware"):
-        print "Firmware Version     = " + response
-    elif (command == "ddcci"):
-        print "DDC/CI               = " + ("ON" if response[0]==1 else "OFF")
-    elif (command == "lcdconditioning"):
-        print "LCD Conditioning     = " + ("ON" if response[0]==1 else "OFF")
-    return
+    "Print the human readable form of a get response"
+    print format_response_text(command, response, param)
+
+def format_response_text(command, response, param):
+    "Return the human readable form of a get response"
+    return COMMANDS["get"][command].format(response, param)
+
+def format_response_record(command, response, param):
+    "Return a get response as a dict of JSON types, or an error record if there was no response"
+    if (response is None):
+        record = { "command": command, "error": "no response" }
+        if (param is not None):
+            record["index"] = param
+        return record
+    return COMMANDS["get"][command].record(response, param)
+
+OUTPUT_FORMATS = ("text", "json", "ndjson")
+
+class RecordWriter(object):
+    "Writes records as one JSON document when closed, or for ndjson as one line each as soon as they are written"
+
+    def __init__(self, output_format, stream=None, fields=None):
+        self.output_format = output_format
+        self.stream = stream if stream is not None else sys.stdout
+        # Added to every record, e.g. the port a record came from
+        self.fields = fields
+        self.records = []
+        import threading
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        if (self.fields is not None):
+            record.update(self.fields)
+        if (self.output_format == "ndjson"):
+            import json
+            line = json.dumps(record, sort_keys=True) + "\n"
+            with self.lock:
+                self.stream.write(line)
+                self.stream.flush()
+        else:
+            with self.lock:
+                self.records.append(record)
+
+    def close(self):
+        if (self.output_format == "json"):
+            import json
+            self.stream.write(json.dumps(self.records, indent=2, sort_keys=True) + "\n")
+            self.records = []
+
+def dump_records(session, writer):
+    "Write a record for every readable setting as its reply arrives"
+    for (command, param) in dump_requests():
+        writer.write(format_response_record(command, session.get(command, param), param))
 
 
 # MONITOR MANAGEMENT
@@ -598,44 +1420,464 @@ RESET_ACTIONS = {
 
 ACTIONS_MAP = { "get": GET_ACTIONS, "set": SET_ACTIONS, "reset": RESET_ACTIONS }
 
-print_debug("len(sys.argv) = " + str(len(sys.argv)))
-print_debug("args = " + str(sys.argv))
-if (len(sys.argv) < 2 or len(sys.argv) > 5):
-    print_usage()
-    exit()
+# COMMAND REGISTRY
+#
+# Everything needed to encode a command and decode its response is worked
+# out once here, so that building a frame or formatting a reply is a single
+# lookup in COMMANDS[action][command].
 
-if (sys.argv[1] == "dump"):
-    dump_info()
-    exit()
+def param_none(args):
+    "Parser for commands that take no parameter"
+    return None
 
-if (sys.argv[1] in ("get", "set", "reset")):
-    keys = ACTIONS_MAP[sys.argv[1]].keys()
-    if (sys.argv[2] not in keys):
-        print "ERROR:  Invalid command specified"
-        exit()
-else:
-    print "ERROR:  Invalid action specified"
-    exit()
-
-param = None
-if (len(sys.argv) >= 4):
-    if (sys.argv[1] == "set"):
-        if   (sys.argv[2] == "osdlanguage"):
-            param = osd_language[sys.argv[3]]
-        elif (sys.argv[2] == "pxplocation"):
-            param = pxp_locations[sys.argv[3]]
-        elif (sys.argv[2] == "pxpmode"):
-            param = pxp_mode[sys.argv[3]]
-        elif (sys.argv[2] == "videoinput"):
-            param = pxp_input[sys.argv[3]]
-        elif (sys.argv[2] == "pxpsubinput"):
-            print "pxpsubinput"
-            param = bytearray([int(sys.argv[3])-1])
-            param += pxp_input[sys.argv[4]]
-            print "param:  " + p4317q_hex_format(param)
+def param_index(args):
+    "Parser for the index of a get whose frame carries one (pxpsubinput, customcolor).  0 if not given"
+    index = int(args[0]) if len(args) > 0 else 0
+    if (not (0 <= index <= 255)):
+        raise ValueError(args[0])
+    return index
+
+def param_get(args):
+    "Parser for a get whose frame has no index"
+    if (len(args) > 0):
+        raise ValueError(args[0])
+    return None
+
+def param_int(args):
+    "Parser for a single numeric parameter byte"
+    return int(args[0])
+
+def param_enum(table):
+    "Parser for a parameter given by name.  Byte valued tables also take the number"
+    numeric = not isinstance(table.values()[0], bytearray)
+    def parse(args):
+        if (args[0] in table):
+            value = table[args[0]]
+            return value if numeric else value[:]
+        if (numeric):
+            return int(args[0])
+        raise KeyError(args[0])
+    return parse
+
+def param_subinput(args):
+    "Parser for a pxpsubinput set: 1-based window number and input name"
+    return bytearray([int(args[0])-1]) + pxp_input[args[1]]
+
+def param_custom_color(args):
+    "Parser for a customcolor set given as R:G:B"
+    (red, green, blue) = [int(value) for value in args[0].split(":")]
+    return bytearray([0, red, green, blue, 0, 0, 0])
+
+# Decoders read the value straight out of data[start:end], which is
+# either a bare payload or a whole response still holding its reply code
+# and checksum.
+
+def decode_text(data, start, end):
+    return str(data[start:end])
+
+def decode_byte(data, start, end):
+    return data[start]
+
+def decode_on_off(data, start, end):
+    return data[start] == 1
+
+def decode_short(data, start, end):
+    return struct.unpack_from("<h", data, start)[0]
+
+def decode_raw(data, start, end):
+    return data[start:end]
+
+def decode_custom_color(data, start, end):
+    return (data[start], data[start+1], data[start+2])
+
+def decode_enum(table):
+    "Decoder from a value byte to its name in table"
+    names = dict([(value, name) for (name, value) in table.items()])
+    def decode(data, start, end):
+        return names.get(data[start], data[start])
+    return decode
+
+def decode_input(data, start, end):
+    return video_input_names.get(data[start], data[start])
+
+def decode_color_preset(data, start, end):
+    value = decode_short(data, start, end)
+    return color_preset_inv.get(value, value)
+
+def show_on_off(value):
+    return "ON" if value else "OFF"
+
+def show_custom_color(value):
+    return "[" + str(value[0]) + ":" + str(value[1]) + ":" + str(value[2]) + "]"
+
+video_input_names = dict([(value[0], name) for (name, value) in pxp_input.items()])
+
+# command: (label, decoder, display function).  A label of None prints an
+# empty line, a %d in the label is replaced with the 1-based index.
+RESPONSE_FORMATS = {
+    "assettag":          (None,                   decode_text,                         str),
+    "monitorname":       ("Monitor Name",         decode_text,                         str),
+    "monitorserial":     ("Monitor Serial #",     decode_text,                         str),
+    "backlighthours":    ("Backlight Hours",      decode_short,                        str),
+    "powerstate":        ("Power State",          decode_on_off,                       show_on_off),
+    "powerled":          ("Power LED",            decode_on_off,                       show_on_off),
+    "powerusb":          ("Power USB",            decode_on_off,                       show_on_off),
+    "brightness":        ("Brightness",           decode_byte,                         str),
+    "contrast":          ("Contrast",             decode_byte,                         str),
+    "aspectratio":       ("Aspect Ratio",         decode_enum(aspect_ratios),          str),
+    "sharpness":         ("Sharpness",            decode_byte,                         str),
+    "inputcolorformat":  ("Input Color Format",   decode_enum(input_color_formats),    str),
+    "colorpresetcaps":   ("Color Preset Caps",    decode_raw,                          p4317q_hex_format),
+    "colorpreset":       ("Color Preset",         decode_color_preset,                 str),
+    "customcolor":       ("Custom Color [R:G:B]", decode_custom_color,                 show_custom_color),
+    "autoselect":        ("Input Auto Select",    decode_on_off,                       show_on_off),
+    "videoinputcaps":    ("Video Input Caps",     decode_raw,                          p4317q_hex_format),
+    "videoinput":        ("Video Input",          decode_input,                        str),
+    "pxpmode":           ("PxP/PiP Mode",         decode_enum(pxp_mode),               str),
+    "pxpsubinput":       ("PxP/PiP Sub Input[%d]", decode_input,                       str),
+    "pxplocation":       ("PiP Window Location",  decode_enum(pxp_locations),          str),
+    "osdtransparency":   ("OSD Transparency",     decode_byte,                         str),
+    "osdlanguage":       ("OSD Language",         decode_enum(osd_language),           str),
+    "osdtimer":          ("OSD Timer",            decode_byte,                         str),
+    "osdbuttonlock":     ("OSD Button Lock",      decode_on_off,                       show_on_off),
+    "versionfirmware":   ("Firmware Version",     decode_text,                         str),
+    "ddcci":             ("DDC/CI",               decode_on_off,                       show_on_off),
+    "lcdconditioning":   ("LCD Conditioning",     decode_on_off,                       show_on_off)
+}
+
+def record_text(value):
+    return value.rstrip("\0 ")
+
+def p4317q_caps_has(caps, bits):
+    "True if every bit of bits is set in the caps bitfield"
+    return all([(have & bit) == bit for (have, bit) in zip(caps, bits)])
+
+def record_caps(table):
+    "Converter from a caps bitfield to the names in table whose bits are all set"
+    def convert(value):
+        return sorted([name for (name, bits) in table.items() if p4317q_caps_has(value, bits)])
+    return convert
+
+def record_custom_color(value):
+    return { "red": value[0], "green": value[1], "blue": value[2] }
+
+# Converters from decoded values to what structured output shows.  Values
+# of anything not listed (ints, booleans, enum names) are shown as they are.
+RECORD_VALUES = {
+    "assettag":          record_text,
+    "monitorname":       record_text,
+    "monitorserial":     record_text,
+    "versionfirmware":   record_text,
+    "colorpresetcaps":   record_caps(color_presets),
+    "videoinputcaps":    record_caps(pxp_input),
+    "customcolor":       record_custom_color
+}
+
+# Parsers for set parameters given on the command line.  Anything not
+# listed takes a single number.
+SET_PARSERS = {
+    "aspectratio":       param_enum(aspect_ratios),
+    "inputcolorformat":  param_enum(input_color_formats),
+    "colorpreset":       param_enum(color_presets),
+    "customcolor":       param_custom_color,
+    "videoinput":        param_enum(pxp_input),
+    "pxpmode":           param_enum(pxp_mode),
+    "pxpsubinput":       param_subinput,
+    "pxplocation":       param_enum(pxp_locations),
+    "osdlanguage":       param_enum(osd_language)
+}
+
+# The values a set may write, checked before anything is sent: a
+# (lowest, highest) range, or the table of named values.  customcolor
+# ranges apply to each of R, G and B.
+SET_LIMITS = {
+    "powerstate":        (0, 1),
+    "powerled":          (0, 1),
+    "powerusb":          (0, 1),
+    "brightness":        (0, 100),
+    "contrast":          (0, 100),
+    "aspectratio":       aspect_ratios,
+    "sharpness":         (0, 100),
+    "inputcolorformat":  input_color_formats,
+    "colorpreset":       color_presets,
+    "customcolor":       (0, 100),
+    "autoselect":        (0, 1),
+    "videoinput":        pxp_input,
+    "pxpmode":           pxp_mode,
+    "pxpsubinput":       pxp_input,
+    "pxplocation":       pxp_locations,
+    "osdtransparency":   (0, 100),
+    "osdlanguage":       osd_language,
+    "osdtimer":          (5, 60),
+    "osdbuttonlock":     (0, 1),
+    "ddcci":             (0, 1),
+    "lcdconditioning":   (0, 1)
+}
+
+# Sets whose value must also be in one of the monitor's caps bitfields
+CAPS_CHECKS = {
+    "colorpreset":       "colorpresetcaps",
+    "videoinput":        "videoinputcaps",
+    "pxpsubinput":       "videoinputcaps"
+}
+
+def p4317q_set_value(command, param):
+    "The value part of a set param, without a window or slot index"
+    if (command == "pxpsubinput"):
+        return param[1:]
+    if (command == "customcolor"):
+        return param[1:4]
+    return param
+
+def p4317q_check_limits(command, param):
+    "Check a parsed set param against SET_LIMITS.  Returns what is wrong with it, or None"
+    if (command == "pxpsubinput" and not (0 <= param[0] <= 3)):
+        return "PxP window must be 1-4"
+    limits = SET_LIMITS.get(command)
+    if (limits is None):
+        return None
+    value = p4317q_set_value(command, param)
+    if (isinstance(limits, dict)):
+        if (value not in limits.values()):
+            return command + " must be one of " + ", ".join(sorted(limits))
+        return None
+    (lowest, highest) = limits
+    for number in (value if isinstance(value, bytearray) else [value]):
+        if (not (lowest <= number <= highest)):
+            return "%s must be %d-%d" % (command, lowest, highest)
+    return None
+
+def p4317q_check_caps(command, param, caps):
+    "Check a parsed set param against the monitor's caps, a dict of caps command to bitfield.  Returns what is wrong with it, or None"
+    name = CAPS_CHECKS.get(command)
+    if (name is None or caps.get(name) is None):
+        return None
+    value = p4317q_set_value(command, param)
+    if (not p4317q_caps_has(caps[name], value)):
+        table = SET_LIMITS[command]
+        supported = [key for (key, bits) in table.items() if p4317q_caps_has(caps[name], bits)]
+        return command + " must be one of " + ", ".join(sorted(supported)) + " on this monitor"
+    return None
+
+class P4317QCommand(object):
+    "One get, set or reset command, with its frame prefix and checksum worked out in advance"
+
+    __slots__ = ("action", "name", "tag", "length", "resp_length", "prefix", "prefix_checksum",
+                 "parse", "decode", "show", "label", "indexed_label", "record_value")
+
+    def __init__(self, action, name, tag, length, resp_length, parse, decode=None, show=None, label=None, record_value=None):
+        self.action = action
+        self.name = name
+        self.tag = tag
+        self.length = length
+        self.resp_length = resp_length
+        self.parse = parse
+        self.decode = decode
+        self.show = show
+        self.record_value = record_value
+        if (label is not None):
+            label = label.ljust(20) + " = "
+        self.label = label
+        self.indexed_label = label is not None and "%d" in label
+        cmd_act = CMD_WRITE if action == "set" else CMD_READ
+        self.prefix = CMD_HEADER + bytearray([length, cmd_act, tag])
+        checksum = 0
+        for b in self.prefix:
+            checksum ^= b
+        self.prefix_checksum = checksum
+
+    def build(self, param):
+        "Build the frame for this command.  param is None, a byte value or a bytearray"
+        checksum = self.prefix_checksum
+        if (param is None):
+            frame = self.prefix[:]
+        elif (isinstance(param, bytearray)):
+            frame = self.prefix + param
+            for b in param:
+                checksum ^= b
+        else:
+            frame = self.prefix + bytearray([param])
+            checksum ^= param
+        frame.append(checksum)
+        return frame
+
+    def format(self, payload, param):
+        "Human readable form of a response payload"
+        if (self.label is None):
+            return ""
+        value = self.decode(payload, 0, len(payload))
+        if (self.indexed_label):
+            return (self.label % (param+1)) + self.show(value)
+        return self.label + self.show(value)
+
+    def record(self, payload, param):
+        "Structured form of a response payload, for JSON output"
+        record = { "command": self.name }
+        if (param is not None):
+            record["index"] = param
+        value = self.decode(payload, 0, len(payload))
+        if (self.record_value is not None):
+            value = self.record_value(value)
+        record["value"] = value
+        record["raw"] = p4317q_hex_format(payload)
+        return record
+
+def build_command_registry():
+    "Build COMMANDS from the ACTIONS tables"
+    registry = {}
+    for (action, actions) in ACTIONS_MAP.items():
+        registry[action] = {}
+        for (name, tag) in actions.items():
+            if (name.endswith("_len") or name.endswith("_resplen")):
+                continue
+            length = actions[name + "_len"]
+            if (action == "get"):
+                (label, decode, show) = RESPONSE_FORMATS[name]
+                # The length counts the action and tag, and the index byte of gets that take one
+                parse = param_index if length > 2 else param_get
+                entry = P4317QCommand(action, name, tag, length, actions[name + "_resplen"], parse, decode, show, label,
+                                      RECORD_VALUES.get(name))
+            elif (action == "set"):
+                entry = P4317QCommand(action, name, tag, length, None, SET_PARSERS.get(name, param_int))
+            else:
+                entry = P4317QCommand(action, name, tag, length, None, param_none)
+            registry[action][name] = entry
+    return registry
+
+COMMANDS = build_command_registry()
+
+def main(args):
+    "Run the command line in args, without the program name.  Returns the exit status"
+    global tracer, recorder
+    trace_path = take_option(args, "--trace", None)
+    record_path = take_option(args, "--record", None)
+    if (trace_path is not None):
+        import p4317q_trace
+        tracer = p4317q_trace.WireTrace()
+    if (record_path is not None):
+        import p4317q_replay
+        recorder = p4317q_replay.SessionRecorder()
+    try:
+        return run_command_line(args)
+    except PortLockError as error:
+        print "ERROR:  " + str(error)
+        return 1
+    except UnsupportedSetting as error:
+        print "ERROR:  Invalid parameter specified: " + str(error)
+        return 1
+    finally:
+        if (trace_path is not None):
+            tracer.dump(trace_path)
+            tracer = None
+        if (record_path is not None):
+            recorder.save(record_path)
+            recorder = None
+
+def open_command_file(args):
+    "The file named after the command in args, or stdin when there is none or it is -.  Prints an error and returns None if it cannot be opened"
+    if (len(args) < 2 or args[1] == "-"):
+        return sys.stdin
+    try:
+        return open(args[1])
+    except IOError as error:
+        print "ERROR:  " + str(error)
+        return None
+
+def run_command_line(args):
+    "main without --trace and --record"
+    if (debug):
+        print_debug("args = " + str(args))
+    port = take_option(args, "--port", DEFAULT_PORT)
+    monitor = take_option(args, "--monitor", None)
+    output_format = take_option(args, "--format", "text")
+    if (len(args) < 1 or (len(args) > 4 and args[0] not in ("batch", "fade")) or output_format not in OUTPUT_FORMATS):
+        print_usage()
+        return 0
+
+    if (monitor is not None):
+        # Imported here because it imports this module
+        import p4317q_discovery
+        port = p4317q_discovery.resolve_monitor(monitor)
+        if (port is None):
+            print "ERROR:  No monitor with serial number " + monitor + " found"
+            return 1
+
+    owner = p4317q_port_owner(port)
+    if (owner is not None and owner[1] is not None):
+        if (args[0] in ("get", "set", "reset", "dump", "fade")):
+            # A daemon has the port: give it the command rather than queue for the lock.
+            # Imported here because it imports this module
+            import p4317q_daemon
+            status = p4317q_daemon.hand_off(owner[1], args, output_format, port)
+            if (status is not None):
+                return status
+        elif (args[0] in ("batch", "apply")):
+            # The daemon keeps the port until it stops, so waiting for it is no use
+            print "ERROR:  " + p4317q_busy_message(port, owner)
+            return 1
+
+    if (args[0] == "dump"):
+        with MonitorSession(port) as session:
+            if (output_format == "text"):
+                dump_info(session)
+            else:
+                writer = RecordWriter(output_format, fields={ "port": port })
+                dump_records(session, writer)
+                writer.close()
+        return 0
+
+    if (args[0] == "fade"):
+        # Imported here because it imports this module
+        import p4317q_fade
+        with MonitorSession(port) as session:
+            return p4317q_fade.run_fade(args[1:], session)
+
+    if (args[0] == "apply"):
+        profile_file = open_command_file(args)
+        if (profile_file is None):
+            return 1
+        with MonitorSession(port) as session:
+            ok = run_apply(profile_file, session)
+        return 0 if ok else 1
+
+    if (args[0] == "batch"):
+        cache = StateCache() if take_flag(args, "--cache") else None
+        pipeline = take_flag(args, "--pipeline")
+        try:
+            gap = float(take_option(args, "--gap", PIPELINE_FRAME_GAP))
+        except ValueError:
+            gap = -1
+        if (gap < 0):
+            print "ERROR:  --gap must be a number of seconds, 0 or more"
+            return 1
+        batch_file = open_command_file(args)
+        if (batch_file is None):
+            return 1
+        with MonitorSession(port, cache=cache) as session:
+            if (pipeline):
+                errors = run_pipelined_batch(batch_file, session, gap)
+            else:
+                errors = run_batch(batch_file, session)
+        return 1 if errors else 0
+
+    parsed = p4317q_parse_command(args)
+    if (parsed is None):
+        return 1
+
+    with MonitorSession(port) as session:
+        if (output_format != "text" and parsed[0] == "get"):
+            response = session.get(parsed[1], parsed[2])
+            record = format_response_record(parsed[1], response, parsed[2])
+            record["port"] = port
+            import json
+            print json.dumps(record, indent=2 if output_format == "json" else None, sort_keys=True)
         else:
-            param = int(sys.argv[3])
-    else:
-        param = int(sys.argv[3])
+            response = p4317q_handle_command(parsed[0], parsed[1], parsed[2], session)
+            if (response is None and parsed[0] == "get"):
+                print "ERROR:  No valid response from monitor"
+    if (response is None and parsed[0] == "get"):
+        return 1
+    return 0
 
-output = p4317q_handle_command(sys.argv[1], sys.argv[2], param)
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
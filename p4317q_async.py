@@ -0,0 +1,450 @@
+#!/usr/bin/python
+
+# Non-blocking control of many P4317Q monitors from one thread.
+#
+# EventLoop multiplexes the monitors' serial file descriptors with select.
+# AsyncMonitor queues get/set/reset/dump requests for one port and returns
+# an Operation for each, which completes when the reply is parsed (gets)
+# or the frame has been written (sets and resets).  Every call takes its
+# own timeout and can be cancelled.  Frames are built and replies framed
+# and decoded with the same code as MonitorSession.
+#
+# Operations can be waited on with run_until_complete, chained with
+# callbacks, or yielded from a generator run with spawn:
+#
+#   def layout(monitor):
+#       mode = yield monitor.get_value("pxpmode")
+#       if (mode != "SxS"):
+#           yield monitor.set("pxpmode", p4317q.pxp_mode["SxS"])
+#       raise Return(mode)
+#
+#   loop = EventLoop()
+#   monitors = open_monitors(loop, ports)
+#   loop.run_until_complete(gather(loop, [spawn(loop, layout(m)) for m in monitors]))
+#
+# Opening a port never waits for its lock, which would stall every other
+# monitor on the loop: a port another process holds raises PortBusy.
+
+import os
+import sys
+import time
+import errno
+import heapq
+import select
+import collections
+
+import dell_p4317q_serial_control_program as p4317q
+
+class OperationTimeout(Exception):
+    "A request got no reply in time"
+
+class OperationCancelled(Exception):
+    "A request was cancelled before it completed"
+
+class Return(Exception):
+    "Raised by a spawned generator to finish with a value"
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+class Operation(object):
+    "The eventual result of a request"
+
+    def __init__(self, on_cancel=None):
+        self.is_done = False
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.on_cancel = on_cancel
+
+    def done(self):
+        return self.is_done
+
+    def cancelled(self):
+        return self.is_done and isinstance(self.error, OperationCancelled)
+
+    def result(self):
+        "The result.  Raises the operation's exception if it failed"
+        if (not self.is_done):
+            raise RuntimeError("Operation is not done")
+        if (self.error is not None):
+            raise self.error
+        return self.value
+
+    def exception(self):
+        return self.error
+
+    def add_done_callback(self, callback):
+        "Call callback(operation) once done, straight away if it already is"
+        if (self.is_done):
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def set_result(self, value):
+        if (not self.is_done):
+            self.value = value
+            self.finish()
+
+    def set_exception(self, error):
+        if (not self.is_done):
+            self.error = error
+            self.finish()
+
+    def cancel(self):
+        "Cancel the operation.  Returns False if it had already completed"
+        if (self.is_done):
+            return False
+        self.error = OperationCancelled()
+        self.finish()
+        if (self.on_cancel is not None):
+            self.on_cancel()
+        return True
+
+    def finish(self):
+        self.is_done = True
+        (callbacks, self.callbacks) = (self.callbacks, [])
+        for callback in callbacks:
+            callback(self)
+
+class Timer(object):
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class EventLoop(object):
+    "A select based loop over file descriptors and timers"
+
+    def __init__(self):
+        self.readers = {}
+        self.writers = {}
+        self.timers = []
+        self.sequence = 0
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def call_later(self, delay, callback):
+        "Run callback after delay seconds.  Returns a Timer that can be cancelled"
+        timer = Timer(time.time() + delay, callback)
+        self.sequence += 1
+        heapq.heappush(self.timers, (timer.deadline, self.sequence, timer))
+        return timer
+
+    def run_once(self, max_wait=None):
+        "Wait for one round of I/O or timers and run their callbacks"
+        while (len(self.timers) > 0 and self.timers[0][2].cancelled):
+            heapq.heappop(self.timers)
+        wait = max_wait
+        if (len(self.timers) > 0):
+            until_timer = max(0, self.timers[0][0] - time.time())
+            wait = until_timer if wait is None else min(wait, until_timer)
+        if (len(self.readers) > 0 or len(self.writers) > 0):
+            (readable, writable, _) = select.select(list(self.readers), list(self.writers), [], wait)
+            for fd in readable:
+                if (fd in self.readers):
+                    self.readers[fd]()
+            for fd in writable:
+                if (fd in self.writers):
+                    self.writers[fd]()
+        elif (wait is not None):
+            time.sleep(wait)
+        now = time.time()
+        while (len(self.timers) > 0 and self.timers[0][0] <= now):
+            timer = heapq.heappop(self.timers)[2]
+            if (not timer.cancelled):
+                timer.callback()
+
+    def run_until_complete(self, operation, timeout=None):
+        "Run the loop until operation is done and return its result"
+        if (timeout is not None):
+            timer = self.call_later(timeout, lambda: operation.set_exception(OperationTimeout()))
+            operation.add_done_callback(lambda op: timer.cancel())
+        while (not operation.done()):
+            self.run_once()
+        return operation.result()
+
+def gather(loop, operations):
+    "An Operation whose result is the list of all the results, or the first error"
+    combined = Operation(on_cancel=lambda: [operation.cancel() for operation in operations])
+    remaining = [len(operations)]
+    def one_done(operation):
+        if (operation.exception() is not None):
+            combined.set_exception(operation.exception())
+            return
+        remaining[0] -= 1
+        if (remaining[0] == 0):
+            combined.set_result([op.result() for op in operations])
+    if (len(operations) == 0):
+        combined.set_result([])
+    for operation in operations:
+        operation.add_done_callback(one_done)
+    return combined
+
+def spawn(loop, generator):
+    "Run a generator that yields Operations (or lists of them) and gets their results back"
+    waiting = [None]
+    def cancel():
+        if (waiting[0] is not None):
+            waiting[0].cancel()
+    task = Operation(on_cancel=cancel)
+
+    def step(value=None, error=None):
+        waiting[0] = None
+        try:
+            if (error is not None):
+                yielded = generator.throw(error)
+            else:
+                yielded = generator.send(value)
+        except Return as finished:
+            task.set_result(finished.value)
+            return
+        except StopIteration:
+            task.set_result(None)
+            return
+        except Exception as failure:
+            task.set_exception(failure)
+            return
+        if (isinstance(yielded, list)):
+            yielded = gather(loop, yielded)
+        waiting[0] = yielded
+        def resume(operation):
+            if (task.done()):
+                return
+            if (operation.exception() is not None):
+                step(error=operation.exception())
+            else:
+                step(value=operation.result())
+        yielded.add_done_callback(resume)
+
+    step()
+    return task
+
+class Request(object):
+    def __init__(self, entry, param, timeout, decode):
+        self.entry = entry
+        self.param = param
+        self.timeout = timeout
+        self.decode = decode
+        self.operation = None
+        self.timer = None
+
+class AsyncMonitor(object):
+    "Non-blocking requests to one monitor.  Requests run one at a time in the order made"
+
+    def __init__(self, loop, port=p4317q.DEFAULT_PORT, baudrate=p4317q.DEFAULT_BAUDRATE, timeout=p4317q.DEFAULT_RESPONSE_TIMEOUT):
+        self.loop = loop
+        self.port_name = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.framer = p4317q.ResponseFramer()
+        self.requests = collections.deque()
+        self.current = None
+        self.output = bytearray()
+        self.serial = None
+        self.fd = None
+        self.lock = p4317q.PortLock(port)
+
+    def open(self):
+        "Open the port without blocking reads.  Returns self.  Raises PortBusy straight away if another process holds the port"
+        if (self.serial is None):
+            if (not self.lock.acquire(0)):
+                raise p4317q.PortBusy(p4317q.p4317q_busy_message(self.port_name, p4317q.p4317q_port_owner(self.port_name)))
+            try:
+                self.serial = p4317q.p4317q_open_port(self.port_name, self.baudrate, 0)
+            except:
+                self.lock.release()
+                raise
+            self.fd = self.serial.fileno()
+            self.loop.add_reader(self.fd, self.on_readable)
+        return self
+
+    def close(self):
+        "Close the port, cancelling anything still queued"
+        pending = list(self.requests) + ([self.current] if self.current else [])
+        self.requests.clear()
+        self.current = None
+        for request in pending:
+            request.operation.cancel()
+        if (self.serial is not None):
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.serial.close()
+            self.serial = None
+            self.fd = None
+            self.lock.release()
+
+    def submit(self, action, command, param=None, timeout=None, decode=False):
+        "Queue a request and return its Operation"
+        request = Request(p4317q.COMMANDS[action][command], param, self.timeout if timeout is None else timeout, decode)
+        request.operation = Operation(on_cancel=lambda: self.on_cancel(request))
+        self.requests.append(request)
+        self.pump()
+        return request.operation
+
+    def get(self, command, param=None, timeout=None):
+        "Operation giving the response payload, as MonitorSession.get"
+        return self.submit("get", command, param, timeout)
+
+    def get_value(self, command, param=None, timeout=None):
+        "Operation giving the decoded value, as MonitorSession.get_value"
+        return self.submit("get", command, param, timeout, decode=True)
+
+    def set(self, command, param, timeout=None):
+        return self.submit("set", command, param, timeout)
+
+    def reset(self, command, timeout=None):
+        return self.submit("reset", command, None, timeout)
+
+    def dump(self, timeout=None):
+        "Operation giving (command, param, payload) for every setting; payload is None where a get failed"
+        def run():
+            records = []
+            for (command, param) in p4317q.dump_requests():
+                try:
+                    payload = yield self.get(command, param, timeout)
+                except OperationTimeout:
+                    payload = None
+                records.append((command, param, payload))
+            raise Return(records)
+        return spawn(self.loop, run())
+
+    def pump(self):
+        "Start queued requests while nothing is waiting for a reply"
+        while (self.current is None and len(self.requests) > 0):
+            request = self.requests.popleft()
+            if (request.operation.done()):
+                continue
+            self.write(request.entry.build(request.param))
+            if (request.entry.action != "get"):
+                # Only get commands have a response.
+                request.operation.set_result(None)
+                continue
+            self.current = request
+            request.timer = self.loop.call_later(request.timeout, lambda: self.on_timeout(request))
+
+    def write(self, frame):
+        self.output += frame
+        self.on_writable()
+
+    def on_writable(self):
+        try:
+            written = os.write(self.fd, bytes(self.output))
+        except OSError as error:
+            if (error.errno != errno.EAGAIN):
+                raise
+            written = 0
+        del self.output[:written]
+        if (len(self.output) > 0):
+            self.loop.add_writer(self.fd, self.on_writable)
+        else:
+            self.loop.remove_writer(self.fd)
+
+    def on_readable(self):
+        data = self.serial.read(max(1, self.serial.in_waiting))
+        self.framer.feed(data)
+        while True:
+            response = self.framer.next_frame()
+            if (response is None):
+                break
+            request = self.current
+            if (request is None or response[2] != request.entry.tag):
+                # A late reply to a request that timed out or was cancelled
+                continue
+            request.timer.cancel()
+            self.current = None
+            if (request.decode):
+                value = p4317q.p4317q_decode_response(response, request.entry.name)
+            else:
+                value = p4317q.p4317q_parse_response(response, request.entry.tag)
+            if (value is None):
+                request.operation.set_exception(IOError("Invalid response to get " + request.entry.name))
+            else:
+                request.operation.set_result(value)
+        self.pump()
+
+    def on_timeout(self, request):
+        if (self.current is request):
+            self.current = None
+            self.framer.timeouts += 1
+            request.operation.set_exception(OperationTimeout("No reply to get " + request.entry.name))
+            self.pump()
+
+    def on_cancel(self, request):
+        if (self.current is request):
+            request.timer.cancel()
+            self.current = None
+            self.pump()
+
+def open_monitors(loop, ports, baudrate=p4317q.DEFAULT_BAUDRATE, timeout=p4317q.DEFAULT_RESPONSE_TIMEOUT):
+    "Open an AsyncMonitor on every port.  If one cannot be opened, closes the ones already open and raises"
+    monitors = []
+    try:
+        for port in ports:
+            monitors.append(AsyncMonitor(loop, port, baudrate, timeout).open())
+    except:
+        for monitor in monitors:
+            monitor.close()
+        raise
+    return monitors
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " --ports port,port,... [--timeout s] {dump | get {command} [index]}"
+    print ""
+    print "Reads from every monitor at once from a single thread."
+
+if (__name__ == "__main__"):
+    args = sys.argv[1:]
+    ports = p4317q.take_option(args, "--ports", "")
+    timeout = float(p4317q.take_option(args, "--timeout", p4317q.DEFAULT_RESPONSE_TIMEOUT))
+    ports = [port for port in ports.split(",") if port != ""]
+    if (len(ports) == 0 or len(args) < 1 or args[0] not in ("dump", "get")):
+        print_usage()
+        exit()
+    if (args[0] == "get"):
+        parsed = p4317q.p4317q_parse_command(args)
+        if (parsed is None):
+            exit(1)
+
+    loop = EventLoop()
+    try:
+        monitors = open_monitors(loop, ports, timeout=timeout)
+    except p4317q.PortLockError as error:
+        print "ERROR:  " + str(error)
+        exit(1)
+    if (args[0] == "dump"):
+        operations = [monitor.dump() for monitor in monitors]
+    else:
+        operations = [monitor.get(parsed[1], parsed[2]) for monitor in monitors]
+    start = time.time()
+    for operation in operations:
+        while (not operation.done()):
+            loop.run_once()
+    elapsed = time.time() - start
+
+    for (monitor, operation) in zip(monitors, operations):
+        print "== " + monitor.port_name
+        if (operation.exception() is not None):
+            print "    ERROR:  " + str(operation.exception())
+        elif (args[0] == "dump"):
+            for (command, param, payload) in operation.result():
+                if (payload is not None):
+                    print "    " + p4317q.format_response_text(command, payload, param)
+        else:
+            print "    " + p4317q.format_response_text(parsed[1], operation.result(), parsed[2])
+        monitor.close()
+    print "%d monitors in %.1f ms" % (len(monitors), elapsed * 1000)
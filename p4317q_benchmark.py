@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+# Benchmarks for the P4317Q control program.
+#
+# Each stage of the command path is timed on its own: building frames,
+# checksums, response parsing and formatting, and full get/set round trips
+# and dumps against the emulator.  Startup is timed in fresh interpreters:
+# importing the module, printing usage and a first get from the command
+# line, each against a budget.  With --replay, framing and parsing are also
+# timed over the replies in a recorded session.  Results are written as JSON with
+# percentiles so runs can be compared, e.g.
+#
+#   python p4317q_benchmark.py --output before.json
+#   ...change something...
+#   python p4317q_benchmark.py --compare before.json
+
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_emulator
+
+BENCHMARK_VERSION=1
+
+# Startup budgets in seconds, over the bare interpreter start
+STARTUP_BUDGETS = {
+    "startup_import":       0.010,
+    "startup_usage":        0.010,
+    "startup_first_get":    0.030
+}
+
+def percentile(ordered, fraction):
+    "Nearest-rank percentile of an already sorted list"
+    index = int(round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+def summarize(samples):
+    "Reduce per-operation times in seconds to a result record in microseconds"
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered)
+    return { "unit": "us",
+             "samples": len(ordered),
+             "min": ordered[0] * 1e6,
+             "mean": mean * 1e6,
+             "p50": percentile(ordered, 0.50) * 1e6,
+             "p90": percentile(ordered, 0.90) * 1e6,
+             "p99": percentile(ordered, 0.99) * 1e6,
+             "max": ordered[-1] * 1e6,
+             "ops_per_sec": (1.0 / mean) if mean > 0 else None }
+
+def measure(function, batches, batch_size):
+    "Time batch_size calls per sample.  Returns the per-call time of each batch"
+    timer = time.time
+    samples = []
+    for batch in range(batches):
+        start = timer()
+        for call in range(batch_size):
+            function()
+        samples.append((timer() - start) / batch_size)
+    return samples
+
+def build_response(command, data):
+    "Build what p4317q_read_response returns for a get reply: payload plus checksum"
+    payload = bytearray([p4317q.RSP_REPLY_CODE, 0x00, p4317q.GET_ACTIONS[command]]) + bytearray(data)
+    frame = p4317q.RSP_HEADER + bytearray([len(payload)]) + payload
+    checksum = 0
+    for b in frame:
+        checksum ^= b
+    return payload + bytearray([checksum])
+
+def xor_reference(message, begin, length):
+    "The bare checksum loop, as a floor for p4317q_checksum"
+    total = 0
+    for index in range(begin, begin+length):
+        total ^= message[index]
+    return total & 0xFF
+
+class Quiet(object):
+    "Send stdout to /dev/null for the duration of a with block"
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+def run_codec_benchmarks(results, scale):
+    "CPU-only stages, measured in batches"
+    batches = 50 * scale
+    subinput = bytearray([1]) + p4317q.pxp_input["hdmi2"]
+    frame = p4317q.p4317q_build_command("set", "pxpsubinput", subinput)
+    brightness_response = build_response("brightness", [42])
+    serial_response = build_response("monitorserial", "CN0EMU1234")
+    brightness_payload = p4317q.p4317q_parse_response(brightness_response, p4317q.GET_ACTIONS["brightness"])
+    subinput_payload = p4317q.p4317q_parse_response(build_response("pxpsubinput", p4317q.pxp_input["dp"]), p4317q.GET_ACTIONS["pxpsubinput"])
+
+    stages = [
+        ("build_get",            lambda: p4317q.p4317q_build_command("get", "brightness", None)),
+        ("build_set",            lambda: p4317q.p4317q_build_command("set", "brightness", 42)),
+        ("build_set_subinput",   lambda: p4317q.p4317q_build_command("set", "pxpsubinput", subinput)),
+        ("checksum",             lambda: p4317q.p4317q_checksum(frame, 0, len(frame)-1)),
+        ("checksum_reference",   lambda: xor_reference(frame, 0, len(frame)-1)),
+        ("parse_brightness",     lambda: p4317q.p4317q_parse_response(brightness_response, p4317q.GET_ACTIONS["brightness"])),
+        ("parse_monitorserial",  lambda: p4317q.p4317q_parse_response(serial_response, p4317q.GET_ACTIONS["monitorserial"])),
+        ("decode_brightness",    lambda: p4317q.p4317q_decode_response(brightness_response, "brightness")),
+        ("decode_monitorserial", lambda: p4317q.p4317q_decode_response(serial_response, "monitorserial")),
+        ("format_brightness",    lambda: p4317q.format_response_text("brightness", brightness_payload, None)),
+        ("format_pxpsubinput",   lambda: p4317q.format_response_text("pxpsubinput", subinput_payload, 0)),
+    ]
+    for (name, function) in stages:
+        results[name] = summarize(measure(function, batches, 200))
+
+    # How much p4317q_checksum costs over the bare XOR loop it wraps
+    results["checksum_overhead_ratio"] = results["checksum"]["mean"] / results["checksum_reference"]["mean"]
+
+def run_wire_benchmarks(results, scale, baudrate):
+    "Round trips against the emulator, one sample per call"
+    byte_time = p4317q_emulator.wire_byte_time(baudrate) if baudrate else 0.0
+    rounds = 50 * scale if baudrate else 500 * scale
+    with p4317q_emulator.P4317QEmulator(byte_time=byte_time) as emulator:
+        with p4317q.MonitorSession(emulator.port_name) as session:
+            results["get_roundtrip"] = summarize(measure(lambda: session.get("brightness"), rounds, 1))
+            # Sets are not answered, so a get after each one keeps them from
+            # piling up in the emulator faster than it can consume them.
+            def set_then_get():
+                session.set("brightness", 42)
+                session.get("brightness")
+            results["set_get_roundtrip"] = summarize(measure(set_then_get, rounds, 1))
+            # The same pairs streamed with MonitorSession.pipeline, per pair
+            pairs = [("set", "brightness", 42), ("get", "brightness", None)] * 10
+            results["set_get_pipelined"] = summarize([sample / 10 for sample in measure(lambda: session.pipeline(pairs), max(5, rounds / 10), 1)])
+            with Quiet():
+                results["dump"] = summarize(measure(lambda: p4317q.dump_info(session), max(5, rounds / 10), 1))
+        # What the dump action pays, including opening and closing the port
+        def cli_dump():
+            with p4317q.MonitorSession(emulator.port_name) as session:
+                p4317q.dump_info(session)
+        with Quiet():
+            results["dump_with_open"] = summarize(measure(cli_dump, max(5, rounds / 10), 1))
+
+def program_path(name):
+    "A program next to the control program"
+    return os.path.join(os.path.dirname(os.path.abspath(p4317q.__file__)), name)
+
+def run_startup_benchmarks(results, scale, baudrate):
+    "Fresh interpreters, one sample per start.  Each stage also records its time over the bare interpreter and its budget"
+    rounds = 10 * scale
+    program = program_path("p4317q_cli.py")
+    directory = os.path.dirname(program)
+    byte_time = p4317q_emulator.wire_byte_time(baudrate) if baudrate else 0.0
+    def start(arguments):
+        def run():
+            with open(os.devnull, "w") as null:
+                subprocess.call([sys.executable] + arguments, cwd=directory, stdout=null, stderr=null)
+        return run
+
+    with p4317q_emulator.P4317QEmulator(byte_time=byte_time) as emulator:
+        stages = [
+            ("startup_python",      ["-c", "pass"]),
+            ("startup_import",      ["-c", "import dell_p4317q_serial_control_program"]),
+            ("startup_usage",       [program]),
+            # The same, run as the main script and so compiled every time
+            ("startup_usage_script", [program_path("dell_p4317q_serial_control_program.py")]),
+            ("startup_first_get",   [program, "--port", emulator.port_name, "get", "brightness"]),
+        ]
+        for (name, arguments) in stages:
+            results[name] = summarize(measure(start(arguments), rounds, 1))
+    floor = results["startup_python"]["p50"]
+    for (name, budget) in STARTUP_BUDGETS.items():
+        results[name]["over_python_us"] = results[name]["p50"] - floor
+        results[name]["budget_us"] = budget * 1e6
+        results[name]["within_budget"] = results[name]["over_python_us"] <= budget * 1e6
+
+    # Modules a plain import pulls in that only some commands need
+    check = "import sys, dell_p4317q_serial_control_program; print ' '.join([name for name in ('serial', 'json', 'threading') if name in sys.modules])"
+    loaded = subprocess.check_output([sys.executable, "-c", check], cwd=directory).split()
+    results["startup_import_loads"] = loaded
+
+def run_replay_benchmarks(results, scale, path):
+    "Framing and parsing of recorded traffic, per reply"
+    import p4317q_replay
+    (start, baudrate, channels, events) = p4317q_replay.load_session(path)
+    replies = p4317q_replay.parse_received(events)
+    if (replies > 0):
+        results["replay_parse"] = summarize([sample / replies for sample in measure(lambda: p4317q_replay.parse_received(events), 20 * scale, 1)])
+
+def compare(current, baseline):
+    "Print the change of every stage against a previous result file"
+    print "%-24s %12s %12s %8s" % ("stage", "base p50 us", "now p50 us", "ratio")
+    for name in sorted(current["results"]):
+        now = current["results"][name]
+        base = baseline["results"].get(name)
+        if (not isinstance(now, dict) or not isinstance(base, dict)):
+            continue
+        print "%-24s %12.2f %12.2f %8.2f" % (name, base["p50"], now["p50"], now["p50"] / base["p50"])
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--output file] [--compare file] [--baudrate rate] [--scale n] [--codec-only] [--startup] [--replay session]"
+    print ""
+    print " --output      write the JSON results here instead of stdout"
+    print " --compare     print p50 ratios against an earlier result file"
+    print " --baudrate    emulated line rate for round trips (0 = no line delay, default 9600)"
+    print " --scale       multiply the number of samples"
+    print " --codec-only  skip the emulator round trips"
+    print " --startup     also time interpreter starts: import, usage and a first get"
+    print " --replay      also time framing and parsing the replies in a recorded session"
+
+def main(args):
+    if ("-h" in args or "--help" in args):
+        print_usage()
+        return
+    output = p4317q.take_option(args, "--output", None)
+    baseline = p4317q.take_option(args, "--compare", None)
+    baudrate = int(p4317q.take_option(args, "--baudrate", 9600))
+    scale = int(p4317q.take_option(args, "--scale", 1))
+    codec_only = "--codec-only" in args
+    startup = "--startup" in args
+    replay = p4317q.take_option(args, "--replay", None)
+
+    results = {}
+    run_codec_benchmarks(results, scale)
+    if (not codec_only):
+        run_wire_benchmarks(results, scale, baudrate)
+    if (startup):
+        run_startup_benchmarks(results, scale, baudrate)
+    if (replay is not None):
+        run_replay_benchmarks(results, scale, replay)
+
+    report = { "version": BENCHMARK_VERSION,
+               "timestamp": time.time(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "baudrate": baudrate,
+               "results": results }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if (output is not None):
+        with open(output, "w") as output_file:
+            output_file.write(text + "\n")
+    elif (baseline is None):
+        print text
+    if (baseline is not None):
+        with open(baseline) as baseline_file:
+            compare(report, json.load(baseline_file))
+
+if (__name__ == "__main__"):
+    main(sys.argv[1:])
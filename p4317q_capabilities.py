@@ -0,0 +1,131 @@
+#!/usr/bin/python
+
+# Persistent cache of each monitor's capabilities.
+#
+# colorpresetcaps and videoinputcaps are bitfields of the color presets and
+# video inputs a monitor supports.  They only change with the firmware, so
+# they are read once per monitor serial number and firmware version and
+# kept on disk, together with which port each monitor was last seen on.
+# Sets of a preset or input can then be checked without a round trip; a
+# set the cached caps reject is only refused after the caps have been read
+# again, in case another monitor is now on the port.  MonitorSession makes
+# the check for every set it sends.
+
+import os
+import sys
+import json
+
+import dell_p4317q_serial_control_program as p4317q
+
+CAPS_CACHE_VERSION=1
+DEFAULT_CAPS_CACHE=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "p4317q-caps.json")
+CAPS_COMMANDS = ("colorpresetcaps", "videoinputcaps")
+
+class CapabilityCache(object):
+    "Caps bitfields by monitor serial number and firmware, kept in a JSON file"
+
+    def __init__(self, path=DEFAULT_CAPS_CACHE):
+        self.path = path
+        # "serial/firmware" -> {caps command: hex}
+        self.monitors = {}
+        # port -> "serial/firmware" of the monitor last seen there
+        self.ports = {}
+        self.hits = 0
+        self.reads = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                contents = json.load(cache_file)
+        except (IOError, ValueError):
+            return
+        if (isinstance(contents, dict) and contents.get("version") == CAPS_CACHE_VERSION):
+            self.monitors = contents.get("monitors", {})
+            self.ports = contents.get("ports", {})
+
+    def save(self):
+        "Write the cache, replacing the old file in one step"
+        directory = os.path.dirname(self.path)
+        if (directory != "" and not os.path.isdir(directory)):
+            os.makedirs(directory)
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as cache_file:
+            json.dump({ "version": CAPS_CACHE_VERSION, "monitors": self.monitors, "ports": self.ports },
+                      cache_file, indent=1, separators=(",", ": "), sort_keys=True)
+            cache_file.write("\n")
+        os.rename(temporary, self.path)
+
+    def caps(self, session, refresh=False):
+        "Caps of the monitor on session as {caps command: bytearray}, or None if it did not answer"
+        key = self.ports.get(session.port_name)
+        if (not refresh and key in self.monitors):
+            self.hits += 1
+            return dict([(name, bytearray(value.decode("hex"))) for (name, value) in self.monitors[key].items()])
+
+        self.reads += 1
+        requests = [("get", "monitorserial", None), ("get", "versionfirmware", None)] + [("get", name, None) for name in CAPS_COMMANDS]
+        replies = session.pipeline(requests)
+        if (None in replies):
+            return None
+        (serial_number, firmware) = [p4317q.format_response_record(command, reply, param)["value"]
+                                     for ((action, command, param), reply) in zip(requests[:2], replies[:2])]
+        key = serial_number + "/" + firmware
+        caps = dict(zip(CAPS_COMMANDS, replies[2:]))
+        self.monitors[key] = dict([(name, str(value).encode("hex")) for (name, value) in caps.items()])
+        self.ports[session.port_name] = key
+        self.save()
+        return caps
+
+    def check(self, session, command, param):
+        "Check a parsed set against the caps of the monitor on session.  Returns what is wrong with it, or None"
+        if (command not in p4317q.CAPS_CHECKS):
+            return None
+        cached = self.ports.get(session.port_name) in self.monitors
+        caps = self.caps(session)
+        if (caps is None):
+            # Cannot tell; let the monitor decide
+            return None
+        problem = p4317q.p4317q_check_caps(command, param, caps)
+        if (problem is not None and cached):
+            caps = self.caps(session, refresh=True)
+            if (caps is not None):
+                problem = p4317q.p4317q_check_caps(command, param, caps)
+        return problem
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--port port | --monitor serial] [--cache file] {show|refresh}"
+    print ""
+    print "show    - Prints the color presets and video inputs the monitor supports"
+    print "refresh - Reads the caps from the monitor again"
+    print ""
+    print " --cache  caps cache file (default " + DEFAULT_CAPS_CACHE + ")"
+
+def main(args):
+    port = p4317q.take_option(args, "--port", p4317q.DEFAULT_PORT)
+    monitor = p4317q.take_option(args, "--monitor", None)
+    path = p4317q.take_option(args, "--cache", DEFAULT_CAPS_CACHE)
+    if (len(args) != 1 or args[0] not in ("show", "refresh")):
+        print_usage()
+        return 1
+    if (monitor is not None):
+        import p4317q_discovery
+        port = p4317q_discovery.resolve_monitor(monitor)
+        if (port is None):
+            print "ERROR:  No monitor with serial number " + monitor + " found"
+            return 1
+
+    cache = CapabilityCache(path)
+    with p4317q.MonitorSession(port) as session:
+        caps = cache.caps(session, refresh=(args[0] == "refresh"))
+    if (caps is None):
+        print "ERROR:  No valid response from monitor"
+        return 1
+    print "Monitor:        " + cache.ports[port]
+    print "Color presets:  " + ", ".join(p4317q.record_caps(p4317q.color_presets)(caps["colorpresetcaps"]))
+    print "Video inputs:   " + ", ".join(p4317q.record_caps(p4317q.pxp_input)(caps["videoinputcaps"]))
+    return 0
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
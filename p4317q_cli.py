@@ -0,0 +1,14 @@
+#!/usr/bin/python
+
+# Command line entry point for the control program.
+#
+# Running dell_p4317q_serial_control_program.py directly compiles all of it
+# on every start, as Python never caches the main script.  This imports it
+# instead, so its compiled form is reused; the arguments are the same.
+
+import sys
+
+import dell_p4317q_serial_control_program as p4317q
+
+if (__name__ == "__main__"):
+    exit(p4317q.main(sys.argv[1:]))
@@ -0,0 +1,444 @@
+#!/usr/bin/python
+
+# Control daemon for the Dell P4317Q.
+#
+# The daemon keeps the serial port open and runs every request through a
+# single queue, so several tools can share one monitor without racing for
+# the port.  Requests are newline delimited JSON-RPC 2.0 over a Unix domain
+# socket.  Methods are get, set, reset, dump, fade and stats; params are
+# the same arguments the command line program takes after the action, e.g.
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "set", "params": ["pxpsubinput", "1", "hdmi1"]}
+#
+# A fade is answered as soon as it starts and runs its steps through the
+# queue like any other set.  A new fade replaces the one running.
+#
+# Requests without an id are JSON-RPC notifications: they are queued and
+# not answered, so a client can stream sets without waiting for each one.
+# A request may add "priority": "background" (e.g. for periodic polling) to
+# let interactive requests go first.  See p4317q_scheduler.py for how
+# queued sets to the same setting are coalesced.
+#
+# Run without "serve" this is a thin client with the same syntax as
+# dell_p4317q_serial_control_program.py.  The daemon holds the port's lock
+# and names its socket in the lock file, so that program hands get, set,
+# reset, dump and fade over to it instead of waiting for the port.
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import time
+import threading
+import Queue
+import SocketServer
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_scheduler
+import p4317q_fade
+
+DEFAULT_SOCKET=os.path.join(os.environ.get("XDG_RUNTIME_DIR", "/tmp"), "p4317q.sock")
+
+# JSON-RPC 2.0 error codes
+RPC_PARSE_ERROR=-32700
+RPC_INVALID_REQUEST=-32600
+RPC_METHOD_NOT_FOUND=-32601
+RPC_INVALID_PARAMS=-32602
+RPC_MONITOR_ERROR=-32000
+
+class RPCError(Exception):
+    "An error to be returned to the client as a JSON-RPC error object"
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+def response_record(command, param, response):
+    "Describe one get response as a JSON-able dict"
+    record = { "command": command, "param": param, "value": None, "text": None }
+    if (response is not None):
+        record["value"] = list(bytearray(response))
+        record["text"] = str(p4317q.format_response_text(command, response, param))
+    return record
+
+class WorkerSession(object):
+    "The part of MonitorSession a Fade uses, run through a MonitorWorker's queue"
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.baudrate = worker.session.baudrate
+
+    def get_value(self, command, param=None):
+        try:
+            record = self.worker.queue(("get", command, param))
+        except RPCError:
+            return None
+        return p4317q.COMMANDS["get"][command].decode(bytearray(record["value"]), 0, len(record["value"]))
+
+    def set(self, command, param):
+        self.worker.queue(("set", command, param))
+
+class MonitorWorker(object):
+    "Owns the monitor session and runs scheduled requests one at a time"
+
+    def __init__(self, session):
+        self.session = session
+        self.requests = p4317q_scheduler.CommandScheduler()
+        self.fader = p4317q_fade.Fader(WorkerSession(self))
+        self.thread = threading.Thread(target=self.run, name="p4317q-worker")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.fader.cancel()
+        self.requests.close()
+        self.thread.join()
+
+    def submit(self, method, params, priority=p4317q_scheduler.PRIORITY_INTERACTIVE, wait=True):
+        "Queue a request and, if wait, wait for its result.  Raises RPCError on failure"
+        if (method == "fade"):
+            return self.fade(params)
+        if (method in ("stats", "dump")):
+            item = (method, None, None)
+        elif (method in ("get", "set", "reset")):
+            if (not isinstance(params, list)):
+                raise RPCError(RPC_INVALID_PARAMS, "params must be a list of command arguments")
+            item = p4317q.p4317q_parse_command([method] + [str(param) for param in params])
+            if (item is None):
+                raise RPCError(RPC_INVALID_PARAMS, "Invalid command " + " ".join([method] + [str(param) for param in params]))
+        else:
+            raise RPCError(RPC_METHOD_NOT_FOUND, "Unknown method " + str(method))
+
+        if (method == "stats"):
+            # Answered straight away, so it shows the queue as it is
+            return self.stats()
+        return self.queue(item, priority, wait)
+
+    def queue(self, item, priority=p4317q_scheduler.PRIORITY_INTERACTIVE, wait=True):
+        "Queue a parsed (action, command, param) request and, if wait, wait for its result.  Raises RPCError on failure"
+        if (not wait):
+            self.requests.put(item, lambda reply: None, priority, p4317q_scheduler.coalesce_key(item))
+            return None
+        done = Queue.Queue(1)
+        self.requests.put(item, done.put, priority, p4317q_scheduler.coalesce_key(item))
+        (ok, result) = done.get()
+        if (not ok):
+            raise result
+        return result
+
+    def fade(self, params):
+        "Start fading to the target in fade arguments, replacing any fade running.  Returns the fade as a dict"
+        if (not isinstance(params, list)):
+            raise RPCError(RPC_INVALID_PARAMS, "params must be a list of command arguments")
+        parsed = p4317q_fade.parse_fade([str(param) for param in params])
+        if (parsed is None):
+            raise RPCError(RPC_INVALID_PARAMS, "Invalid fade " + " ".join([str(param) for param in params]))
+        (command, target, duration) = parsed
+        try:
+            fade = self.fader.fade_to(command, target, duration)
+        except IOError as error:
+            raise RPCError(RPC_MONITOR_ERROR, str(error))
+        return { "command": command, "start": fade.start, "target": fade.target, "duration": duration,
+                 "steps": fade.steps, "interval": fade.interval }
+
+    def stats(self):
+        stats = { "framer": self.session.framer.counters(), "queue": self.requests.stats() }
+        if (self.session.cache is not None):
+            stats["cache"] = self.session.cache.stats()
+        return stats
+
+    def run(self):
+        try:
+            # Take the port now, so command line callers find the daemon holding it
+            self.session.open()
+        except Exception:
+            # Tried again on the first request
+            pass
+        while True:
+            request = self.requests.take()
+            if (request is None):
+                break
+            try:
+                reply = (True, self.execute(request.item))
+            except RPCError as error:
+                reply = (False, error)
+            except Exception as error:
+                # Serial errors leave the port in an unknown state, start over
+                # with a fresh open on the next request.
+                self.session.close()
+                reply = (False, RPCError(RPC_MONITOR_ERROR, str(error)))
+            for waiter in request.waiters:
+                waiter(reply)
+            self.pace(request.item)
+        self.session.close()
+
+    def pace(self, item):
+        "Wait until a set or reset frame has left the wire, so later sets stay queued where they can be coalesced"
+        (action, command, param) = item
+        if (action in ("set", "reset")):
+            frame_length = p4317q.COMMANDS[action][command].length + 4
+            time.sleep(p4317q.p4317q_wire_time(frame_length, self.session.baudrate))
+
+    def execute(self, item):
+        (action, command, param) = item
+        if (action == "dump"):
+            records = []
+            for (command, param) in p4317q.dump_requests():
+                records.append(response_record(command, param, self.session.get(command, param)))
+            return records
+
+        try:
+            response = self.session.command(action, command, param)
+        except p4317q.UnsupportedSetting as error:
+            raise RPCError(RPC_INVALID_PARAMS, "Invalid parameter: " + str(error))
+        if (action != "get"):
+            return None
+        if (response is None):
+            raise RPCError(RPC_MONITOR_ERROR, "No valid response from monitor")
+        return response_record(command, param, response)
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    "Handles one client connection.  A client may send any number of requests"
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if (line.strip() == ""):
+                continue
+            reply = self.server.dispatch(line)
+            if (reply is None):
+                continue
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+class MonitorDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    "Unix socket JSON-RPC server in front of a single MonitorWorker"
+
+    daemon_threads = True
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, port=p4317q.DEFAULT_PORT, cache=None):
+        self.socket_path = socket_path
+        remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+        self.worker = MonitorWorker(p4317q.MonitorSession(port, cache=cache, socket_path=socket_path))
+        self.worker.start()
+
+    def dispatch(self, line):
+        "Run one JSON-RPC request line and return the reply object, or None for a notification"
+        request_id = None
+        notification = False
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                raise RPCError(RPC_PARSE_ERROR, "Parse error")
+            if (not isinstance(request, dict) or "method" not in request):
+                raise RPCError(RPC_INVALID_REQUEST, "Invalid request")
+            request_id = request.get("id")
+            priority = p4317q_scheduler.PRIORITIES.get(request.get("priority", "interactive"))
+            if (priority is None):
+                raise RPCError(RPC_INVALID_REQUEST, "priority must be interactive or background")
+            if ("id" not in request):
+                # A notification: queue it and move on to the next line
+                notification = True
+                self.worker.submit(request["method"], request.get("params", []), priority, False)
+                return None
+            result = self.worker.submit(request["method"], request.get("params", []), priority)
+            return { "jsonrpc": "2.0", "id": request_id, "result": result }
+        except RPCError as error:
+            if (notification):
+                return None
+            return { "jsonrpc": "2.0", "id": request_id, "error": { "code": error.code, "message": error.message } }
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.worker.stop()
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+def remove_stale_socket(socket_path):
+    "Remove a socket file left behind by a daemon that is no longer running"
+    if (not os.path.exists(socket_path)):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_path)
+    except socket.error as error:
+        if (error.errno in (errno.ECONNREFUSED, errno.ENOENT)):
+            os.unlink(socket_path)
+            return
+        raise
+    finally:
+        probe.close()
+    raise RuntimeError("A daemon is already listening on " + socket_path)
+
+class DaemonClient(object):
+    "Client side of the daemon socket.  One connection is reused for every call"
+
+    def __init__(self, socket_path=DEFAULT_SOCKET):
+        self.socket_path = socket_path
+        self.sock = None
+        self.rfile = None
+        self.next_id = 0
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def connect(self):
+        if (self.sock is None):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.socket_path)
+            self.rfile = self.sock.makefile("rb")
+        return self
+
+    def close(self):
+        if (self.sock is not None):
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+            self.rfile = None
+
+    def call(self, method, params=None, priority=None):
+        "Make one request.  Returns the result, raises RPCError on an error reply"
+        self.connect()
+        self.next_id += 1
+        request = { "jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params or [] }
+        if (priority is not None):
+            request["priority"] = priority
+        self.sock.sendall(json.dumps(request) + "\n")
+        line = self.rfile.readline()
+        if (line == ""):
+            raise RPCError(RPC_MONITOR_ERROR, "Daemon closed the connection")
+        reply = json.loads(line)
+        if ("error" in reply):
+            raise RPCError(reply["error"]["code"], reply["error"]["message"])
+        return reply["result"]
+
+    def notify(self, method, params=None, priority=None):
+        "Queue a request without waiting for it to run.  Nothing comes back, not even errors"
+        self.connect()
+        request = { "jsonrpc": "2.0", "method": method, "params": params or [] }
+        if (priority is not None):
+            request["priority"] = priority
+        self.sock.sendall(json.dumps(request) + "\n")
+
+def hand_off(socket_path, args, output_format="text", port=None):
+    "Run a get, set, reset, dump or fade command line on the daemon at socket_path and print the result the way the control program does.  Returns the exit status, or None if the daemon cannot be reached"
+    if (args[0] == "fade"):
+        if (p4317q_fade.parse_fade(args[1:]) is None):
+            return 1
+    elif (args[0] != "dump"):
+        # Checked here so errors read the same as without a daemon
+        parsed = p4317q.p4317q_parse_command(list(args))
+        if (parsed is None):
+            return 1
+    try:
+        with DaemonClient(socket_path) as client:
+            result = client.call(args[0], args[1:])
+    except socket.error:
+        return None
+    except RPCError as error:
+        print "ERROR:  " + error.message
+        return 1
+
+    if (args[0] == "fade"):
+        print p4317q_fade.describe_fade(result["command"], result["start"], result["target"], result["duration"],
+                                        result["steps"], result["interval"])
+        return 0
+    records = result if args[0] == "dump" else [result] if result is not None else []
+    if (output_format == "text"):
+        for record in records:
+            if (record["text"] is not None):
+                print record["text"]
+        return 0
+    records = [p4317q.format_response_record(record["command"], bytearray(record["value"]) if record["value"] is not None else None,
+                                             record["param"]) for record in records]
+    if (args[0] == "get"):
+        records[0]["port"] = port
+        print json.dumps(records[0], indent=2 if output_format == "json" else None, sort_keys=True)
+        return 0
+    writer = p4317q.RecordWriter(output_format, fields={ "port": port })
+    for record in records:
+        writer.write(record)
+    writer.close()
+    return 0
+
+def serve(socket_path, port, cache=None):
+    "Run the daemon until interrupted"
+    server = MonitorDaemon(socket_path, port, cache)
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    print "Listening on " + socket_path + " for " + port
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--socket path] serve [--port port | --monitor serial] [--cache]"
+    print sys.argv[0] + " [--socket path] [--background] {get|set|reset} {command} [parameter]"
+    print sys.argv[0] + " [--socket path] [--background] dump"
+    print sys.argv[0] + " [--socket path] fade {brightness|contrast|customcolor} target [--over duration]"
+    print sys.argv[0] + " [--socket path] stats"
+    print ""
+    print "serve - Runs the daemon, keeping the monitor's serial port open."
+    print "        --cache answers repeated gets from a cache that sets invalidate"
+    print "stats - Prints the daemon's framing, queue and cache counters"
+    print "fade  - Starts a fade in the daemon and returns; a new fade replaces it"
+    print "--background lets interactive requests from other clients go first"
+    print "Anything else is sent to a running daemon; see"
+    print "dell_p4317q_serial_control_program.py for the commands."
+
+if (__name__ == "__main__"):
+    args = sys.argv[1:]
+    socket_path = p4317q.take_option(args, "--socket", DEFAULT_SOCKET)
+    port = p4317q.take_option(args, "--port", p4317q.DEFAULT_PORT)
+    priority = "background" if p4317q.take_flag(args, "--background") else None
+    if (len(args) < 1):
+        print_usage()
+        exit()
+
+    if (args[0] == "serve"):
+        monitor = p4317q.take_option(args, "--monitor", None)
+        if (monitor is not None):
+            import p4317q_discovery
+            port = p4317q_discovery.resolve_monitor(monitor)
+            if (port is None):
+                print "ERROR:  No monitor with serial number " + monitor + " found"
+                exit(1)
+        serve(socket_path, port, p4317q.StateCache() if p4317q.take_flag(args, "--cache") else None)
+        exit()
+
+    try:
+        with DaemonClient(socket_path) as client:
+            result = client.call(args[0], args[1:], priority)
+    except RPCError as error:
+        print "ERROR:  " + error.message
+        exit(1)
+    except socket.error as error:
+        print "ERROR:  Cannot reach daemon on " + socket_path + ": " + str(error)
+        exit(1)
+
+    if (args[0] == "stats"):
+        print json.dumps(result, indent=2, sort_keys=True)
+    elif (args[0] == "fade"):
+        print p4317q_fade.describe_fade(result["command"], result["start"], result["target"], result["duration"],
+                                        result["steps"], result["interval"])
+    elif (args[0] == "dump"):
+        for record in result:
+            if (record["text"] is not None):
+                print record["text"]
+    elif (result is not None):
+        print result["text"]
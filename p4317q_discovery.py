@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# Finds which serial port each P4317Q is on.
+#
+# Candidate ports are probed in parallel with a short timeout, asking each
+# for its serial number and name.  What was found is kept in a small JSON
+# file keyed by the stable /dev/serial/by-id path of each port (ttyUSB
+# numbers change between boots and replugs, by-id paths do not).  On later
+# runs a monitor's cached port is checked with a single monitorserial get,
+# and only if that fails are all ports probed again, so
+#
+#   python dell_p4317q_serial_control_program.py --monitor CN0XXXXXXX dump
+#
+# finds its port without scanning.
+
+import os
+import sys
+import json
+import time
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_fleet
+
+IDENTITY_CACHE_VERSION=1
+DEFAULT_IDENTITY_CACHE=os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "p4317q-ports.json")
+# A monitor answers a get within a few tens of milliseconds at 9600 baud
+PROBE_TIMEOUT=0.5
+BY_ID_DIRECTORY="/dev/serial/by-id"
+
+def stable_port_names():
+    "Map each device's real path to its /dev/serial/by-id link"
+    names = {}
+    if (os.path.isdir(BY_ID_DIRECTORY)):
+        for link in sorted(os.listdir(BY_ID_DIRECTORY)):
+            path = os.path.join(BY_ID_DIRECTORY, link)
+            names[os.path.realpath(path)] = path
+    return names
+
+def stable_port_name(port, names=None):
+    "The by-id path for port, or port itself when it has none"
+    if (names is None):
+        names = stable_port_names()
+    return names.get(os.path.realpath(port), port)
+
+def load_identities(path=DEFAULT_IDENTITY_CACHE):
+    "Read the identity cache.  Returns {port: {\"serial\", \"name\", \"seen\"}}, empty if missing or unreadable"
+    try:
+        with open(path) as cache_file:
+            contents = json.load(cache_file)
+    except (IOError, ValueError):
+        return {}
+    if (not isinstance(contents, dict) or contents.get("version") != IDENTITY_CACHE_VERSION):
+        return {}
+    return contents.get("ports", {})
+
+def save_identities(identities, path=DEFAULT_IDENTITY_CACHE):
+    "Write the identity cache, replacing the old file in one step"
+    directory = os.path.dirname(path)
+    if (directory != "" and not os.path.isdir(directory)):
+        os.makedirs(directory)
+    temporary = path + ".tmp"
+    with open(temporary, "w") as cache_file:
+        json.dump({ "version": IDENTITY_CACHE_VERSION, "ports": identities }, cache_file, indent=2, sort_keys=True)
+        cache_file.write("\n")
+    os.rename(temporary, path)
+
+def identify_operation(session):
+    "A fleet operation that reads the monitor's name; run_on_monitor has already read its serial"
+    name = session.get_value("monitorname")
+    if (name is None):
+        raise IOError("No response to get monitorname")
+    return [name.strip("\0 ")]
+
+def probe_ports(ports, timeout=PROBE_TIMEOUT, workers=p4317q_fleet.DEFAULT_WORKERS, known=None):
+    "Probe ports in parallel.  Returns {stable port: identity} for every port a monitor answered on, and for ports another process holds that are in known"
+    names = stable_port_names()
+    found = {}
+    for result in p4317q_fleet.run_fleet(ports, identify_operation, workers, timeout, timeout):
+        port = stable_port_name(result.port, names)
+        if (result.ok and result.serial):
+            found[port] = { "serial": result.serial, "name": result.lines[0], "seen": time.time() }
+        elif (result.busy and known is not None and port in known):
+            # In use, e.g. by the daemon: the monitor is taken to still be there
+            found[port] = known[port]
+    return found
+
+def candidate_ports():
+    "Ports to scan, by their stable names, without duplicates"
+    names = stable_port_names()
+    ports = []
+    for port in p4317q_fleet.discover_ports():
+        port = stable_port_name(port, names)
+        if (port not in ports):
+            ports.append(port)
+    return ports
+
+def discover(ports=None, path=DEFAULT_IDENTITY_CACHE, timeout=PROBE_TIMEOUT):
+    "Probe every candidate port and replace the identity cache with what answered, keeping the entries of ports in use"
+    if (ports is None):
+        ports = candidate_ports()
+    identities = probe_ports(ports, timeout, known=load_identities(path))
+    save_identities(identities, path)
+    return identities
+
+def verify_port(port, serial_number, timeout=PROBE_TIMEOUT):
+    "True if the monitor on port has this serial number.  One get, no exceptions"
+    try:
+        with p4317q.MonitorSession(port, timeout=timeout, lock_timeout=timeout) as session:
+            return p4317q_fleet.read_serial_number(session) == serial_number
+    except p4317q.PortBusy:
+        # Whoever holds the port is taken to still be talking to the same monitor
+        return True
+    except Exception:
+        return False
+
+def resolve_monitor(serial_number, path=DEFAULT_IDENTITY_CACHE, timeout=PROBE_TIMEOUT, ports=None):
+    "The port of the monitor with this serial number, or None.  Scans only when the cached port is stale"
+    identities = load_identities(path)
+    for (port, identity) in sorted(identities.items()):
+        if (identity.get("serial") == serial_number):
+            if (verify_port(port, serial_number, timeout)):
+                return port
+            p4317q.print_debug("DEBUG:  " + serial_number + " is no longer on " + port)
+    identities = discover(ports, path, timeout)
+    for (port, identity) in sorted(identities.items()):
+        if (identity["serial"] == serial_number):
+            return port
+    return None
+
+def print_identities(identities):
+    for (port, identity) in sorted(identities.items()):
+        print "%-12s %-10s %s" % (identity["serial"], identity["name"], port)
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--cache file] [--ports port,port,...] [--timeout s] {scan|list|resolve serial}"
+    print ""
+    print "scan    - Probes every serial port and records the monitor found on each"
+    print "list    - Prints the recorded monitors without touching any port"
+    print "resolve - Prints the port of one monitor, checking the recorded port first"
+    print ""
+    print " --cache    identity cache file (default " + DEFAULT_IDENTITY_CACHE + ")"
+    print " --ports    probe these ports instead of every serial port on the machine"
+    print " --timeout  seconds to wait for each probe (default " + str(PROBE_TIMEOUT) + ")"
+
+def main(args):
+    path = p4317q.take_option(args, "--cache", DEFAULT_IDENTITY_CACHE)
+    port_list = p4317q.take_option(args, "--ports", None)
+    timeout = float(p4317q.take_option(args, "--timeout", PROBE_TIMEOUT))
+    ports = None
+    if (port_list is not None):
+        ports = [port for port in port_list.split(",") if port != ""]
+    if (len(args) < 1):
+        print_usage()
+        return 1
+
+    if (args[0] == "scan"):
+        identities = discover(ports, path, timeout)
+        print_identities(identities)
+        return 0 if len(identities) > 0 else 1
+    if (args[0] == "list"):
+        print_identities(load_identities(path))
+        return 0
+    if (args[0] == "resolve" and len(args) == 2):
+        port = resolve_monitor(args[1], path, timeout, ports)
+        if (port is None):
+            print "ERROR:  No monitor with serial number " + args[1]
+            return 1
+        print port
+        return 0
+    print_usage()
+    return 1
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
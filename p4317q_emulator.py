@@ -0,0 +1,309 @@
+#!/usr/bin/python
+
+# Software emulator of the Dell P4317Q RS232 protocol.
+#
+# The emulator exposes a pseudo-terminal that behaves like the monitor's
+# serial port: it parses 0x37 0x51 command frames, checks their checksum,
+# keeps state for every get/set/reset command and answers gets with
+# 0x6F 0x37 response frames.  Only get commands get a response.
+#
+# Line timing and faults can be injected to exercise the host side:
+#   byte_time     - seconds per byte on the wire (10 bits per byte at 8N1)
+#   noise         - probability of a garbage byte ahead of a reply
+#   drop          - probability of losing each byte of a reply
+#   bad_checksum  - probability of a reply with a corrupted checksum
+
+import os
+import pty
+import sys
+import tty
+import time
+import errno
+import struct
+import random
+import select
+import threading
+
+import dell_p4317q_serial_control_program as p4317q
+
+RSP_RESULT_OK=0x00
+
+# Commands whose first parameter byte selects a slot rather than a value
+INDEXED_COMMANDS = ("pxpsubinput", "customcolor")
+
+def wire_byte_time(baudrate):
+    "Seconds needed to send one 8N1 byte (start + 8 data + stop bits)"
+    return 10.0 / baudrate
+
+EMULATOR_SERIAL="CN0EMU1234"
+
+def default_state(serial_number=EMULATOR_SERIAL):
+    "Power-on state of the emulated monitor, keyed by (command, index)"
+    state = {
+        ("assettag", None):          bytearray(10),
+        ("monitorname", None):       bytearray("P4317Q\0\0\0\0"),
+        ("monitorserial", None):     bytearray(serial_number[:10].ljust(10, "\0")),
+        ("backlighthours", None):    bytearray(struct.pack("<h", 1234)),
+        ("powerstate", None):        bytearray([1]),
+        ("powerled", None):          bytearray([1]),
+        ("powerusb", None):          bytearray([0]),
+        ("brightness", None):        bytearray([75]),
+        ("contrast", None):          bytearray([75]),
+        ("aspectratio", None):       bytearray([p4317q.aspect_ratios["16x9"]]),
+        ("sharpness", None):         bytearray([50]),
+        ("inputcolorformat", None):  bytearray([p4317q.input_color_formats["RGB"]]),
+        ("colorpreset", None):       p4317q.color_presets["standard"][:],
+        ("autoselect", None):        bytearray([1]),
+        ("videoinput", None):        p4317q.pxp_input["hdmi1"][:],
+        ("pxpmode", None):           bytearray([p4317q.pxp_mode["4k"]]),
+        ("pxplocation", None):       bytearray([p4317q.pxp_locations["topRight"]]),
+        ("osdtransparency", None):   bytearray([20]),
+        ("osdlanguage", None):       bytearray([p4317q.osd_language["english"]]),
+        ("osdtimer", None):          bytearray([20]),
+        ("osdbuttonlock", None):     bytearray([0]),
+        ("versionfirmware", None):   bytearray("14"),
+        ("ddcci", None):             bytearray([1]),
+        ("lcdconditioning", None):   bytearray([0]),
+    }
+    # The caps are the OR of every supported value
+    colorcaps = bytearray(4)
+    for value in p4317q.color_presets.values():
+        colorcaps = bytearray([a | b for (a, b) in zip(colorcaps, value)])
+    state[("colorpresetcaps", None)] = colorcaps
+    inputcaps = bytearray(4)
+    for value in p4317q.pxp_input.values():
+        inputcaps = bytearray([a | b for (a, b) in zip(inputcaps, value)])
+    state[("videoinputcaps", None)] = inputcaps
+    for (index, name) in enumerate(["hdmi1", "hdmi2", "dp", "mdp"]):
+        state[("pxpsubinput", index)] = p4317q.pxp_input[name][:]
+    state[("customcolor", 0)] = bytearray([100, 100, 100, 0, 0, 0])
+    return state
+
+# The settings each reset command restores
+RESET_GROUPS = {
+    "power": ("powerstate", "powerled", "powerusb"),
+    "color": ("inputcolorformat", "colorpreset", "customcolor"),
+    "osd":   ("osdtransparency", "osdlanguage", "osdtimer", "osdbuttonlock"),
+    "factory": None
+}
+
+# Settings a factory reset leaves alone
+FACTORY_PRESERVED = ("assettag", "monitorname", "monitorserial", "backlighthours", "colorpresetcaps", "videoinputcaps", "versionfirmware")
+
+def command_names(actions):
+    "Map command tags back to command names for one of the ACTIONS tables"
+    names = {}
+    for (name, tag) in actions.items():
+        if (not name.endswith("_len") and not name.endswith("_resplen")):
+            names[tag] = name
+    return names
+
+class P4317QEmulator(object):
+    "An emulated P4317Q behind a pseudo-terminal"
+
+    def __init__(self, byte_time=0.0, response_delay=0.0, noise=0.0, drop=0.0, bad_checksum=0.0, seed=None, serial_number=EMULATOR_SERIAL):
+        self.byte_time = byte_time
+        self.response_delay = response_delay
+        self.noise = noise
+        self.drop = drop
+        self.bad_checksum = bad_checksum
+        self.random = random.Random(seed)
+        self.serial_number = serial_number
+        self.state = default_state(serial_number)
+        self.lock = threading.Lock()
+        self.names = { p4317q.CMD_READ: command_names(p4317q.GET_ACTIONS),
+                       p4317q.CMD_WRITE: command_names(p4317q.SET_ACTIONS) }
+        self.reset_names = command_names(p4317q.RESET_ACTIONS)
+        self.frames = 0
+        self.checksum_errors = 0
+        self.unknown_commands = 0
+        self.master = None
+        self.slave = None
+        self.port_name = None
+        # When the frame now being received has fully arrived
+        self.received_at = 0.0
+        self.thread = None
+        self.running = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        "Create the pseudo-terminal and start answering commands"
+        (self.master, self.slave) = pty.openpty()
+        tty.setraw(self.slave)
+        self.port_name = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="p4317q-emulator")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if (self.thread is not None):
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if (fd is not None):
+                os.close(fd)
+        self.master = None
+        self.slave = None
+
+    def get_value(self, command, index=None):
+        "Current raw value of a setting"
+        with self.lock:
+            return self.state[(command, index)][:]
+
+    def set_value(self, command, value, index=None):
+        "Change a setting, as if from the monitor's own buttons"
+        with self.lock:
+            self.state[(command, index)] = bytearray(value)
+
+    def run(self):
+        buf = bytearray()
+        while self.running:
+            (readable, _, _) = select.select([self.master], [], [], 0.05)
+            if (not readable):
+                continue
+            try:
+                buf += os.read(self.master, 256)
+                read_at = time.time()
+            except OSError as error:
+                if (error.errno == errno.EIO):
+                    # No process has the slave side open right now
+                    time.sleep(0.01)
+                    continue
+                raise
+            while True:
+                frame = self.take_frame(buf)
+                if (frame is None):
+                    break
+                # The line receives while the monitor is busy replying, so a
+                # frame that came in meanwhile has already (partly) arrived
+                self.received_at = max(self.received_at, read_at) + len(frame) * self.byte_time
+                self.handle_frame(frame)
+
+    def take_frame(self, buf):
+        "Remove and return the next complete command frame in buf, skipping garbage"
+        while len(buf) >= 2 and (buf[0] != p4317q.CMD_HEADER[0] or buf[1] != p4317q.CMD_HEADER[1]):
+            del buf[0]
+        if (len(buf) < 3):
+            return None
+        frame_len = buf[2] + 4
+        if (len(buf) < frame_len):
+            return None
+        frame = buf[:frame_len]
+        del buf[:frame_len]
+        return frame
+
+    def handle_frame(self, frame):
+        self.frames += 1
+        # Wait for the command to finish arriving over the wire
+        time.sleep(max(0, self.received_at - time.time()))
+
+        cmd_len = frame[2]
+        if (p4317q.p4317q_checksum(frame, 0, cmd_len+3) != frame[-1]):
+            self.checksum_errors += 1
+            return
+        action = frame[3]
+        tag = frame[4]
+        params = frame[5:-1]
+
+        # Resets go out with the read action code, but have their own tags
+        if (tag in self.reset_names):
+            self.handle_reset(self.reset_names[tag])
+        elif (action == p4317q.CMD_READ and tag in self.names[action]):
+            self.handle_get(self.names[action][tag], tag, params)
+        elif (action == p4317q.CMD_WRITE and tag in self.names[action]):
+            self.handle_set(self.names[action][tag], params)
+        else:
+            self.unknown_commands += 1
+
+    def handle_get(self, command, tag, params):
+        index = None
+        if (command in INDEXED_COMMANDS):
+            index = params[0] if len(params) > 0 else 0
+        data_len = p4317q.GET_ACTIONS[command + "_resplen"] - 3
+        with self.lock:
+            value = self.state.get((command, index), bytearray())
+        data = (value + bytearray(data_len))[:data_len]
+        self.send_reply(bytearray([p4317q.RSP_REPLY_CODE, RSP_RESULT_OK, tag]) + data)
+
+    def handle_set(self, command, params):
+        with self.lock:
+            if (command in INDEXED_COMMANDS):
+                self.state[(command, params[0])] = bytearray(params[1:])
+            else:
+                self.state[(command, None)] = bytearray(params)
+
+    def handle_reset(self, group):
+        defaults = default_state(self.serial_number)
+        with self.lock:
+            for key in defaults:
+                if (RESET_GROUPS[group] is None):
+                    if (key[0] not in FACTORY_PRESERVED):
+                        self.state[key] = defaults[key]
+                elif (key[0] in RESET_GROUPS[group]):
+                    self.state[key] = defaults[key]
+
+    def send_reply(self, payload):
+        reply = p4317q.RSP_HEADER + bytearray([len(payload)]) + payload
+        checksum = p4317q.p4317q_checksum(reply, 0, len(reply))
+        if (self.random.random() < self.bad_checksum):
+            checksum ^= 0xFF
+        reply.append(checksum)
+        if (self.random.random() < self.noise):
+            reply.insert(0, self.random.randint(0, 255))
+        if (self.drop > 0):
+            reply = bytearray([b for b in reply if self.random.random() >= self.drop])
+
+        time.sleep(self.response_delay)
+        if (self.byte_time > 0):
+            for b in reply:
+                os.write(self.master, bytes(bytearray([b])))
+                time.sleep(self.byte_time)
+        else:
+            os.write(self.master, bytes(reply))
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--baudrate rate] [--delay seconds] [--noise p] [--drop p] [--bad-checksum p] [--seed n] [--serial sn]"
+    print ""
+    print "Runs an emulated P4317Q and prints the pseudo-terminal to use as its port."
+    print " --baudrate      paces bytes at this line rate (default: no line delay)"
+    print " --delay         monitor processing time before each reply"
+    print " --noise         probability of a garbage byte before each reply"
+    print " --drop          probability of dropping each reply byte"
+    print " --bad-checksum  probability of corrupting each reply checksum"
+    print " --serial        monitor serial number to report (10 characters)"
+
+if (__name__ == "__main__"):
+    args = sys.argv[1:]
+    if ("-h" in args or "--help" in args):
+        print_usage()
+        exit()
+    baudrate = p4317q.take_option(args, "--baudrate", None)
+    seed = p4317q.take_option(args, "--seed", None)
+    emulator = P4317QEmulator(byte_time=wire_byte_time(int(baudrate)) if baudrate else 0.0,
+                              response_delay=float(p4317q.take_option(args, "--delay", 0.0)),
+                              noise=float(p4317q.take_option(args, "--noise", 0.0)),
+                              drop=float(p4317q.take_option(args, "--drop", 0.0)),
+                              bad_checksum=float(p4317q.take_option(args, "--bad-checksum", 0.0)),
+                              seed=int(seed) if seed else None,
+                              serial_number=p4317q.take_option(args, "--serial", EMULATOR_SERIAL))
+    if (len(args) > 0):
+        print_usage()
+        exit()
+    with emulator:
+        print emulator.port_name
+        sys.stdout.flush()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,369 @@
+#!/usr/bin/python
+
+# Telemetry poller and Prometheus exporter for P4317Q monitors.
+#
+# Every port gets a poller thread that reads a few settings on its own
+# schedule.  Each setting starts at its shortest interval and backs off
+# towards its longest one for as long as its value does not change; a
+# change drops it back to the shortest.  Polls are also held to a budget:
+# the share of the 9600 baud line they may use, worked out from the frame
+# and reply lengths in GET_ACTIONS.
+#
+# Pollers do not keep ports to themselves.  When p4317q_daemon.py holds a
+# port, its polls go through the daemon as background requests, which run
+# after anything interactive.  Otherwise each poll opens the port, takes
+# its lock and lets go of both again, so other tools wait at most one poll.
+#
+# The latest values, poll latency histograms and error counts are served
+# in the Prometheus text format on a local HTTP port.
+
+import sys
+import time
+import socket
+import threading
+import BaseHTTPServer
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_fleet
+import p4317q_daemon
+
+DEFAULT_LISTEN="127.0.0.1:9417"
+# Share of the serial line polling may use
+DEFAULT_BUDGET=0.25
+# Seconds of budget that may be saved up and spent at once
+BUDGET_BURST=2.0
+BACKOFF_FACTOR=2.0
+
+# setting: (shortest interval, longest interval) in seconds
+METRIC_INTERVALS = {
+    "backlighthours": (60.0, 3600.0),
+    "powerstate":     (1.0, 30.0),
+    "videoinput":     (2.0, 60.0),
+    "pxpmode":        (2.0, 60.0),
+    "brightness":     (2.0, 60.0)
+}
+DEFAULT_METRICS = ["backlighthours", "powerstate", "videoinput", "pxpmode", "brightness"]
+# Settings that are not one number or named value, or need an index
+UNEXPORTABLE_METRICS = ("assettag", "monitorname", "monitorserial", "versionfirmware", "colorpresetcaps", "videoinputcaps",
+                        "customcolor", "pxpsubinput")
+
+# Upper bounds of the poll latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def poll_cost(command, baudrate=p4317q.DEFAULT_BAUDRATE):
+    "Seconds of line time one get of command takes: the frame out and the reply back"
+    frame_length = p4317q.GET_ACTIONS[command + "_len"] + 4
+    reply_length = p4317q.GET_ACTIONS[command + "_resplen"] + 4
+    return p4317q.p4317q_wire_time(frame_length + reply_length, baudrate)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels):
+    return "{" + ",".join(["%s=\"%s\"" % (name, escape_label(value)) for (name, value) in labels]) + "}"
+
+class MetricsRegistry(object):
+    "What the pollers have seen, rendered in the Prometheus text format"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (port, setting) -> values
+        self.values = {}
+        self.names = {}
+        self.intervals = {}
+        self.polls = {}
+        self.errors = {}
+        self.changes = {}
+        self.latency = {}
+        # port -> (serial number, line seconds used, seconds running)
+        self.ports = {}
+
+    def set_port(self, port, serial_number, used, elapsed):
+        with self.lock:
+            self.ports[port] = (serial_number, used, elapsed)
+
+    def observe(self, port, setting, seconds, interval, error=None, value=None, name=None, changed=False):
+        "Record one poll"
+        key = (port, setting)
+        with self.lock:
+            self.polls[key] = self.polls.get(key, 0) + 1
+            self.intervals[key] = interval
+            (counts, total) = self.latency.get(key, ([0] * (len(LATENCY_BUCKETS) + 1), 0.0))
+            for (index, bound) in enumerate(LATENCY_BUCKETS + (float("inf"),)):
+                if (seconds <= bound):
+                    counts[index] += 1
+            self.latency[key] = (counts, total + seconds)
+            if (error is not None):
+                self.errors[(port, setting, error)] = self.errors.get((port, setting, error), 0) + 1
+                return
+            self.values[key] = value
+            if (name is not None):
+                self.names[key] = name
+            if (changed):
+                self.changes[key] = self.changes.get(key, 0) + 1
+
+    def labels(self, port, setting=None):
+        labels = [("port", port), ("serial", self.ports.get(port, (None,))[0] or "")]
+        if (setting is not None):
+            labels.append(("setting", setting))
+        return labels
+
+    def render(self):
+        "The current metrics as Prometheus text exposition"
+        lines = []
+        with self.lock:
+            lines.append("# HELP p4317q_setting Latest value of a monitor setting (the raw code for named values)")
+            lines.append("# TYPE p4317q_setting gauge")
+            for ((port, setting), value) in sorted(self.values.items()):
+                lines.append("p4317q_setting%s %s" % (format_labels(self.labels(port, setting)), value))
+            lines.append("# HELP p4317q_setting_info Name of the current value of a named setting")
+            lines.append("# TYPE p4317q_setting_info gauge")
+            for ((port, setting), name) in sorted(self.names.items()):
+                lines.append("p4317q_setting_info%s 1" % format_labels(self.labels(port, setting) + [("value", name)]))
+            lines.append("# HELP p4317q_setting_changes_total Changes seen between polls")
+            lines.append("# TYPE p4317q_setting_changes_total counter")
+            for ((port, setting), count) in sorted(self.changes.items()):
+                lines.append("p4317q_setting_changes_total%s %d" % (format_labels(self.labels(port, setting)), count))
+            lines.append("# HELP p4317q_poll_interval_seconds Current polling interval of a setting")
+            lines.append("# TYPE p4317q_poll_interval_seconds gauge")
+            for ((port, setting), interval) in sorted(self.intervals.items()):
+                lines.append("p4317q_poll_interval_seconds%s %g" % (format_labels(self.labels(port, setting)), interval))
+            lines.append("# HELP p4317q_polls_total Polls made")
+            lines.append("# TYPE p4317q_polls_total counter")
+            for ((port, setting), count) in sorted(self.polls.items()):
+                lines.append("p4317q_polls_total%s %d" % (format_labels(self.labels(port, setting)), count))
+            lines.append("# HELP p4317q_poll_errors_total Polls that failed, by kind")
+            lines.append("# TYPE p4317q_poll_errors_total counter")
+            for ((port, setting, error), count) in sorted(self.errors.items()):
+                lines.append("p4317q_poll_errors_total%s %d" % (format_labels(self.labels(port, setting) + [("error", error)]), count))
+            lines.append("# HELP p4317q_poll_duration_seconds Time from sending a get to its reply")
+            lines.append("# TYPE p4317q_poll_duration_seconds histogram")
+            for ((port, setting), (counts, total)) in sorted(self.latency.items()):
+                labels = self.labels(port, setting)
+                for (bound, count) in zip(LATENCY_BUCKETS + (float("inf"),), counts):
+                    le = "+Inf" if bound == float("inf") else "%g" % bound
+                    lines.append("p4317q_poll_duration_seconds_bucket%s %d" % (format_labels(labels + [("le", le)]), count))
+                lines.append("p4317q_poll_duration_seconds_sum%s %f" % (format_labels(labels), total))
+                lines.append("p4317q_poll_duration_seconds_count%s %d" % (format_labels(labels), counts[-1]))
+            lines.append("# HELP p4317q_serial_utilization Share of the serial line used by polling")
+            lines.append("# TYPE p4317q_serial_utilization gauge")
+            for (port, (serial_number, used, elapsed)) in sorted(self.ports.items()):
+                lines.append("p4317q_serial_utilization%s %f" % (format_labels(self.labels(port)), used / elapsed if elapsed > 0 else 0.0))
+        return "\n".join(lines) + "\n"
+
+class MetricSchedule(object):
+    "When one setting is polled next, and the interval it has backed off to"
+
+    def __init__(self, setting, baudrate):
+        self.setting = setting
+        (self.shortest, self.longest) = METRIC_INTERVALS.get(setting, (p4317q.DEFAULT_CACHE_TTL, 60.0))
+        self.interval = self.shortest
+        self.due = 0.0
+        self.last = None
+        self.cost = poll_cost(setting, baudrate)
+
+    def update(self, value, now):
+        "Plan the next poll after reading value.  Returns True if the value changed"
+        changed = (self.last is not None and value != self.last)
+        if (changed):
+            self.interval = self.shortest
+        elif (self.last is not None):
+            self.interval = min(self.longest, self.interval * BACKOFF_FACTOR)
+        self.last = value
+        self.due = now + self.interval
+        return changed
+
+    def failed(self, now):
+        "Plan the next poll after a failed one"
+        self.interval = min(self.longest, self.interval * BACKOFF_FACTOR)
+        self.due = now + self.interval
+
+class PortPoller(object):
+    "Polls the settings of the monitor on one port, within its share of the line"
+
+    def __init__(self, port, registry, metrics=DEFAULT_METRICS, budget=DEFAULT_BUDGET, timeout=p4317q.DEFAULT_RESPONSE_TIMEOUT):
+        # Not waiting longer for the port than for a reply
+        self.session = p4317q.MonitorSession(port, timeout=timeout, lock_timeout=timeout)
+        # Connection to the daemon holding the port, if one does
+        self.client = None
+        self.registry = registry
+        self.schedules = [MetricSchedule(setting, self.session.baudrate) for setting in metrics]
+        self.budget = budget
+        self.tokens = budget * BUDGET_BURST
+        self.refilled = time.time()
+        self.started = self.refilled
+        self.used = 0.0
+        self.serial_number = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="p4317q-poller-" + port)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.session.close()
+        if (self.client is not None):
+            self.client.close()
+
+    def budget_wait(self, cost, now):
+        "Seconds until the budget allows a poll costing cost seconds of line time"
+        self.tokens = min(max(cost, self.budget * BUDGET_BURST), self.tokens + (now - self.refilled) * self.budget)
+        self.refilled = now
+        if (self.tokens >= cost):
+            return 0.0
+        return (cost - self.tokens) / self.budget
+
+    def run(self):
+        while (not self.stopped.is_set()):
+            schedule = min(self.schedules, key=lambda schedule: schedule.due)
+            now = time.time()
+            wait = max(schedule.due - now, self.budget_wait(schedule.cost, now))
+            if (wait > 0):
+                self.stopped.wait(wait)
+                continue
+            self.tokens -= schedule.cost
+            self.used += schedule.cost
+            self.poll(schedule)
+            self.registry.set_port(self.session.port_name, self.serial_number, self.used, time.time() - self.started)
+
+    def daemon_get(self, socket_path, command):
+        "Get command through the daemon at socket_path as a background request.  Returns the payload, or None if the monitor did not answer"
+        if (self.client is None or self.client.socket_path != socket_path):
+            if (self.client is not None):
+                self.client.close()
+            self.client = p4317q_daemon.DaemonClient(socket_path)
+        try:
+            record = self.client.call("get", [command], "background")
+        except p4317q_daemon.RPCError:
+            return None
+        except socket.error:
+            self.client.close()
+            raise
+        return bytearray(record["value"])
+
+    def get(self, commands):
+        "The payloads (or None) of gets of commands, through the daemon if it holds the port"
+        owner = p4317q.p4317q_port_owner(self.session.port_name)
+        if (owner is not None and owner[1] is not None):
+            try:
+                return [self.daemon_get(owner[1], command) for command in commands]
+            except socket.error:
+                # The daemon went away; try the port itself
+                pass
+        with self.session:
+            return [self.session.get(command) for command in commands]
+
+    def poll(self, schedule):
+        setting = schedule.setting
+        start = time.time()
+        try:
+            commands = [setting] if self.serial_number is not None else ["monitorserial", setting]
+            payloads = self.get(commands)
+            if (self.serial_number is None and payloads[0] is not None):
+                self.serial_number = p4317q.COMMANDS["get"]["monitorserial"].decode(payloads[0], 0, len(payloads[0])).strip("\0 ")
+            payload = payloads[-1]
+            error = None if payload is not None else "timeout"
+            if (payload is not None):
+                value = p4317q.COMMANDS["get"][setting].decode(payload, 0, len(payload))
+                name = None
+                if (isinstance(value, basestring)):
+                    # A named value; export its raw code and the name separately
+                    (name, value) = (value, payload[0])
+                value = int(value)
+        except Exception as exception:
+            error = exception.__class__.__name__
+        now = time.time()
+        if (error is not None):
+            schedule.failed(now)
+            self.registry.observe(self.session.port_name, setting, now - start, schedule.interval, error=error)
+            return
+        changed = schedule.update(value, now)
+        self.registry.observe(self.session.port_name, setting, now - start, schedule.interval, value=value, name=name, changed=changed)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if (self.path != "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        p4317q.print_debug("DEBUG:  " + (format % args))
+
+def serve(ports, listen=DEFAULT_LISTEN, metrics=DEFAULT_METRICS, budget=DEFAULT_BUDGET, timeout=p4317q.DEFAULT_RESPONSE_TIMEOUT):
+    "Poll every port and serve /metrics until interrupted"
+    (host, port_number) = listen.rsplit(":", 1)
+    registry = MetricsRegistry()
+    pollers = [PortPoller(port, registry, metrics, budget, timeout) for port in ports]
+    server = BaseHTTPServer.HTTPServer((host, int(port_number)), MetricsHandler)
+    server.registry = registry
+    for poller in pollers:
+        poller.start()
+    print "Serving metrics for " + ", ".join(ports) + " on http://" + listen + "/metrics"
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    for poller in pollers:
+        poller.stop()
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " {--inventory file | --ports port,port,... | --discover} [--listen host:port] [--budget share] [--metrics setting,...] [--timeout s]"
+    print ""
+    print "Polls the monitors and serves their settings, poll latencies and errors"
+    print "in the Prometheus text format on http://host:port/metrics."
+    print " --listen   address to serve on (default " + DEFAULT_LISTEN + ")"
+    print " --budget   share of each serial line polling may use (default " + str(DEFAULT_BUDGET) + ")"
+    print " --metrics  get commands to poll (default " + ",".join(DEFAULT_METRICS) + ")"
+    print ""
+    print "When p4317q_daemon.py holds a port, polls go through it as background"
+    print "requests.  Otherwise each poll opens the port and closes it again."
+
+def main(args):
+    inventory = p4317q.take_option(args, "--inventory", None)
+    port_list = p4317q.take_option(args, "--ports", None)
+    discover = p4317q.take_flag(args, "--discover")
+    listen = p4317q.take_option(args, "--listen", DEFAULT_LISTEN)
+    budget = float(p4317q.take_option(args, "--budget", DEFAULT_BUDGET))
+    metrics = p4317q.take_option(args, "--metrics", ",".join(DEFAULT_METRICS)).split(",")
+    timeout = float(p4317q.take_option(args, "--timeout", p4317q.DEFAULT_RESPONSE_TIMEOUT))
+    if (len(args) > 0 or budget <= 0):
+        print_usage()
+        return 1
+    for setting in metrics:
+        if (setting not in p4317q.COMMANDS["get"]):
+            print "ERROR:  Invalid command specified: " + setting
+            return 1
+        if (setting in UNEXPORTABLE_METRICS):
+            print "ERROR:  " + setting + " is not a single number or named value and cannot be exported"
+            return 1
+
+    if (inventory is not None):
+        with open(inventory) as inventory_file:
+            ports = p4317q_fleet.read_inventory(inventory_file)
+    elif (port_list is not None):
+        ports = [port for port in port_list.split(",") if port != ""]
+    elif (discover):
+        ports = p4317q_fleet.discover_ports()
+    else:
+        print "ERROR:  No monitors given; use --inventory, --ports or --discover"
+        return 1
+    if (len(ports) == 0):
+        print "ERROR:  No ports found"
+        return 1
+
+    serve(ports, listen, metrics, budget, timeout)
+    return 0
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
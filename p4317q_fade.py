@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+# Gradual transitions of brightness, contrast and customcolor.
+#
+# A fade writes a setting step by step over one session, from its current
+# value to a target, each step at a fixed point in time so the change is
+# even.  It takes as many steps as the value can change by, up to as many as
+# the line and the monitor can keep up with: a set frame's wire time plus
+# FADE_MONITOR_TIME per step.  Steps that fall too far behind are skipped
+# rather than sent back to back.
+#
+# A Fader runs fades in the background.  Giving it a new target while a fade
+# is running stops that fade after the step it is on and fades on from the
+# last value written, e.g.
+#
+#   fader = Fader(session)
+#   fader.fade_to("brightness", 80, 3.0)
+#   ...
+#   fader.fade_to("brightness", 20, 1.0)
+#
+# p4317q_daemon.py runs fades through a Fader of its own, so a fade handed
+# to it replaces the one it is running.
+
+import sys
+import time
+import threading
+
+import dell_p4317q_serial_control_program as p4317q
+
+FADE_COMMANDS = ("brightness", "contrast", "customcolor")
+DEFAULT_FADE_DURATION=1.0
+# Allowance for the monitor to act on each set.  Sets are not answered, so
+# there is nothing to measure it by.
+FADE_MONITOR_TIME=0.01
+
+def parse_duration(text):
+    "Seconds from 3, 3s, 1.5s or 500ms"
+    if (text.endswith("ms")):
+        return float(text[:-2]) / 1000
+    if (text.endswith("s")):
+        return float(text[:-1])
+    return float(text)
+
+def fade_target(command, text):
+    "The values to fade to, from the set parameter text.  None (after printing why) if it is not valid"
+    parsed = p4317q.p4317q_parse_command(["set", command, text])
+    if (parsed is None):
+        return None
+    value = p4317q.p4317q_set_value(command, parsed[2])
+    return list(value) if isinstance(value, bytearray) else [value]
+
+def fade_param(command, values):
+    "The set param that writes values"
+    if (command == "customcolor"):
+        return bytearray([0] + list(values) + [0, 0, 0])
+    return values[0]
+
+def read_values(session, command):
+    "The current values of command, or None if the monitor does not answer"
+    value = session.get_value(command, 0 if command == "customcolor" else None)
+    if (value is None):
+        return None
+    return list(value) if isinstance(value, tuple) else [value]
+
+def step_interval(command, baudrate=p4317q.DEFAULT_BAUDRATE):
+    "Shortest time between two steps: the set frame on the wire plus the monitor's allowance"
+    return p4317q.p4317q_wire_time(p4317q.SET_ACTIONS[command + "_len"] + 4, baudrate) + FADE_MONITOR_TIME
+
+def fade_steps(command, start, target, duration, baudrate=p4317q.DEFAULT_BAUDRATE):
+    "Number of steps for a fade: one per unit of change, at most as many as fit in duration"
+    distance = max([abs(b - a) for (a, b) in zip(start, target)])
+    if (distance == 0):
+        return 0
+    return max(1, min(distance, int(duration / step_interval(command, baudrate))))
+
+class Fade(object):
+    "One transition of a setting from start to target over duration seconds"
+
+    def __init__(self, session, command, target, duration, start=None):
+        self.session = session
+        self.command = command
+        self.target = list(target)
+        self.duration = duration
+        if (start is None):
+            start = read_values(session, command)
+            if (start is None):
+                raise IOError("No response to get " + command)
+        self.start = list(start)
+        self.steps = fade_steps(command, self.start, self.target, duration, session.baudrate)
+        self.interval = duration / self.steps if self.steps > 0 else 0
+        # Last values written, which is where a fade that replaces this one starts
+        self.written = list(self.start)
+        self.sent = 0
+        self.skipped = 0
+        self.stopped = threading.Event()
+
+    def values(self, step):
+        "The values at step (of steps)"
+        return [int(round(a + (b - a) * float(step) / self.steps)) for (a, b) in zip(self.start, self.target)]
+
+    def run(self):
+        "Write every step on time.  Returns True if the fade reached its target, False if it was cancelled"
+        began = time.time()
+        for step in range(1, self.steps + 1):
+            wait = began + step * self.interval - time.time()
+            if (wait > 0 and self.stopped.wait(wait)):
+                return False
+            if (self.stopped.is_set()):
+                return False
+            # Behind by more than a step: leave this one out and catch up
+            if (step < self.steps and time.time() > began + (step + 1) * self.interval):
+                self.skipped += 1
+                continue
+            values = self.values(step)
+            if (values == self.written):
+                continue
+            self.session.set(self.command, fade_param(self.command, values))
+            self.written = values
+            self.sent += 1
+        return True
+
+    def cancel(self):
+        "Stop after the step being written, if any"
+        self.stopped.set()
+
+class Fader(object):
+    "Runs one fade at a time on a session in the background.  A new target replaces the fade in progress"
+
+    def __init__(self, session):
+        self.session = session
+        self.fade = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def fade_to(self, command, target, duration=DEFAULT_FADE_DURATION):
+        "Start fading command to target (a list of values).  Returns the Fade"
+        with self.lock:
+            start = None
+            if (self.fade is not None):
+                self.fade.cancel()
+                self.thread.join()
+                if (self.fade.command == command):
+                    start = self.fade.written
+            self.fade = Fade(self.session, command, target, duration, start)
+            self.thread = threading.Thread(target=self.fade.run)
+            self.thread.daemon = True
+            self.thread.start()
+            return self.fade
+
+    def wait(self):
+        "Wait for the current fade to end"
+        thread = self.thread
+        if (thread is not None):
+            thread.join()
+
+    def cancel(self):
+        with self.lock:
+            if (self.fade is not None):
+                self.fade.cancel()
+                self.thread.join()
+
+def parse_fade(args):
+    "(command, target values, duration) from fade arguments {brightness|contrast|customcolor} target [--over duration].  None (after printing why) if they are not valid"
+    args = list(args)
+    try:
+        duration = parse_duration(p4317q.take_option(args, "--over", str(DEFAULT_FADE_DURATION)))
+    except ValueError:
+        duration = -1
+    if (len(args) != 2 or args[0] not in FADE_COMMANDS or duration < 0):
+        print "ERROR:  Usage: fade {" + "|".join(FADE_COMMANDS) + "} target [--over duration]"
+        return None
+    (command, text) = args
+    target = fade_target(command, text)
+    if (target is None):
+        return None
+    return (command, target, duration)
+
+def show_values(values):
+    return ":".join([str(value) for value in values])
+
+def describe_fade(command, start, target, duration, steps, interval):
+    "The line printed when a fade starts"
+    return "%s %s -> %s over %.2f s, %d steps of %.1f ms" % (command, show_values(start), show_values(target), duration, steps, interval * 1000)
+
+def run_fade(args, session):
+    "The fade command: {brightness|contrast|customcolor} target [--over duration].  Returns the exit status"
+    parsed = parse_fade(args)
+    if (parsed is None):
+        return 1
+    (command, target, duration) = parsed
+    try:
+        fade = Fade(session, command, target, duration)
+    except IOError as error:
+        print "ERROR:  " + str(error)
+        return 1
+    print describe_fade(command, fade.start, fade.target, duration, fade.steps, fade.interval)
+    try:
+        fade.run()
+    except KeyboardInterrupt:
+        fade.cancel()
+        print "Cancelled at " + show_values(fade.written)
+        return 1
+    if (fade.skipped > 0):
+        print "%d steps skipped to keep time" % fade.skipped
+    return 0
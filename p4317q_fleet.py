@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+# Fleet control for many P4317Q monitors, each on its own serial port.
+#
+# Every port gets its own MonitorSession and a bounded pool of worker
+# threads works through the ports concurrently, so a fleet-wide dump takes
+# about as long as the slowest monitor rather than the sum of all of them.
+# Results are reported per monitor, keyed by its serial number, and a
+# failing monitor does not affect the others.
+
+import sys
+import time
+import glob
+import threading
+import Queue
+
+import dell_p4317q_serial_control_program as p4317q
+
+DEFAULT_WORKERS=8
+
+# Where to look for ports when no inventory is given
+DISCOVERY_PATTERNS = ["/dev/serial/by-id/*", "/dev/ttyUSB*", "/dev/ttyACM*"]
+
+class FleetResult(object):
+    "What happened on one monitor"
+
+    def __init__(self, port):
+        self.port = port
+        self.serial = None
+        self.ok = False
+        # Another process held the port throughout
+        self.busy = False
+        self.error = None
+        self.elapsed = 0.0
+        self.lines = []
+
+    def key(self):
+        "The serial number, or the port if the monitor never answered"
+        return self.serial if self.serial else self.port
+
+def read_inventory(lines):
+    "Ports listed one per line.  Blank lines and # comments are skipped"
+    ports = []
+    for line in lines:
+        line = line.strip()
+        if (line != "" and not line.startswith("#")):
+            ports.append(line)
+    return ports
+
+def discover_ports():
+    "Candidate monitor ports on this machine"
+    try:
+        from serial.tools import list_ports
+        ports = sorted([port.device for port in list_ports.comports()])
+        if (len(ports) > 0):
+            return ports
+    except ImportError:
+        pass
+    ports = []
+    for pattern in DISCOVERY_PATTERNS:
+        ports.extend(sorted(glob.glob(pattern)))
+    return ports
+
+def read_serial_number(session):
+    "The monitor's serial number, or None if it did not answer"
+    value = session.get_value("monitorserial")
+    if (value is None):
+        return None
+    return value.strip("\0 ")
+
+def command_operation(commands):
+    "An operation that runs parsed (action, command, param) tuples and reports each get"
+    def operation(session):
+        lines = []
+        for (action, command, param) in commands:
+            response = session.command(action, command, param)
+            if (action == "get"):
+                if (response is None):
+                    raise IOError("No valid response to get " + command)
+                lines.append(p4317q.format_response_text(command, response, param))
+        return lines
+    return operation
+
+def dump_operation(session):
+    "An operation that reads every setting"
+    lines = []
+    for (command, param) in p4317q.dump_requests():
+        response = session.get(command, param)
+        if (response is None):
+            lines.append(command + ": no response")
+        else:
+            lines.append(p4317q.format_response_text(command, response, param))
+    return lines
+
+def record_operation(commands, writer):
+    "An operation that runs parsed commands and writes a record for each get as soon as its reply arrives"
+    def operation(session):
+        fields = { "port": session.port_name, "serial": read_serial_number(session) }
+        for (action, command, param) in commands:
+            response = session.command(action, command, param)
+            if (action == "get"):
+                record = p4317q.format_response_record(command, response, param)
+                record.update(fields)
+                writer.write(record)
+        return []
+    return operation
+
+def run_on_monitor(port, operation, timeout, lock_timeout=p4317q.PORT_LOCK_TIMEOUT):
+    "Open port, identify the monitor and run operation on it.  Never raises"
+    result = FleetResult(port)
+    start = time.time()
+    try:
+        with p4317q.MonitorSession(port, timeout=timeout, lock_timeout=lock_timeout) as session:
+            result.serial = read_serial_number(session)
+            result.lines = operation(session)
+            result.ok = True
+    except p4317q.PortBusy as error:
+        result.busy = True
+        result.error = str(error)
+    except Exception as error:
+        result.error = str(error) or error.__class__.__name__
+    result.elapsed = time.time() - start
+    return result
+
+def run_fleet(ports, operation, workers=DEFAULT_WORKERS, timeout=p4317q.DEFAULT_RESPONSE_TIMEOUT, lock_timeout=p4317q.PORT_LOCK_TIMEOUT):
+    "Run operation(session) on every port with at most workers at once.  Returns FleetResults sorted by monitor"
+    pending = Queue.Queue()
+    for port in ports:
+        pending.put(port)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                port = pending.get_nowait()
+            except Queue.Empty:
+                return
+            result = run_on_monitor(port, operation, timeout, lock_timeout)
+            with lock:
+                results.append(result)
+
+    threads = [threading.Thread(target=worker, name="p4317q-fleet-" + str(n)) for n in range(min(workers, len(ports)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(results, key=lambda result: result.key())
+
+def results_by_serial(results):
+    "Map monitor serial number (or port, for monitors that did not answer) to its FleetResult"
+    return dict([(result.key(), result) for result in results])
+
+def print_results(results, wall_time):
+    for result in results:
+        if (result.ok):
+            print "== %s (%s) %.1f ms" % (result.key(), result.port, result.elapsed * 1000)
+        else:
+            print "== %s (%s) FAILED after %.1f ms: %s" % (result.key(), result.port, result.elapsed * 1000, result.error)
+        for line in result.lines:
+            print "    " + line
+    failed = len([result for result in results if not result.ok])
+    slowest = max([result.elapsed for result in results] or [0])
+    total = sum([result.elapsed for result in results])
+    print "%d monitors, %d failed, %.1f ms wall, %.1f ms slowest, %.1f ms summed" % (len(results), failed, wall_time * 1000, slowest * 1000, total * 1000)
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " {--inventory file | --ports port,port,... | --discover} [--workers n] [--timeout s] [--format text|json|ndjson] operation"
+    print ""
+    print "operations:"
+    print "    dump"
+    print "    {get|set|reset} {command} [parameter]"
+    print "    batch file      - get/set/reset lines, as for the batch action"
+    print ""
+    print "Runs the operation on every monitor concurrently, one session per port,"
+    print "at most --workers (default " + str(DEFAULT_WORKERS) + ") at a time."
+    print "--format ndjson prints one JSON record per get reply as it arrives,"
+    print "tagged with the monitor's port and serial number, and one record per"
+    print "monitor that failed.  json prints the same records as one list at the end."
+
+def main(args):
+    inventory = p4317q.take_option(args, "--inventory", None)
+    port_list = p4317q.take_option(args, "--ports", None)
+    discover = p4317q.take_flag(args, "--discover")
+    workers = int(p4317q.take_option(args, "--workers", DEFAULT_WORKERS))
+    timeout = float(p4317q.take_option(args, "--timeout", p4317q.DEFAULT_RESPONSE_TIMEOUT))
+    output_format = p4317q.take_option(args, "--format", "text")
+    if (len(args) < 1 or output_format not in p4317q.OUTPUT_FORMATS):
+        print_usage()
+        return 1
+
+    if (inventory is not None):
+        with open(inventory) as inventory_file:
+            ports = read_inventory(inventory_file)
+    elif (port_list is not None):
+        ports = [port for port in port_list.split(",") if port != ""]
+    elif (discover):
+        ports = discover_ports()
+    else:
+        print "ERROR:  No monitors given; use --inventory, --ports or --discover"
+        return 1
+    if (len(ports) == 0):
+        print "ERROR:  No ports found"
+        return 1
+
+    if (args[0] == "dump"):
+        operation = dump_operation
+        commands = [("get", command, param) for (command, param) in p4317q.dump_requests()]
+    elif (args[0] == "batch"):
+        if (len(args) < 2):
+            print_usage()
+            return 1
+        commands = []
+        with open(args[1]) as batch_file:
+            for line in batch_file:
+                line = line.strip()
+                if (line == "" or line.startswith("#")):
+                    continue
+                parsed = p4317q.p4317q_parse_command(line.split())
+                if (parsed is None):
+                    return 1
+                commands.append(parsed)
+        operation = command_operation(commands)
+    else:
+        parsed = p4317q.p4317q_parse_command(args)
+        if (parsed is None):
+            return 1
+        commands = [parsed]
+        operation = command_operation(commands)
+
+    if (output_format != "text"):
+        writer = p4317q.RecordWriter(output_format)
+        results = run_fleet(ports, record_operation(commands, writer), workers, timeout)
+        for result in results:
+            if (not result.ok):
+                writer.write({ "port": result.port, "serial": result.serial, "error": result.error })
+        writer.close()
+        return 0 if all([result.ok for result in results]) else 1
+
+    start = time.time()
+    results = run_fleet(ports, operation, workers, timeout)
+    print_results(results, time.time() - start)
+    return 0 if all([result.ok for result in results]) else 1
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+# Recording and replay of serial sessions.
+#
+# With --record file the control program keeps every byte written to and
+# read from the monitor, with when it happened, and saves them to file.
+# Giving "replay:file" as the port then plays the monitor's side back: each
+# frame written is matched to the next recorded frame that is the same, and
+# the bytes the monitor sent after it become readable at the same offsets
+# they had in the recording.  "replay-fast:file" makes them readable at once.
+# No monitor is needed, so firmware quirks can be reproduced from a
+# recording, e.g.
+#
+#   python p4317q_cli.py --port /dev/ttyUSB0 --record mc104.session dump
+#   python p4317q_cli.py --port replay:mc104.session dump
+#   python p4317q_replay.py bench mc104.session
+#
+# A session file is a header, the port names, then one record per read or
+# write: microseconds since the previous record, port, direction, length and
+# the bytes.
+
+import sys
+import time
+import struct
+import threading
+import collections
+
+import dell_p4317q_serial_control_program as p4317q
+
+SESSION_MAGIC="P4317QSS"
+SESSION_VERSION=1
+
+SESSION_TX=1
+SESSION_RX=2
+
+# magic, version, start time, baudrate, port count
+SESSION_HEADER = struct.Struct("<8sHdIB")
+# microseconds since the previous record, port, direction, length
+SESSION_RECORD = struct.Struct("<IBBB")
+SESSION_CHUNK=255
+
+class SessionEvent(object):
+    "Bytes written (tx) or read (rx) on a port, time in seconds from the start of the recording"
+
+    __slots__ = ("time", "channel", "direction", "data")
+
+    def __init__(self, when, channel, direction, data):
+        self.time = when
+        self.channel = channel
+        self.direction = direction
+        self.data = data
+
+class SessionRecorder(object):
+    "Collects what is written to and read from every port it wraps, and saves it as a session file"
+
+    def __init__(self):
+        self.start = time.time()
+        self.baudrate = p4317q.DEFAULT_BAUDRATE
+        self.channels = []
+        self.events = []
+        self.lock = threading.Lock()
+
+    def wrap(self, port, port_name, baudrate):
+        "Return a port that records through this recorder"
+        with self.lock:
+            if (port_name not in self.channels):
+                self.channels.append(port_name)
+            self.baudrate = baudrate
+            return RecordingPort(port, self, self.channels.index(port_name))
+
+    def add(self, channel, direction, data):
+        if (len(data) == 0):
+            return
+        with self.lock:
+            self.events.append(SessionEvent(time.time() - self.start, channel, direction, bytearray(data)))
+
+    def save(self, path):
+        with self.lock:
+            write_session(path, self.start, self.baudrate, self.channels, self.events)
+
+class RecordingPort(object):
+    "A serial port whose reads and writes are also given to a SessionRecorder"
+
+    def __init__(self, port, recorder, channel):
+        self.port = port
+        self.recorder = recorder
+        self.channel = channel
+
+    def write(self, data):
+        result = self.port.write(data)
+        self.recorder.add(self.channel, SESSION_TX, data)
+        return result
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        self.recorder.add(self.channel, SESSION_RX, data)
+        return data
+
+    @property
+    def in_waiting(self):
+        return self.port.in_waiting
+
+    def close(self):
+        self.port.close()
+
+    def __getattr__(self, name):
+        return getattr(self.port, name)
+
+def write_session(path, start, baudrate, channels, events):
+    with open(path, "wb") as session_file:
+        session_file.write(SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION, start, baudrate, len(channels)))
+        for name in channels:
+            session_file.write(struct.pack("<B", len(name[:255])) + name[:255])
+        previous = 0
+        for event in events:
+            # Reads longer than a record holds are split; the rest follow at once
+            for offset in range(0, len(event.data), SESSION_CHUNK):
+                chunk = event.data[offset:offset + SESSION_CHUNK]
+                delta = int(round((event.time - previous) * 1e6))
+                session_file.write(SESSION_RECORD.pack(max(0, delta), event.channel, event.direction, len(chunk)))
+                session_file.write(chunk)
+                previous += delta / 1e6
+
+def load_session(path):
+    "Read a session file.  Returns (start time, baudrate, port names, events).  Raises ValueError if it is not a session"
+    with open(path, "rb") as session_file:
+        contents = session_file.read()
+    if (len(contents) < SESSION_HEADER.size or contents[:len(SESSION_MAGIC)] != SESSION_MAGIC):
+        raise ValueError(path + " is not a session recording")
+    (magic, version, start, baudrate, channel_count) = SESSION_HEADER.unpack_from(contents, 0)
+    if (version != SESSION_VERSION):
+        raise ValueError(path + " is session version " + str(version) + ", expected " + str(SESSION_VERSION))
+    offset = SESSION_HEADER.size
+    channels = []
+    for index in range(channel_count):
+        length = ord(contents[offset])
+        channels.append(contents[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    events = []
+    now = 0
+    while (offset + SESSION_RECORD.size <= len(contents)):
+        (delta, channel, direction, length) = SESSION_RECORD.unpack_from(contents, offset)
+        offset += SESSION_RECORD.size
+        now += delta / 1e6
+        events.append(SessionEvent(now, channel, direction, bytearray(contents[offset:offset + length])))
+        offset += length
+    return (start, baudrate, channels, events)
+
+class ReplayPort(object):
+    "Plays the monitor's side of a recorded session back to whatever writes to it"
+
+    def __init__(self, path, port_name=None, realtime=True, timeout=p4317q.READ_POLL_INTERVAL):
+        (start, self.baudrate, channels, events) = load_session(path)
+        # The recorded port of that name, or else the first one
+        channel = channels.index(port_name) if port_name in channels else 0
+        self.events = [event for event in events if event.channel == channel]
+        self.realtime = realtime
+        self.timeout = timeout
+        self.position = 0
+        # (when readable, bytes) still to come
+        self.due = collections.deque()
+        self.buffer = bytearray()
+        # Recorded frames skipped over, or frames written with no recorded match
+        self.mismatches = 0
+
+    def write(self, data):
+        "Match a written frame to the recording and schedule the reply that followed it"
+        data = bytearray(data)
+        events = self.events
+        index = self.position
+        while (index < len(events) and not (events[index].direction == SESSION_TX and events[index].data == data)):
+            index += 1
+        if (index == len(events)):
+            # Not in the recording: nothing answers
+            self.mismatches += 1
+            return len(data)
+        self.mismatches += len([event for event in events[self.position:index] if event.direction == SESSION_TX])
+        now = time.time()
+        sent = events[index].time
+        index += 1
+        while (index < len(events) and events[index].direction == SESSION_RX):
+            self.due.append((now + (events[index].time - sent) if self.realtime else now, events[index].data))
+            index += 1
+        self.position = index
+        return len(data)
+
+    def release(self):
+        "Move everything that is due into the read buffer"
+        now = time.time()
+        while (len(self.due) > 0 and self.due[0][0] <= now):
+            self.buffer += self.due.popleft()[1]
+
+    @property
+    def in_waiting(self):
+        self.release()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        "Return up to size bytes, waiting until that many are readable or the timeout passes"
+        deadline = time.time() + self.timeout
+        while True:
+            self.release()
+            now = time.time()
+            if (len(self.buffer) >= size or now >= deadline):
+                break
+            if (len(self.due) > 0):
+                time.sleep(max(0, min(self.due[0][0], deadline) - now))
+            else:
+                time.sleep(deadline - now)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        pass
+
+def open_replay(spec, port_name=None, timeout=p4317q.READ_POLL_INTERVAL):
+    "A ReplayPort for a port given as replay:file or replay-fast:file, or None if spec is neither"
+    if (spec.startswith(p4317q.REPLAY_PREFIX)):
+        return ReplayPort(spec[len(p4317q.REPLAY_PREFIX):], port_name, True, timeout)
+    if (spec.startswith(p4317q.REPLAY_FAST_PREFIX)):
+        return ReplayPort(spec[len(p4317q.REPLAY_FAST_PREFIX):], port_name, False, timeout)
+    return None
+
+def session_summary(channels, events):
+    "Lines describing a recording"
+    lines = []
+    duration = events[-1].time if len(events) > 0 else 0
+    lines.append("%d records over %.3f s" % (len(events), duration))
+    for (channel, name) in enumerate(channels):
+        sent = [event for event in events if event.channel == channel and event.direction == SESSION_TX]
+        received = [event for event in events if event.channel == channel and event.direction == SESSION_RX]
+        lines.append("%-16s %5d writes %7d bytes, %5d reads %7d bytes" % (name, len(sent), sum([len(event.data) for event in sent]),
+                                                                         len(received), sum([len(event.data) for event in received])))
+    return lines
+
+def parse_received(events):
+    "Frame and parse every byte received in events.  Returns the number of replies that parsed"
+    framer = p4317q.ResponseFramer()
+    parsed = 0
+    for event in events:
+        if (event.direction != SESSION_RX):
+            continue
+        framer.feed(event.data)
+        while True:
+            frame = framer.next_frame()
+            if (frame is None):
+                break
+            if (p4317q.p4317q_parse_response(frame, frame[2]) is not None):
+                parsed += 1
+    return parsed
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " info file"
+    print sys.argv[0] + " bench file [--rounds n]"
+    print ""
+    print "info  - Prints the ports, reads and writes in a recording"
+    print "bench - Times framing and parsing every reply in a recording"
+    print ""
+    print "Record with --record file on the control program, and replay by"
+    print "giving replay:file (original timing) or replay-fast:file as the port."
+
+def main(args):
+    rounds = int(p4317q.take_option(args, "--rounds", 20))
+    if (len(args) != 2 or args[0] not in ("info", "bench")):
+        print_usage()
+        return 1
+    try:
+        (start, baudrate, channels, events) = load_session(args[1])
+    except (IOError, ValueError) as error:
+        print "ERROR:  " + str(error)
+        return 1
+
+    if (args[0] == "info"):
+        print "Recorded " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start)) + " at %d baud" % baudrate
+        for line in session_summary(channels, events):
+            print line
+        return 0
+
+    timings = []
+    for index in range(rounds):
+        began = time.time()
+        replies = parse_received(events)
+        timings.append(time.time() - began)
+    best = min(timings)
+    received = sum([len(event.data) for event in events if event.direction == SESSION_RX])
+    print "%d replies, %d bytes" % (replies, received)
+    if (best > 0 and replies > 0):
+        print "%.0f replies/s, %.2f MB/s (best of %d)" % (replies / best, received / best / 1e6, rounds)
+    return 0
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
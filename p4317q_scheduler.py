@@ -0,0 +1,111 @@
+#!/usr/bin/python
+
+# Command scheduler for a shared monitor session.
+#
+# Requests wait here until the session is free.  Interactive requests run
+# ahead of background ones (e.g. polling backlighthours), and a set that
+# arrives while an earlier set of the same command and index is still
+# waiting replaces that set's value instead of queueing behind it.  A UI
+# slider that produces dozens of "set brightness N" calls therefore sends
+# only the values the wire has time for, ending with the last one.
+
+import threading
+
+import dell_p4317q_serial_control_program as p4317q
+
+PRIORITY_INTERACTIVE=0
+PRIORITY_BACKGROUND=1
+
+PRIORITIES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "background": PRIORITY_BACKGROUND
+}
+
+def coalesce_key(parsed):
+    "What a parsed (action, command, param) set writes to, or None for commands that are never coalesced"
+    (action, command, param) = parsed
+    if (action != "set"):
+        return None
+    return (command, p4317q.p4317q_command_index(command, param))
+
+class ScheduledRequest(object):
+    "One queued request and everyone waiting for its result"
+
+    def __init__(self, priority, sequence, item, key):
+        self.priority = priority
+        self.sequence = sequence
+        self.item = item
+        self.key = key
+        self.waiters = []
+
+class CommandScheduler(object):
+    "A priority queue of requests that coalesces superseded sets"
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = []
+        self.sequence = 0
+        self.closed = False
+        self.submitted = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def stats(self):
+        with self.condition:
+            depth = {}
+            for (name, priority) in PRIORITIES.items():
+                depth[name] = len([request for request in self.pending if request.priority == priority])
+            return { "depth": len(self.pending), "depth_by_priority": depth, "max_depth": self.max_depth,
+                     "submitted": self.submitted, "coalesced": self.coalesced }
+
+    def put(self, item, waiter, priority=PRIORITY_INTERACTIVE, key=None):
+        "Queue item.  waiter is called with the result of the request that ends up carrying item"
+        with self.condition:
+            self.submitted += 1
+            pending = self.superseded(key, priority)
+            if (pending is not None):
+                # Send the new value in the old request's place
+                pending.item = item
+                pending.waiters.append(waiter)
+                self.coalesced += 1
+                return
+            request = ScheduledRequest(priority, self.sequence, item, key)
+            request.waiters.append(waiter)
+            self.sequence += 1
+            self.pending.append(request)
+            self.pending.sort(key=lambda request: (request.priority, request.sequence))
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.condition.notify()
+
+    def superseded(self, key, priority):
+        "The waiting set that a set to key replaces, if any"
+        if (key is None):
+            return None
+        (command, index) = key
+        for (position, request) in enumerate(self.pending):
+            if (request.key != key or request.priority != priority):
+                continue
+            # Moving the new value ahead of later writes is only safe when
+            # none of them depends on this setting or resets it.
+            for later in self.pending[position+1:]:
+                (action, later_command, param) = later.item
+                if (action == "reset" or command in p4317q.CACHE_DEPENDENTS.get(later_command, ())
+                        or later_command in p4317q.CACHE_DEPENDENTS.get(command, ())):
+                    return None
+            return request
+        return None
+
+    def take(self):
+        "Wait for and remove the next request.  Returns None once the scheduler is closed and drained"
+        with self.condition:
+            while (len(self.pending) == 0 and not self.closed):
+                self.condition.wait()
+            if (len(self.pending) == 0):
+                return None
+            return self.pending.pop(0)
+
+    def close(self):
+        "Let take() return None once everything queued has run"
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
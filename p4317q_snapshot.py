@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# Snapshot and restore of a monitor's whole configuration.
+#
+# A snapshot holds the raw value of every setting dump reads that can also
+# be set, including all four pxpsubinput windows and customcolor, keyed by
+# the monitor's serial number and firmware version.  Restoring reads the
+# monitor's live state and writes only the settings that differ, in the
+# same safe order apply uses (PxP mode before the window inputs), over one
+# session.  A snapshot restored onto another monitor clones its settings.
+#
+# With --inventory, --ports or --discover, snapshots are taken or restored
+# on every monitor at once, one file per monitor serial number.
+
+import os
+import sys
+import json
+import time
+import binascii
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_fleet
+
+SNAPSHOT_FORMAT="p4317q-snapshot"
+SNAPSHOT_VERSION=1
+
+def snapshot_requests():
+    "The (command, param) gets of every setting a snapshot holds"
+    return [(command, param) for (command, param) in p4317q.dump_requests() if command in p4317q.COMMANDS["set"]]
+
+def setting_key(command, param):
+    return command if param is None else "%s.%d" % (command, param)
+
+def set_param(command, param, payload):
+    "The set param that writes payload back, read from a get of command with param"
+    count = p4317q.SET_ACTIONS[command + "_len"] - 2
+    if (param is not None):
+        return bytearray([param]) + payload[:count-1]
+    if (count == 1):
+        return payload[0]
+    return payload[:count]
+
+def take_snapshot(session):
+    "Read every setting.  Returns the snapshot as a dict, raises IOError if the monitor does not answer"
+    identity = [("monitorserial", None), ("versionfirmware", None), ("monitorname", None)]
+    requests = identity + snapshot_requests()
+    replies = session.pipeline([("get", command, param) for (command, param) in requests])
+    missing = [setting_key(command, param) for ((command, param), reply) in zip(requests, replies) if reply is None]
+    if (len(missing) > 0):
+        raise IOError("No response to get " + ", ".join(missing))
+    (serial_number, firmware, name) = [p4317q.format_response_record(command, reply, param)["value"]
+                                       for ((command, param), reply) in zip(identity, replies)]
+    settings = {}
+    for ((command, param), reply) in zip(requests[len(identity):], replies[len(identity):]):
+        settings[setting_key(command, param)] = binascii.b2a_hex(reply)
+    return { "format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION, "serial": serial_number,
+             "firmware": firmware, "name": name, "taken": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+             "settings": settings }
+
+def write_snapshot(snapshot, path):
+    with open(path, "w") as snapshot_file:
+        json.dump(snapshot, snapshot_file, indent=1, separators=(",", ": "), sort_keys=True)
+        snapshot_file.write("\n")
+
+def read_snapshot(path):
+    "Load a snapshot file.  Raises ValueError if it is not a snapshot this version can restore"
+    with open(path) as snapshot_file:
+        snapshot = json.load(snapshot_file)
+    if (not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT):
+        raise ValueError(path + " is not a monitor snapshot")
+    if (snapshot.get("version") != SNAPSHOT_VERSION):
+        raise ValueError(path + " is snapshot version " + str(snapshot.get("version")) + ", expected " + str(SNAPSHOT_VERSION))
+    return snapshot
+
+def snapshot_profile(snapshot):
+    "The snapshot as an apply profile of (command, param, text) tuples"
+    profile = []
+    for (command, param) in snapshot_requests():
+        key = setting_key(command, param)
+        if (key not in snapshot["settings"]):
+            continue
+        payload = bytearray(binascii.a2b_hex(snapshot["settings"][key]))
+        entry = p4317q.COMMANDS["get"][command]
+        text = command
+        if (command == "pxpsubinput"):
+            text += " " + str(param + 1)
+        text += " " + str(entry.show(entry.decode(payload, 0, len(payload))))
+        profile.append((command, set_param(command, param, payload), text))
+    return profile
+
+def restore_snapshot(snapshot, session):
+    "Write the settings of snapshot that differ from the monitor.  Returns report lines"
+    lines = []
+    serial_number = p4317q_fleet.read_serial_number(session)
+    firmware = session.get_value("versionfirmware")
+    if (serial_number != snapshot["serial"]):
+        lines.append("Cloning snapshot of " + snapshot["serial"] + " onto " + str(serial_number))
+    if (firmware is not None and firmware.strip("\0 ") != snapshot["firmware"]):
+        lines.append("Snapshot was taken on firmware " + snapshot["firmware"] + ", monitor has " + firmware.strip("\0 "))
+    start = time.time()
+    records = p4317q.apply_desired_state(snapshot_profile(snapshot), session)
+    return lines + p4317q.format_apply_records(records, time.time() - start)
+
+def snapshot_path(directory, serial_number):
+    return os.path.join(directory, serial_number + ".json")
+
+def snapshot_operation(directory):
+    "A fleet operation that writes each monitor's snapshot to directory"
+    def operation(session):
+        snapshot = take_snapshot(session)
+        path = snapshot_path(directory, snapshot["serial"])
+        write_snapshot(snapshot, path)
+        return ["%d settings written to %s" % (len(snapshot["settings"]), path)]
+    return operation
+
+def restore_operation(source):
+    "A fleet operation that restores each monitor from its own snapshot in directory source, or every monitor from file source"
+    shared = None
+    if (not os.path.isdir(source)):
+        shared = read_snapshot(source)
+    def operation(session):
+        snapshot = shared
+        if (snapshot is None):
+            serial_number = p4317q_fleet.read_serial_number(session)
+            if (serial_number is None):
+                raise IOError("No response to get monitorserial")
+            snapshot = read_snapshot(snapshot_path(source, serial_number))
+        return restore_snapshot(snapshot, session)
+    return operation
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--port port | --monitor serial] {snapshot|restore} file"
+    print sys.argv[0] + " {--inventory file | --ports port,port,... | --discover} [--workers n] snapshot directory"
+    print sys.argv[0] + " {--inventory file | --ports port,port,... | --discover} [--workers n] restore {directory|file}"
+    print ""
+    print "snapshot - Saves every setting of the monitor to file"
+    print "restore  - Writes the settings in file that differ from the monitor's,"
+    print "           PxP mode before the window inputs.  A snapshot of another"
+    print "           monitor clones its settings."
+    print ""
+    print "With several monitors each one is snapshotted to, or restored from,"
+    print "directory/<serial number>.json, all monitors at once.  Restoring from a"
+    print "file applies the same snapshot to every monitor."
+
+def main(args):
+    port = p4317q.take_option(args, "--port", None)
+    monitor = p4317q.take_option(args, "--monitor", None)
+    inventory = p4317q.take_option(args, "--inventory", None)
+    port_list = p4317q.take_option(args, "--ports", None)
+    discover = p4317q.take_flag(args, "--discover")
+    workers = int(p4317q.take_option(args, "--workers", p4317q_fleet.DEFAULT_WORKERS))
+    if (len(args) != 2 or args[0] not in ("snapshot", "restore")):
+        print_usage()
+        return 1
+    (action, path) = args
+
+    ports = None
+    if (inventory is not None):
+        with open(inventory) as inventory_file:
+            ports = p4317q_fleet.read_inventory(inventory_file)
+    elif (port_list is not None):
+        ports = [name for name in port_list.split(",") if name != ""]
+    elif (discover):
+        ports = p4317q_fleet.discover_ports()
+
+    try:
+        if (ports is not None):
+            if (action == "snapshot"):
+                if (not os.path.isdir(path)):
+                    os.makedirs(path)
+                operation = snapshot_operation(path)
+            else:
+                operation = restore_operation(path)
+            start = time.time()
+            results = p4317q_fleet.run_fleet(ports, operation, workers)
+            p4317q_fleet.print_results(results, time.time() - start)
+            return 0 if all([result.ok for result in results]) else 1
+
+        if (monitor is not None):
+            import p4317q_discovery
+            port = p4317q_discovery.resolve_monitor(monitor)
+            if (port is None):
+                print "ERROR:  No monitor with serial number " + monitor + " found"
+                return 1
+        with p4317q.MonitorSession(port or p4317q.DEFAULT_PORT) as session:
+            if (action == "snapshot"):
+                snapshot = take_snapshot(session)
+                write_snapshot(snapshot, path)
+                print "%d settings of %s written to %s" % (len(snapshot["settings"]), snapshot["serial"], path)
+            else:
+                for line in restore_snapshot(read_snapshot(path), session):
+                    print line
+    except (IOError, OSError, ValueError) as error:
+        print "ERROR:  " + str(error)
+        return 1
+    return 0
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
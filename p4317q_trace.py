@@ -0,0 +1,278 @@
+#!/usr/bin/python
+
+# Wire tracing for the P4317Q control program.
+#
+# A WireTrace keeps the last frames sent and received, per-stage timings and
+# errors in a fixed-size ring of binary records.  Nothing is printed while
+# tracing; the ring is written out afterwards and read back here, e.g.
+#
+#   python dell_p4317q_serial_control_program.py --trace get.trace get brightness
+#   python p4317q_trace.py show get.trace
+#
+# Tracing is off unless dell_p4317q_serial_control_program.tracer is set, and
+# then costs each hook one comparison with None.
+#
+# Every record is one fixed-size slot: a RECORD header followed by up to
+# RECORD_DATA bytes of the frame.  What the three timings (microseconds) mean
+# depends on the kind:
+#
+#   tx     build, write           code = command tag
+#   rx     wait, transfer         code = command tag; wait is from the last
+#                                 frame sent to the first byte, transfer from
+#                                 the first byte to the last
+#   parse  parse                  code = command tag
+#   error  -                      code = TRACE_ERROR_*, data = the bytes involved
+
+import sys
+import time
+import struct
+import threading
+
+import dell_p4317q_serial_control_program as p4317q
+
+TRACE_MAGIC="P4317QTR"
+TRACE_VERSION=1
+DEFAULT_TRACE_CAPACITY=4096
+
+TRACE_TX=1
+TRACE_RX=2
+TRACE_PARSE=3
+TRACE_ERROR=4
+
+TRACE_KINDS = { TRACE_TX: "tx", TRACE_RX: "rx", TRACE_PARSE: "parse", TRACE_ERROR: "error" }
+
+TRACE_ERRORS = { p4317q.TRACE_ERROR_TIMEOUT:   "timeout",
+                 p4317q.TRACE_ERROR_CHECKSUM:  "checksum",
+                 p4317q.TRACE_ERROR_DISCARD:   "discard",
+                 p4317q.TRACE_ERROR_FOREIGN:   "foreign",
+                 p4317q.TRACE_ERROR_BAD_REPLY: "badreply" }
+
+# time, kind, channel, code, data length, three timings in microseconds
+RECORD = struct.Struct("<dBBBBIII")
+# Longest reply frame: header, length, payload and checksum
+RECORD_DATA = p4317q.RSP_MAX_LEN + 4
+SLOT_SIZE = RECORD.size + RECORD_DATA
+
+# magic, version, slot size, capacity, records written, channel count
+FILE_HEADER = struct.Struct("<8sHHIIB")
+
+# pcap, one packet per record: kind, channel, code, then the data
+PCAP_HEADER = struct.Struct("<IHHiIII")
+PCAP_PACKET = struct.Struct("<IIII")
+PCAP_MAGIC=0xA1B2C3D4
+LINKTYPE_USER0=147
+
+def microseconds(seconds):
+    return max(0, min(0xFFFFFFFF, int(seconds * 1e6)))
+
+class TraceRecord(object):
+    "One record read back from a trace"
+
+    __slots__ = ("time", "kind", "channel", "code", "data", "timings")
+
+    def __init__(self, when, kind, channel, code, data, timings):
+        self.time = when
+        self.kind = kind
+        self.channel = channel
+        self.code = code
+        self.data = data
+        self.timings = timings
+
+def unpack_record(buf, offset):
+    (when, kind, channel, code, length, first, second, third) = RECORD.unpack_from(buf, offset)
+    start = offset + RECORD.size
+    return TraceRecord(when, kind, channel, code, bytearray(buf[start:start + length]), (first, second, third))
+
+class WireTrace(object):
+    "Fixed-size ring of binary trace records.  Once full, each new record replaces the oldest"
+
+    def __init__(self, capacity=DEFAULT_TRACE_CAPACITY):
+        self.capacity = capacity
+        self.ring = bytearray(capacity * SLOT_SIZE)
+        self.written = 0
+        # Port names; a record's channel is an index into this list
+        self.channels = []
+        self.channel_index = {}
+        # Time of the last frame sent on each channel, for reply wait times
+        self.last_sent = {}
+        self.lock = threading.Lock()
+
+    def channel(self, name):
+        index = self.channel_index.get(name)
+        if (index is None):
+            index = len(self.channels) & 0xFF
+            self.channels.append(str(name))
+            self.channel_index[name] = index
+        return index
+
+    def add(self, kind, name, code, data, first=0, second=0, third=0, when=None):
+        "Store one record, truncating data to RECORD_DATA bytes"
+        if (when is None):
+            when = time.time()
+        data = data[:RECORD_DATA]
+        with self.lock:
+            offset = (self.written % self.capacity) * SLOT_SIZE
+            RECORD.pack_into(self.ring, offset, when, kind, self.channel(name), code & 0xFF, len(data),
+                             microseconds(first), microseconds(second), microseconds(third))
+            self.ring[offset + RECORD.size:offset + RECORD.size + len(data)] = data
+            self.written += 1
+
+    def transmit(self, name, frame, build_time, write_time):
+        now = time.time()
+        self.last_sent[name] = now
+        self.add(TRACE_TX, name, frame[4], frame, build_time, write_time, when=now)
+
+    def receive(self, name, frame, first_byte):
+        "A complete reply frame, header included, whose first byte arrived at first_byte"
+        now = time.time()
+        first_byte = first_byte or now
+        wait = first_byte - self.last_sent.get(name, first_byte)
+        self.add(TRACE_RX, name, frame[5], frame, wait, now - first_byte, when=now)
+
+    def parsed(self, name, tag, parse_time, ok):
+        self.add(TRACE_PARSE, name, tag, bytearray(), parse_time)
+        if (not ok):
+            self.error(name, p4317q.TRACE_ERROR_BAD_REPLY)
+
+    def error(self, name, code, data=bytearray()):
+        self.add(TRACE_ERROR, name, code, data)
+
+    def records(self):
+        "The records still in the ring, oldest first"
+        with self.lock:
+            count = min(self.written, self.capacity)
+            first = self.written - count
+            return [unpack_record(self.ring, ((first + index) % self.capacity) * SLOT_SIZE) for index in range(count)]
+
+    def dropped(self):
+        "Number of records overwritten"
+        return max(0, self.written - self.capacity)
+
+    def dump(self, path):
+        "Write the ring, oldest record first, with the channel names"
+        with self.lock:
+            count = min(self.written, self.capacity)
+            first = self.written - count
+            with open(path, "wb") as trace_file:
+                trace_file.write(FILE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, SLOT_SIZE, self.capacity, self.written, len(self.channels)))
+                for name in self.channels:
+                    trace_file.write(struct.pack("<B", len(name[:255])) + name[:255])
+                for index in range(count):
+                    offset = ((first + index) % self.capacity) * SLOT_SIZE
+                    trace_file.write(self.ring[offset:offset + SLOT_SIZE])
+
+def load_trace(path):
+    "Read a dumped trace.  Returns (channel names, records, records dropped).  Raises ValueError if it is not a trace"
+    with open(path, "rb") as trace_file:
+        contents = trace_file.read()
+    if (len(contents) < FILE_HEADER.size):
+        raise ValueError(path + " is not a wire trace")
+    (magic, version, slot_size, capacity, written, channel_count) = FILE_HEADER.unpack_from(contents, 0)
+    if (magic != TRACE_MAGIC):
+        raise ValueError(path + " is not a wire trace")
+    if (version != TRACE_VERSION or slot_size != SLOT_SIZE):
+        raise ValueError(path + " is trace version " + str(version) + ", expected " + str(TRACE_VERSION))
+    offset = FILE_HEADER.size
+    channels = []
+    for index in range(channel_count):
+        length = ord(contents[offset])
+        channels.append(contents[offset + 1:offset + 1 + length])
+        offset += 1 + length
+    records = []
+    while (offset + SLOT_SIZE <= len(contents)):
+        records.append(unpack_record(contents, offset))
+        offset += SLOT_SIZE
+    return (channels, records, max(0, written - capacity))
+
+def command_name(tag):
+    "Name of the command with this tag, trying gets first"
+    for action in ("get", "set", "reset"):
+        for (name, entry) in p4317q.COMMANDS[action].items():
+            if (entry.tag == tag):
+                return name
+    return "0x%02x" % tag
+
+def format_record(record, channels, start):
+    "One line for a record, its time relative to start"
+    channel = channels[record.channel] if record.channel < len(channels) else str(record.channel)
+    line = "%10.6f  %-14s %-6s" % (record.time - start, channel, TRACE_KINDS.get(record.kind, str(record.kind)))
+    (first, second, third) = record.timings
+    if (record.kind == TRACE_TX):
+        line += "%-16s [%s]  build %d us, write %d us" % (command_name(record.code), p4317q.p4317q_hex_format(record.data), first, second)
+    elif (record.kind == TRACE_RX):
+        line += "%-16s [%s]  wait %d us, transfer %d us" % (command_name(record.code), p4317q.p4317q_hex_format(record.data), first, second)
+    elif (record.kind == TRACE_PARSE):
+        line += "%-16s parse %d us" % (command_name(record.code), first)
+    else:
+        line += "%-16s" % TRACE_ERRORS.get(record.code, str(record.code))
+        if (len(record.data) > 0):
+            line += " [" + p4317q.p4317q_hex_format(record.data) + "]"
+    return line
+
+def percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+def summarize_trace(records):
+    "Lines with the count of each kind and error, and the p50/max of each stage"
+    lines = []
+    stages = [("build", TRACE_TX, 0), ("write", TRACE_TX, 1), ("wait", TRACE_RX, 0),
+              ("transfer", TRACE_RX, 1), ("parse", TRACE_PARSE, 0)]
+    for (stage, kind, field) in stages:
+        samples = sorted([record.timings[field] for record in records if record.kind == kind])
+        if (len(samples) > 0):
+            lines.append("%-9s %6d  p50 %8d us  max %8d us" % (stage, len(samples), percentile(samples, 0.5), samples[-1]))
+    errors = {}
+    for record in records:
+        if (record.kind == TRACE_ERROR):
+            name = TRACE_ERRORS.get(record.code, str(record.code))
+            errors[name] = errors.get(name, 0) + 1
+    for name in sorted(errors):
+        lines.append("%-9s %6d" % (name, errors[name]))
+    return lines
+
+def write_pcap(records, path):
+    "Write the records as a pcap file of link type USER0, one packet each: kind, channel, code, data"
+    with open(path, "wb") as pcap_file:
+        pcap_file.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 65535, LINKTYPE_USER0))
+        for record in records:
+            packet = bytearray([record.kind, record.channel, record.code]) + record.data
+            seconds = int(record.time)
+            pcap_file.write(PCAP_PACKET.pack(seconds, int((record.time - seconds) * 1e6), len(packet), len(packet)))
+            pcap_file.write(packet)
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " {show|summary} file"
+    print sys.argv[0] + " pcap file output"
+    print ""
+    print "show    - Prints every record of a trace written with --trace"
+    print "summary - Prints record counts, stage timings and errors"
+    print "pcap    - Converts a trace to pcap (link type USER0) for Wireshark"
+
+def main(args):
+    if (len(args) < 2 or args[0] not in ("show", "summary", "pcap") or (args[0] == "pcap") != (len(args) == 3)):
+        print_usage()
+        return 1
+    try:
+        (channels, records, dropped) = load_trace(args[1])
+    except (IOError, ValueError) as error:
+        print "ERROR:  " + str(error)
+        return 1
+
+    if (args[0] == "pcap"):
+        write_pcap(records, args[2])
+        return 0
+    if (args[0] == "show"):
+        start = records[0].time if len(records) > 0 else 0
+        if (dropped > 0):
+            print "(%d older records dropped)" % dropped
+        for record in records:
+            print format_record(record, channels, start)
+        return 0
+    print "%d records on %s" % (len(records), ", ".join(channels) or "no ports")
+    for line in summarize_trace(records):
+        print line
+    return 0
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
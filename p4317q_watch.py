@@ -0,0 +1,235 @@
+#!/usr/bin/python
+
+# Watches monitor settings for changes made from the monitor's own buttons.
+#
+# A ChangeWatcher reads a set of settings over one session, each round as
+# one pipelined stream of gets, and compares the decoded values with the
+# previous round.  Callbacks run only for settings whose value changed, e.g.
+#
+#   videoinput: hdmi1 -> dp
+#
+# A setting whose reply is lost keeps its old value.  A new value read in a
+# round in which bytes were garbled is only reported once it is read again.
+#
+# How much of the serial line watching uses is set by the interval between
+# rounds and a budget on the share of the line the rounds may take.
+#
+# The watcher does not keep the port to itself.  When p4317q_daemon.py
+# holds the port, rounds go through the daemon as background requests.
+# Otherwise each round opens the port, takes its lock and lets go of both
+# again, as the exporter's pollers do.
+
+import sys
+import json
+import time
+import socket
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_exporter
+import p4317q_daemon
+
+DEFAULT_WATCH_COMMANDS = ["powerstate", "videoinput", "pxpmode", "pxpsubinput"]
+DEFAULT_WATCH_INTERVAL=1.0
+# Share of the serial line watching may use
+DEFAULT_WATCH_BUDGET=0.25
+
+def watch_requests(commands):
+    "The (command, param) gets that cover commands, with every pxpsubinput window"
+    requests = []
+    for command in commands:
+        if (command == "pxpsubinput"):
+            for index in range(0,4):
+                requests.append((command, index))
+        elif (command == "customcolor"):
+            requests.append((command, 0))
+        else:
+            requests.append((command, None))
+    return requests
+
+class ChangeEvent(object):
+    "One setting that changed between two rounds"
+
+    def __init__(self, command, param, old, new, when):
+        self.command = command
+        self.param = param
+        self.old = old
+        self.new = new
+        self.time = when
+
+    def name(self):
+        if (self.param is None or self.command == "customcolor"):
+            return self.command
+        return "%s[%d]" % (self.command, self.param + 1)
+
+    def record(self):
+        record = { "time": self.time, "command": self.command, "old": self.old, "new": self.new }
+        if (self.param is not None):
+            record["index"] = self.param
+        return record
+
+    def __str__(self):
+        return "%s: %s -> %s" % (self.name(), self.old, self.new)
+
+class ChangeWatcher(object):
+    "Polls settings over a session and reports the ones that change"
+
+    def __init__(self, session, commands=DEFAULT_WATCH_COMMANDS, interval=DEFAULT_WATCH_INTERVAL, budget=DEFAULT_WATCH_BUDGET):
+        self.session = session
+        self.requests = watch_requests(commands)
+        self.interval = interval
+        self.budget = budget
+        # Line time one round takes, gets out and replies back
+        self.round_cost = sum([p4317q_exporter.poll_cost(command, session.baudrate) for (command, param) in self.requests])
+        self.snapshot = {}
+        # New values read in a round with garbled bytes, waiting to be read again
+        self.pending = {}
+        # Connection to the daemon holding the port, if one does
+        self.client = None
+        self.callbacks = []
+        self.rounds = 0
+        self.missed = 0
+
+    def subscribe(self, callback):
+        "Call callback(ChangeEvent) for every change seen from now on"
+        self.callbacks.append(callback)
+
+    def period(self):
+        "Seconds from the start of one round to the start of the next"
+        return max(self.interval, self.round_cost / self.budget)
+
+    def close(self):
+        "Let go of the port and the daemon connection"
+        self.session.close()
+        if (self.client is not None):
+            self.client.close()
+
+    def daemon_read(self, socket_path):
+        "(payloads, doubtful) of a round through the daemon at socket_path, or None if the daemon is gone"
+        if (self.client is None or self.client.socket_path != socket_path):
+            if (self.client is not None):
+                self.client.close()
+            self.client = p4317q_daemon.DaemonClient(socket_path)
+        replies = []
+        try:
+            resyncs = self.client.call("stats")["framer"]["resyncs"]
+            for (command, param) in self.requests:
+                try:
+                    record = self.client.call("get", [command] if param is None else [command, param], "background")
+                    replies.append(bytearray(record["value"]))
+                except p4317q_daemon.RPCError:
+                    replies.append(None)
+            doubtful = self.client.call("stats")["framer"]["resyncs"] != resyncs
+        except (socket.error, p4317q_daemon.RPCError):
+            self.client.close()
+            return None
+        return (replies, doubtful)
+
+    def read(self):
+        "(payloads, doubtful) of every watched setting, through the daemon if it holds the port.  doubtful is True if bytes were lost or garbled meanwhile"
+        owner = p4317q.p4317q_port_owner(self.session.port_name)
+        if (owner is not None and owner[1] is not None):
+            result = self.daemon_read(owner[1])
+            if (result is not None):
+                return result
+            # The daemon went away; try the port itself
+        commands = [("get", command, param) for (command, param) in self.requests]
+        opened = self.session.port is None
+        try:
+            resyncs = self.session.framer.resyncs
+            replies = self.session.pipeline(commands)
+        except p4317q.PortBusy:
+            return ([None] * len(self.requests), False)
+        finally:
+            if (opened):
+                self.session.close()
+        return (replies, self.session.framer.resyncs != resyncs)
+
+    def poll(self):
+        "Read every watched setting once.  Returns the changes since the last round; the first round only takes the snapshot"
+        # A garbled frame can still pass the checksum, so values read in a
+        # doubtful round are checked again
+        (replies, doubtful) = self.read()
+        now = time.time()
+        self.rounds += 1
+        events = []
+        for ((command, param), reply) in zip(self.requests, replies):
+            if (reply is None):
+                # Keep the old value; a lost reply is not a change
+                self.missed += 1
+                continue
+            value = p4317q.COMMANDS["get"][command].record(reply, param)["value"]
+            key = (command, param)
+            if (doubtful and self.snapshot.get(key) != value and self.pending.get(key) != value):
+                # Only believed once the next round reads it again
+                self.pending[key] = value
+                continue
+            self.pending.pop(key, None)
+            if (key in self.snapshot and self.snapshot[key] != value):
+                events.append(ChangeEvent(command, param, self.snapshot[key], value, now))
+            self.snapshot[key] = value
+        for event in events:
+            for callback in self.callbacks:
+                callback(event)
+        return events
+
+    def run(self, rounds=None):
+        "Poll until interrupted, or for this many rounds"
+        while (rounds is None or self.rounds < rounds):
+            start = time.time()
+            self.poll()
+            time.sleep(max(0, start + self.period() - time.time()))
+
+def print_usage():
+    print sys.argv[0] + " usage:"
+    print sys.argv[0] + " [--port port | --monitor serial] [--interval s] [--budget share] [--format text|ndjson] [command ...]"
+    print ""
+    print "Prints the settings that change, as they change.  Watches"
+    print "    " + " ".join(DEFAULT_WATCH_COMMANDS)
+    print "unless other get commands are given."
+    print " --interval  seconds between polls (default " + str(DEFAULT_WATCH_INTERVAL) + ")"
+    print " --budget    share of the serial line polling may use (default " + str(DEFAULT_WATCH_BUDGET) + ")"
+
+def main(args):
+    port = p4317q.take_option(args, "--port", p4317q.DEFAULT_PORT)
+    monitor = p4317q.take_option(args, "--monitor", None)
+    interval = float(p4317q.take_option(args, "--interval", DEFAULT_WATCH_INTERVAL))
+    budget = float(p4317q.take_option(args, "--budget", DEFAULT_WATCH_BUDGET))
+    output_format = p4317q.take_option(args, "--format", "text")
+    if ("-h" in args or "--help" in args or output_format not in ("text", "ndjson") or budget <= 0):
+        print_usage()
+        return 1
+    commands = args or DEFAULT_WATCH_COMMANDS
+    for command in commands:
+        if (command not in p4317q.COMMANDS["get"]):
+            print "ERROR:  Invalid command specified: " + command
+            return 1
+    if (monitor is not None):
+        import p4317q_discovery
+        port = p4317q_discovery.resolve_monitor(monitor)
+        if (port is None):
+            print "ERROR:  No monitor with serial number " + monitor + " found"
+            return 1
+
+    def report(event):
+        if (output_format == "ndjson"):
+            record = event.record()
+            record["port"] = port
+            print json.dumps(record, sort_keys=True)
+        else:
+            print time.strftime("%H:%M:%S", time.localtime(event.time)) + " " + str(event)
+        sys.stdout.flush()
+
+    # A round that finds the port busy for longer than the interval is missed
+    session = p4317q.MonitorSession(port, lock_timeout=interval)
+    watcher = ChangeWatcher(session, commands, interval, budget)
+    watcher.subscribe(report)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+if (__name__ == "__main__"):
+    exit(main(sys.argv[1:]))
@@ -1,3 +1,3 @@
 @echo off
 
-python dell_p4317q_serial_control_program.py set powerstate 0
+python p4317q_cli.py set powerstate 0
@@ -1,4 +1,3 @@
 @echo off
 
-python dell_p4317q_serial_control_program.py set pxpmode 4k
-python dell_p4317q_serial_control_program.py set videoinput %1
+(echo pxpmode 4k& echo videoinput %1) | python p4317q_cli.py apply -
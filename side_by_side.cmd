@@ -1,5 +1,3 @@
 @echo off
 
-python dell_p4317q_serial_control_program.py set pxpmode SxS
-python dell_p4317q_serial_control_program.py set pxpsubinput 1 hdmi1
-python dell_p4317q_serial_control_program.py set pxpsubinput 2 hdmi2
+(echo pxpmode SxS& echo pxpsubinput 1 hdmi1& echo pxpsubinput 2 hdmi2) | python p4317q_cli.py apply -
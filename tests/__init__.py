@@ -0,0 +1,14 @@
+# Tests for the P4317Q tools.  Most run against p4317q_emulator's
+# pseudo-terminal, so they need no monitor, only a system with ptys:
+#
+#   python -m unittest discover -s tests -t .
+
+import os
+import atexit
+import shutil
+import tempfile
+
+# The caps and port caches the emulated monitors fill go here, not into
+# the user's own
+os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp(prefix="p4317q-tests-")
+atexit.register(shutil.rmtree, os.environ["XDG_CACHE_HOME"], True)
@@ -0,0 +1,84 @@
+# Base class for tests that talk to an emulated monitor.
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_daemon
+try:
+    import p4317q_emulator
+except ImportError:
+    # No ptys (Windows)
+    p4317q_emulator = None
+else:
+    class LosingEmulator(p4317q_emulator.P4317QEmulator):
+        "An emulator that leaves the next get of each (command, index) in lose unanswered"
+
+        def __init__(self, **options):
+            p4317q_emulator.P4317QEmulator.__init__(self, **options)
+            self.lose = set()
+
+        def handle_get(self, command, tag, params):
+            index = params[0] if command in p4317q_emulator.INDEXED_COMMANDS and len(params) > 0 else None
+            if ((command, index) in self.lose):
+                self.lose.remove((command, index))
+                return
+            p4317q_emulator.P4317QEmulator.handle_get(self, command, tag, params)
+
+# How long a test waits for a reply that a fault may have lost
+TEST_TIMEOUT=0.1
+
+def payload(name):
+    "The raw value of a named input"
+    return p4317q.pxp_input[name][:]
+
+@unittest.skipIf(p4317q_emulator is None, "the emulator needs ptys")
+class EmulatorTestCase(unittest.TestCase):
+    "Starts an emulated monitor for every test.  emulator_options inject faults"
+
+    emulator_options = {}
+
+    def setUp(self):
+        options = dict(self.emulator_options)
+        options.setdefault("seed", 1)
+        self.emulator = LosingEmulator(**options).start()
+        self.port = self.emulator.port_name
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.emulator.stop()
+
+    def open_session(self, **options):
+        "A MonitorSession on the emulator, closed after the test"
+        options.setdefault("timeout", TEST_TIMEOUT)
+        session = p4317q.MonitorSession(self.port, **options).open()
+        self.sessions.append(session)
+        return session
+
+class DaemonTestCase(EmulatorTestCase):
+    "Also runs a daemon holding the emulated monitor's port, on a socket in a temporary directory"
+
+    def setUp(self):
+        EmulatorTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "p4317q.sock")
+        self.daemon = p4317q_daemon.MonitorDaemon(self.socket_path, self.port)
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.start()
+        # The worker takes the port as it starts
+        deadline = time.time() + 1.0
+        while (p4317q.p4317q_port_owner(self.port) is None and time.time() < deadline):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.thread.join()
+        self.daemon.server_close()
+        shutil.rmtree(self.directory)
+        EmulatorTestCase.tearDown(self)
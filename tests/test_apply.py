@@ -0,0 +1,67 @@
+import sys
+import StringIO
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+from tests.emulated import EmulatorTestCase, payload
+
+def profile(*lines):
+    return p4317q.p4317q_parse_profile(lines)
+
+class ApplyTest(EmulatorTestCase):
+
+    def apply(self, *lines):
+        "Apply lines.  Returns (command, written, forced_by) of each record"
+        if (len(self.sessions) == 0):
+            self.open_session()
+        records = p4317q.apply_desired_state(profile(*lines), self.sessions[0])
+        return [(command, written, forced_by) for (command, text, written, current, forced_by) in records]
+
+    def test_only_differences_are_written(self):
+        self.assertEqual(self.apply("brightness 75", "contrast 40"), [("brightness", False, None), ("contrast", True, None)])
+        self.sessions[0].get("brightness")
+        self.assertEqual(self.emulator.get_value("contrast"), bytearray([40]))
+
+    def test_pxp_mode_goes_first_and_rewrites_windows(self):
+        records = self.apply("pxpsubinput 2 hdmi2", "brightness 75", "pxpmode SxS")
+        self.assertEqual(records, [("pxpmode", True, None), ("pxpsubinput", True, "pxpmode"), ("brightness", False, None)])
+
+    def test_windows_in_order(self):
+        records = self.apply("pxpsubinput 3 hdmi1", "pxpsubinput 1 dp")
+        self.assertEqual([command for (command, written, forced_by) in records], ["pxpsubinput", "pxpsubinput"])
+        self.sessions[0].get("brightness")
+        self.assertEqual(self.emulator.get_value("pxpsubinput", 0), payload("dp"))
+        self.assertEqual(self.emulator.get_value("pxpsubinput", 2), payload("hdmi1"))
+
+    def test_lost_reply_forces_write(self):
+        self.emulator.set_value("pxpsubinput", payload("hdmi1"), 0)
+        self.emulator.lose.add(("pxpsubinput", 0))
+        records = self.apply("pxpsubinput 1 hdmi2", "pxpsubinput 2 hdmi2")
+        self.assertEqual(records[0], ("pxpsubinput", True, None))
+        self.sessions[0].get("brightness")
+        self.assertEqual(self.emulator.get_value("pxpsubinput", 0), payload("hdmi2"))
+
+    def test_invalid_profile(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            self.assertEqual(p4317q.p4317q_parse_profile(["pxpmode nosuch"]), None)
+        finally:
+            sys.stdout = stdout
+
+class DropApplyTest(EmulatorTestCase):
+    "Applies over a line that loses reply bytes still leave the monitor as asked"
+
+    emulator_options = { "drop": 0.05 }
+
+    def test_windows(self):
+        session = self.open_session()
+        wanted = profile("pxpsubinput 1 hdmi2", "pxpsubinput 2 hdmi2")
+        for round_number in range(10):
+            self.emulator.set_value("pxpsubinput", payload("hdmi1"), 0)
+            p4317q.apply_desired_state(wanted, session)
+            session.get("brightness")
+            self.assertEqual(self.emulator.get_value("pxpsubinput", 0), payload("hdmi2"))
+
+if (__name__ == "__main__"):
+    unittest.main()
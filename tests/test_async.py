@@ -0,0 +1,49 @@
+import time
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_async
+from tests.emulated import EmulatorTestCase, LosingEmulator
+
+class AsyncTest(EmulatorTestCase):
+
+    def setUp(self):
+        EmulatorTestCase.setUp(self)
+        self.loop = p4317q_async.EventLoop()
+        self.monitors = []
+
+    def tearDown(self):
+        for monitor in self.monitors:
+            monitor.close()
+        EmulatorTestCase.tearDown(self)
+
+    def test_get_value(self):
+        self.monitors = p4317q_async.open_monitors(self.loop, [self.port], timeout=0.5)
+        self.assertEqual(self.loop.run_until_complete(self.monitors[0].get_value("brightness")), 75)
+
+    @unittest.skipIf(p4317q.fcntl is None, "ports are not locked without fcntl")
+    def test_busy_port_fails_at_once(self):
+        lock = p4317q.PortLock(self.port)
+        self.assertTrue(lock.acquire(0))
+        try:
+            started = time.time()
+            self.assertRaises(p4317q.PortBusy, p4317q_async.AsyncMonitor(self.loop, self.port).open)
+            self.assertLess(time.time() - started, 0.5)
+        finally:
+            lock.release()
+
+    @unittest.skipIf(p4317q.fcntl is None, "ports are not locked without fcntl")
+    def test_failed_open_closes_the_others(self):
+        busy = LosingEmulator().start()
+        lock = p4317q.PortLock(busy.port_name)
+        self.assertTrue(lock.acquire(0))
+        try:
+            self.assertRaises(p4317q.PortBusy, p4317q_async.open_monitors, self.loop, [self.port, busy.port_name])
+            self.assertEqual(p4317q.p4317q_port_owner(self.port), None)
+            self.assertEqual(self.loop.readers, {})
+        finally:
+            lock.release()
+            busy.stop()
+
+if (__name__ == "__main__"):
+    unittest.main()
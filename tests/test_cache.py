@@ -0,0 +1,65 @@
+import time
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+from tests.emulated import EmulatorTestCase, payload
+
+MONITOR = "/dev/ttyUSB0"
+
+class StateCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = p4317q.StateCache()
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self.cache.lookup(MONITOR, "brightness", None), None)
+        self.cache.store(MONITOR, "brightness", None, bytearray([75]))
+        self.assertEqual(self.cache.lookup(MONITOR, "brightness", None), bytearray([75]))
+        self.assertEqual(self.cache.lookup("/dev/ttyUSB1", "brightness", None), None)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_expiry(self):
+        cache = p4317q.StateCache(ttls={ "brightness": 0.05 })
+        cache.store(MONITOR, "brightness", None, bytearray([75]))
+        cache.store(MONITOR, "contrast", None, bytearray([75]))
+        time.sleep(0.1)
+        self.assertEqual(cache.lookup(MONITOR, "brightness", None), None)
+        self.assertEqual(cache.lookup(MONITOR, "contrast", None), bytearray([75]))
+
+    def test_set_invalidates_only_its_index(self):
+        for index in range(4):
+            self.cache.store(MONITOR, "pxpsubinput", index, payload("hdmi1"))
+        self.cache.invalidate(MONITOR, "set", "pxpsubinput", bytearray([1]) + payload("dp"))
+        self.assertEqual([self.cache.lookup(MONITOR, "pxpsubinput", index) is None for index in range(4)],
+                         [False, True, False, False])
+
+    def test_set_invalidates_dependents(self):
+        self.cache.store(MONITOR, "pxpsubinput", 0, payload("hdmi1"))
+        self.cache.store(MONITOR, "pxplocation", None, bytearray([1]))
+        self.cache.store(MONITOR, "brightness", None, bytearray([75]))
+        self.cache.invalidate(MONITOR, "set", "pxpmode", p4317q.pxp_mode["SxS"])
+        self.assertEqual(self.cache.lookup(MONITOR, "pxpsubinput", 0), None)
+        self.assertEqual(self.cache.lookup(MONITOR, "pxplocation", None), None)
+        self.assertEqual(self.cache.lookup(MONITOR, "brightness", None), bytearray([75]))
+
+    def test_reset_keeps_what_never_changes(self):
+        self.cache.store(MONITOR, "monitorserial", None, bytearray("CN0EMU1234"))
+        self.cache.store(MONITOR, "brightness", None, bytearray([75]))
+        self.cache.invalidate(MONITOR, "reset", "factory", None)
+        self.assertEqual(self.cache.lookup(MONITOR, "brightness", None), None)
+        self.assertEqual(self.cache.lookup(MONITOR, "monitorserial", None), bytearray("CN0EMU1234"))
+
+class CachedSessionTest(EmulatorTestCase):
+
+    def test_gets_answered_from_cache_until_set(self):
+        session = self.open_session(cache=p4317q.StateCache())
+        self.assertEqual(session.get_value("brightness"), 75)
+        frames = self.emulator.frames
+        self.assertEqual(session.get_value("brightness"), 75)
+        self.assertEqual(self.emulator.frames, frames)
+        session.set("brightness", 20)
+        self.assertEqual(session.get_value("brightness"), 20)
+        self.assertEqual(self.emulator.frames, frames + 2)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import sys
+import StringIO
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_capabilities
+import p4317q_fleet
+from tests.emulated import EmulatorTestCase, DaemonTestCase, TEST_TIMEOUT, payload
+
+def profile(*lines):
+    return p4317q.p4317q_parse_profile(lines)
+
+def restrict_inputs(emulator):
+    "Leave the emulated monitor only HDMI 1 and DP"
+    emulator.set_value("videoinputcaps", bytearray([a | b for (a, b) in zip(payload("hdmi1"), payload("dp"))]))
+    # Caps cached from another test's emulator on the same port would let sets through
+    if (os.path.exists(p4317q_capabilities.DEFAULT_CAPS_CACHE)):
+        os.remove(p4317q_capabilities.DEFAULT_CAPS_CACHE)
+
+class CapsCheckTest(EmulatorTestCase):
+    "Every way of setting refuses an input the monitor does not have"
+
+    def setUp(self):
+        EmulatorTestCase.setUp(self)
+        restrict_inputs(self.emulator)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        EmulatorTestCase.tearDown(self)
+
+    def input_is(self, session, name):
+        # The get after the sets is answered once they are done
+        session.get("brightness")
+        return self.emulator.get_value("videoinput") == payload(name)
+
+    def test_set(self):
+        session = self.open_session()
+        self.assertRaises(p4317q.UnsupportedSetting, session.set, "videoinput", payload("mdp"))
+        session.set("videoinput", payload("dp"))
+        self.assertTrue(self.input_is(session, "dp"))
+
+    def test_pipeline_sends_nothing(self):
+        session = self.open_session()
+        commands = [("set", "brightness", 30), ("set", "videoinput", payload("mdp"))]
+        self.assertRaises(p4317q.UnsupportedSetting, session.pipeline, commands)
+        self.assertEqual(session.get_value("brightness"), 75)
+
+    def test_batch(self):
+        session = self.open_session()
+        self.assertEqual(p4317q.run_batch(["set videoinput mdp", "set brightness 30"], session), 1)
+        self.assertEqual(p4317q.run_pipelined_batch(["set videoinput mdp", "set videoinput dp"], session), 1)
+        self.assertTrue(self.input_is(session, "dp"))
+        self.assertIn("videoinput must be one of dp, hdmi1 on this monitor", sys.stdout.getvalue())
+
+    def test_apply_writes_nothing(self):
+        session = self.open_session()
+        self.assertRaises(p4317q.UnsupportedSetting, p4317q.apply_desired_state, profile("brightness 30", "pxpsubinput 2 mdp"), session)
+        self.assertEqual(session.get_value("brightness"), 75)
+
+    def test_fleet(self):
+        commands = [p4317q.p4317q_parse_command(["set", "videoinput", "mdp"])]
+        result = p4317q_fleet.run_on_monitor(self.port, p4317q_fleet.command_operation(commands), TEST_TIMEOUT)
+        self.assertFalse(result.ok)
+        self.assertIn("on this monitor", result.error)
+
+@unittest.skipIf(p4317q.fcntl is None, "ports are not locked without fcntl")
+class DaemonCapsCheckTest(DaemonTestCase):
+
+    def setUp(self):
+        DaemonTestCase.setUp(self)
+        restrict_inputs(self.emulator)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        DaemonTestCase.tearDown(self)
+
+    def test_set(self):
+        self.assertEqual(p4317q.main(["--port", self.port, "set", "videoinput", "mdp"]), 1)
+        self.assertIn("on this monitor", sys.stdout.getvalue())
+        self.assertEqual(p4317q.main(["--port", self.port, "set", "videoinput", "dp"]), 0)
+
+if (__name__ == "__main__"):
+    unittest.main()
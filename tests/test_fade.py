@@ -0,0 +1,51 @@
+import sys
+import StringIO
+import unittest
+
+import p4317q_fade
+from tests.emulated import EmulatorTestCase
+
+class FadeArgumentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_durations(self):
+        self.assertEqual([p4317q_fade.parse_duration(text) for text in ("3", "1.5s", "500ms")], [3.0, 1.5, 0.5])
+
+    def test_parse_fade(self):
+        self.assertEqual(p4317q_fade.parse_fade(["customcolor", "90:80:70", "--over", "2s"]), ("customcolor", [90, 80, 70], 2.0))
+        self.assertEqual(p4317q_fade.parse_fade(["brightness", "101"]), None)
+        self.assertEqual(p4317q_fade.parse_fade(["brightness", "50", "--over", "abc"]), None)
+        self.assertEqual(p4317q_fade.parse_fade(["sharpness", "50"]), None)
+
+    def test_steps_fit_the_duration(self):
+        self.assertEqual(p4317q_fade.fade_steps("brightness", [0], [10], 10.0), 10)
+        steps = p4317q_fade.fade_steps("brightness", [0], [100], 0.5)
+        self.assertTrue(0 < steps < 100)
+        self.assertEqual(p4317q_fade.fade_steps("brightness", [40], [40], 1.0), 0)
+
+class FadeTest(EmulatorTestCase):
+
+    def test_reaches_target(self):
+        fade = p4317q_fade.Fade(self.open_session(), "brightness", [50], 0.3)
+        self.assertEqual(fade.start, [75])
+        self.assertTrue(fade.run())
+        self.assertEqual(fade.written, [50])
+        self.assertEqual(self.sessions[0].get_value("brightness"), 50)
+
+    def test_new_target_replaces_running_fade(self):
+        fader = p4317q_fade.Fader(self.open_session())
+        first = fader.fade_to("brightness", [0], 2.0)
+        second = fader.fade_to("brightness", [100], 0.3)
+        fader.wait()
+        self.assertTrue(first.stopped.is_set())
+        self.assertEqual(second.start, first.written)
+        self.assertEqual(self.sessions[0].get_value("brightness"), 100)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+
+def reply_frame(payload):
+    "A response frame, header to checksum, around payload"
+    frame = p4317q.RSP_HEADER + bytearray([len(payload)]) + bytearray(payload)
+    frame.append(p4317q.p4317q_checksum(frame, 0, len(frame)))
+    return frame
+
+BRIGHTNESS_PAYLOAD = bytearray([p4317q.RSP_REPLY_CODE, 0x00, p4317q.GET_ACTIONS["brightness"], 75])
+
+class ResponseFramerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.framer = p4317q.ResponseFramer()
+
+    def test_whole_frame(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        self.framer.feed(frame)
+        self.assertEqual(self.framer.next_frame(), frame[3:])
+        self.assertEqual(self.framer.next_frame(), None)
+        self.assertEqual(self.framer.resyncs, 0)
+
+    def test_frame_split_across_reads(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        for byte in frame[:-1]:
+            self.framer.feed(bytearray([byte]))
+            self.assertEqual(self.framer.next_frame(), None)
+        self.framer.feed(frame[-1:])
+        self.assertEqual(self.framer.next_frame(), frame[3:])
+
+    def test_garbage_ahead_of_frame(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        self.framer.feed(bytearray([0x00, 0x42, 0x37]) + frame)
+        self.assertEqual(self.framer.next_frame(), frame[3:])
+        self.assertEqual(self.framer.discarded_bytes, 3)
+
+    def test_bad_checksum_is_skipped(self):
+        bad = reply_frame(BRIGHTNESS_PAYLOAD)
+        bad[-1] ^= 0xFF
+        good = reply_frame(BRIGHTNESS_PAYLOAD[:3] + bytearray([20]))
+        self.framer.feed(bad + good)
+        self.assertEqual(self.framer.next_frame(), good[3:])
+        self.assertEqual(self.framer.checksum_errors, 1)
+
+    def test_false_header_in_garbage(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        # A header whose length would run into the real frame
+        self.framer.feed(p4317q.RSP_HEADER + bytearray([4]) + frame)
+        self.assertEqual(self.framer.next_frame(), frame[3:])
+
+    def test_impossible_length(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        self.framer.feed(p4317q.RSP_HEADER + bytearray([p4317q.RSP_MAX_LEN + 1]) + frame)
+        self.assertEqual(self.framer.next_frame(), frame[3:])
+
+    def test_trailing_header_byte_is_kept(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        self.framer.feed(bytearray([0x01]) + frame[:1])
+        self.assertEqual(self.framer.next_frame(), None)
+        self.framer.feed(frame[1:])
+        self.assertEqual(self.framer.next_frame(), frame[3:])
+
+    def test_parse_response(self):
+        frame = reply_frame(BRIGHTNESS_PAYLOAD)
+        self.framer.feed(frame)
+        response = p4317q.p4317q_parse_response(self.framer.next_frame(), p4317q.GET_ACTIONS["brightness"])
+        self.assertEqual(p4317q.format_response_record("brightness", response, None)["value"], 75)
+
+if (__name__ == "__main__"):
+    unittest.main()
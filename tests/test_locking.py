@@ -0,0 +1,116 @@
+import os
+import sys
+import shutil
+import StringIO
+import tempfile
+import time
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+from tests.emulated import EmulatorTestCase, DaemonTestCase
+
+@unittest.skipIf(p4317q.fcntl is None, "ports are not locked without fcntl")
+class PortLockTest(EmulatorTestCase):
+
+    def test_one_holder_at_a_time(self):
+        first = p4317q.PortLock(self.port)
+        second = p4317q.PortLock(self.port)
+        self.assertTrue(first.acquire(0))
+        self.assertFalse(second.acquire(0.05))
+        self.assertEqual(p4317q.p4317q_port_owner(self.port), (os.getpid(), None))
+        first.release()
+        self.assertEqual(p4317q.p4317q_port_owner(self.port), None)
+        self.assertTrue(second.acquire(0))
+        second.release()
+
+    def test_session_waits_a_bounded_time(self):
+        self.open_session()
+        session = p4317q.MonitorSession(self.port, lock_timeout=0.05)
+        self.assertRaises(p4317q.PortBusy, session.open)
+        self.assertEqual(session.port, None)
+
+    def test_links_share_a_lock(self):
+        directory = tempfile.mkdtemp()
+        try:
+            link = os.path.join(directory, "monitor")
+            os.symlink(self.port, link)
+            self.assertEqual(p4317q.p4317q_lock_path(link), p4317q.p4317q_lock_path(self.port))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_lock_directory_only_root_may_write(self):
+        directory = tempfile.mkdtemp()
+        root_only = os.path.join(directory, "root-only")
+        shared = os.path.join(directory, "shared")
+        os.mkdir(root_only)
+        os.mkdir(shared)
+        os.chmod(directory, 0755)
+        os.chmod(shared, 01777)
+        # Only root can write here; anyone else (nobody, if root runs the tests) cannot
+        os.chmod(root_only, 0755 if os.getuid() == 0 else 0555)
+        directories = p4317q.PORT_LOCK_DIRECTORIES
+        p4317q.PORT_LOCK_DIRECTORIES = (root_only, shared)
+        try:
+            pid = os.fork()
+            if (pid == 0):
+                status = 2
+                try:
+                    if (os.getuid() == 0):
+                        os.setgid(65534)
+                        os.setuid(65534)
+                    lock = p4317q.PortLock(self.port)
+                    status = 0 if lock.acquire(0) and os.path.dirname(lock.path) == shared else 1
+                finally:
+                    os._exit(status)
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            # The lock file it made is found by every user from now on
+            self.assertEqual(os.path.dirname(p4317q.p4317q_lock_path(self.port)), shared)
+        finally:
+            p4317q.PORT_LOCK_DIRECTORIES = directories
+            shutil.rmtree(directory)
+
+    def test_replay_ports_are_not_locked(self):
+        self.assertEqual(p4317q.p4317q_lock_path(p4317q.REPLAY_PREFIX + "session"), None)
+
+@unittest.skipIf(p4317q.fcntl is None, "ports are not locked without fcntl")
+class HandOffTest(DaemonTestCase):
+    "Command lines go to the daemon that holds the port"
+
+    def setUp(self):
+        DaemonTestCase.setUp(self)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        DaemonTestCase.tearDown(self)
+
+    def run_command_line(self, *args):
+        "Exit status and output of the control program"
+        sys.stdout.truncate(0)
+        status = p4317q.main(["--port", self.port] + list(args))
+        return (status, sys.stdout.getvalue())
+
+    def test_owner_names_the_socket(self):
+        self.assertEqual(p4317q.p4317q_port_owner(self.port), (os.getpid(), self.socket_path))
+
+    def test_get_and_set(self):
+        self.assertEqual(self.run_command_line("set", "brightness", "30"), (0, ""))
+        (status, output) = self.run_command_line("get", "brightness")
+        self.assertEqual((status, output.split()), (0, ["Brightness", "=", "30"]))
+        (status, output) = self.run_command_line("--format", "ndjson", "get", "brightness")
+        self.assertIn('"value": 30', output)
+
+    def test_rejected_set(self):
+        self.assertEqual(self.run_command_line("set", "brightness", "101")[0], 1)
+
+    def test_batch_and_apply_name_the_daemon(self):
+        for command in ("batch", "apply"):
+            started = time.time()
+            (status, output) = self.run_command_line(command, os.devnull)
+            self.assertLess(time.time() - started, 1.0)
+            self.assertEqual(status, 1)
+            self.assertIn("control daemon (process %d) on %s" % (os.getpid(), self.socket_path), output)
+
+if (__name__ == "__main__"):
+    unittest.main()
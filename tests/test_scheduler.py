@@ -0,0 +1,63 @@
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_scheduler
+
+def parsed(*args):
+    return p4317q.p4317q_parse_command(list(args))
+
+class CommandSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = p4317q_scheduler.CommandScheduler()
+        self.replies = []
+
+    def put(self, item, priority=p4317q_scheduler.PRIORITY_INTERACTIVE):
+        self.scheduler.put(item, self.replies.append, priority, p4317q_scheduler.coalesce_key(item))
+
+    def drain(self):
+        "The items queued, in the order they would run"
+        self.scheduler.close()
+        items = []
+        while True:
+            request = self.scheduler.take()
+            if (request is None):
+                return items
+            items.append(request.item)
+            for waiter in request.waiters:
+                waiter(request.item)
+
+    def test_later_set_replaces_waiting_one(self):
+        self.put(parsed("set", "brightness", "10"))
+        self.put(parsed("get", "contrast"))
+        self.put(parsed("set", "brightness", "90"))
+        self.assertEqual(self.drain(), [parsed("set", "brightness", "90"), parsed("get", "contrast")])
+        self.assertEqual(self.scheduler.coalesced, 1)
+        # Both callers hear about the set that carried their value
+        self.assertEqual(self.replies.count(parsed("set", "brightness", "90")), 2)
+
+    def test_windows_are_not_coalesced_together(self):
+        self.put(parsed("set", "pxpsubinput", "1", "hdmi1"))
+        self.put(parsed("set", "pxpsubinput", "2", "dp"))
+        self.assertEqual(len(self.drain()), 2)
+
+    def test_no_coalescing_across_a_dependent_write(self):
+        self.put(parsed("set", "pxpsubinput", "1", "hdmi1"))
+        self.put(parsed("set", "pxpmode", "SxS"))
+        self.put(parsed("set", "pxpsubinput", "1", "dp"))
+        self.assertEqual(self.drain(), [parsed("set", "pxpsubinput", "1", "hdmi1"), parsed("set", "pxpmode", "SxS"),
+                                        parsed("set", "pxpsubinput", "1", "dp")])
+
+    def test_background_runs_last(self):
+        self.put(parsed("get", "powerstate"), p4317q_scheduler.PRIORITY_BACKGROUND)
+        self.put(parsed("get", "brightness"))
+        self.put(parsed("get", "contrast"))
+        self.assertEqual([item[1] for item in self.drain()], ["brightness", "contrast", "powerstate"])
+
+    def test_no_coalescing_across_priorities(self):
+        self.put(parsed("set", "brightness", "10"), p4317q_scheduler.PRIORITY_BACKGROUND)
+        self.put(parsed("set", "brightness", "90"))
+        self.assertEqual(len(self.drain()), 2)
+
+if (__name__ == "__main__"):
+    unittest.main()
@@ -0,0 +1,165 @@
+import sys
+import unittest
+import StringIO
+
+import dell_p4317q_serial_control_program as p4317q
+from tests.emulated import EmulatorTestCase, payload
+
+WINDOWS = ["hdmi1", "hdmi2", "dp", "mdp"]
+WINDOW_GETS = [("get", "pxpsubinput", index) for index in range(4)]
+
+class SessionTest(EmulatorTestCase):
+
+    def test_get_and_set(self):
+        session = self.open_session()
+        self.assertEqual(session.get_value("brightness"), 75)
+        session.set("brightness", 40)
+        # Sets are not answered; the get after it is, once the set is done
+        self.assertEqual(session.get_value("brightness"), 40)
+        self.assertEqual(self.emulator.get_value("brightness"), bytearray([40]))
+
+    def test_indexed_get(self):
+        session = self.open_session()
+        self.assertEqual([session.get_value("pxpsubinput", index) for index in range(4)], WINDOWS)
+
+    def test_reset(self):
+        session = self.open_session()
+        session.set("osdtimer", 50)
+        session.set("brightness", 10)
+        session.reset("osd")
+        self.assertEqual(session.get_value("osdtimer"), 20)
+        self.assertEqual(session.get_value("brightness"), 10)
+
+    def test_pipeline(self):
+        session = self.open_session()
+        commands = [("set", "brightness", 30), ("get", "brightness", None)] + WINDOW_GETS + [("get", "pxpmode", None)]
+        results = session.pipeline(commands)
+        self.assertEqual(results[0], None)
+        decoded = [p4317q.format_response_record(command, result, param)["value"]
+                   for ((action, command, param), result) in zip(commands[1:], results[1:])]
+        self.assertEqual(decoded, [30] + WINDOWS + ["4k"])
+
+    def test_lost_reply_is_none(self):
+        session = self.open_session()
+        # Replies carry no window index: a later window's reply must not
+        # stand in for the lost one
+        self.emulator.lose.add(("pxpsubinput", 1))
+        results = session.pipeline(WINDOW_GETS + [("get", "brightness", None)])
+        self.assertEqual(results[1], None)
+        decoded = [p4317q.format_response_record("pxpsubinput", result, 0)["value"] for result in results[2:4]]
+        self.assertEqual([p4317q.format_response_record("pxpsubinput", results[0], 0)["value"]] + decoded, ["hdmi1", "dp", "mdp"])
+        self.assertEqual(p4317q.format_response_record("brightness", results[4], None)["value"], 75)
+
+class ParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_range_checks(self):
+        self.assertEqual(p4317q.p4317q_parse_command(["set", "brightness", "100"]), ("set", "brightness", 100))
+        self.assertEqual(p4317q.p4317q_parse_command(["set", "brightness", "101"]), None)
+        self.assertEqual(p4317q.p4317q_parse_command(["set", "pxpsubinput", "5", "hdmi1"]), None)
+        self.assertEqual(p4317q.p4317q_parse_command(["get", "nosuch"]), None)
+
+    def test_get_index(self):
+        self.assertEqual(p4317q.p4317q_parse_command(["get", "pxpsubinput"]), ("get", "pxpsubinput", 0))
+        self.assertEqual(p4317q.p4317q_parse_command(["get", "pxpsubinput", "2"]), ("get", "pxpsubinput", 2))
+        self.assertEqual(p4317q.p4317q_parse_command(["get", "customcolor"]), ("get", "customcolor", 0))
+        self.assertEqual(p4317q.p4317q_parse_command(["get", "brightness", "1"]), None)
+
+    def test_rejected_set_exits_1(self):
+        self.assertEqual(p4317q.main(["--port", "/dev/null", "set", "brightness", "101"]), 1)
+        self.assertIn("brightness must be 0-100", sys.stdout.getvalue())
+
+class CommandLineTest(EmulatorTestCase):
+
+    def setUp(self):
+        EmulatorTestCase.setUp(self)
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        EmulatorTestCase.tearDown(self)
+
+    def run_command_line(self, *args):
+        "Exit status and output of the control program"
+        sys.stdout.truncate(0)
+        status = p4317q.main(["--port", self.port] + list(args))
+        return (status, sys.stdout.getvalue())
+
+    def test_get(self):
+        (status, output) = self.run_command_line("get", "brightness")
+        self.assertEqual((status, output.split()), (0, ["Brightness", "=", "75"]))
+
+    def test_get_without_index(self):
+        # The frame must carry the index its length byte counts, or the
+        # monitor takes the next frame's first byte for it
+        self.assertEqual(p4317q.run_batch(["get customcolor", "get pxpsubinput", "get brightness"], self.open_session()), 0)
+        output = sys.stdout.getvalue()
+        self.assertIn("PxP/PiP Sub Input[1] = hdmi1", " ".join(output.split()))
+        self.assertIn("Brightness = 75", " ".join(output.split()))
+
+    def test_bad_batch_and_apply_arguments(self):
+        for args in (["batch", "/nonexistent/commands"], ["apply", "/nonexistent/profile"], ["batch", "--pipeline", "--gap", "soon", "-"], ["batch", "--gap", "-1", "-"]):
+            (status, output) = self.run_command_line(*args)
+            self.assertEqual(status, 1)
+            self.assertTrue(output.startswith("ERROR:  "), output)
+
+    def test_unanswered_get_fails(self):
+        self.emulator.lose.add(("brightness", None))
+        self.assertEqual(self.run_command_line("get", "brightness"), (1, "ERROR:  No valid response from monitor\n"))
+        self.emulator.lose.add(("brightness", None))
+        (status, output) = self.run_command_line("--format", "ndjson", "get", "brightness")
+        self.assertEqual(status, 1)
+        self.assertIn('"error": "no response"', output)
+
+class FaultTest(EmulatorTestCase):
+    "Replies damaged on the way are lost, never taken for another reply"
+
+    rounds = 15
+
+    def check_windows(self, session):
+        answered = 0
+        for round_number in range(self.rounds):
+            for (window, result) in zip(WINDOWS, session.pipeline(WINDOW_GETS)):
+                if (result is not None):
+                    self.assertEqual(p4317q.format_response_record("pxpsubinput", result, 0)["value"], window)
+                    answered += 1
+        return answered
+
+class NoiseTest(FaultTest):
+    emulator_options = { "noise": 0.3 }
+
+    def test_windows(self):
+        session = self.open_session()
+        self.assertEqual(self.check_windows(session), self.rounds * 4)
+        self.assertTrue(session.framer.resyncs > 0)
+
+class BadChecksumTest(FaultTest):
+    emulator_options = { "bad_checksum": 0.2 }
+
+    def test_windows(self):
+        session = self.open_session()
+        self.assertTrue(self.check_windows(session) > 0)
+        self.assertTrue(session.framer.checksum_errors > 0)
+
+    def test_get(self):
+        session = self.open_session()
+        values = [session.get_value("brightness") for index in range(20)]
+        self.assertTrue(None in values)
+        self.assertEqual(set(values), set([None, 75]))
+
+class DropTest(FaultTest):
+    emulator_options = { "drop": 0.03 }
+
+    def test_windows(self):
+        session = self.open_session()
+        self.assertTrue(self.check_windows(session) > 0)
+
+if (__name__ == "__main__"):
+    unittest.main()
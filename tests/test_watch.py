@@ -0,0 +1,79 @@
+import unittest
+
+import dell_p4317q_serial_control_program as p4317q
+import p4317q_watch
+from tests.emulated import EmulatorTestCase, DaemonTestCase, TEST_TIMEOUT, payload
+
+class WatchTest(EmulatorTestCase):
+
+    def test_first_round_is_the_snapshot(self):
+        watcher = p4317q_watch.ChangeWatcher(self.open_session(), interval=0)
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.poll(), [])
+
+    def test_change_is_reported_once(self):
+        watcher = p4317q_watch.ChangeWatcher(self.open_session(), interval=0)
+        seen = []
+        watcher.subscribe(seen.append)
+        watcher.poll()
+        self.emulator.set_value("pxpsubinput", payload("dp"), 1)
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual([str(event) for event in seen], ["pxpsubinput[2]: hdmi2 -> dp"])
+
+    def test_lost_reply_is_not_a_change(self):
+        watcher = p4317q_watch.ChangeWatcher(self.open_session(), interval=0)
+        watcher.poll()
+        self.emulator.lose.add(("pxpsubinput", 1))
+        self.assertEqual(watcher.poll(), [])
+        self.assertEqual(watcher.missed, 1)
+
+    def test_port_is_free_between_rounds(self):
+        watcher = p4317q_watch.ChangeWatcher(p4317q.MonitorSession(self.port, timeout=TEST_TIMEOUT), interval=0)
+        try:
+            watcher.poll()
+            self.assertEqual(p4317q.p4317q_port_owner(self.port), None)
+            self.assertEqual(self.open_session().get_value("brightness"), 75)
+        finally:
+            watcher.close()
+
+@unittest.skipIf(p4317q.fcntl is None, "ports are not locked without fcntl")
+class DaemonWatchTest(DaemonTestCase):
+    "Rounds go through the daemon holding the port"
+
+    def test_change_is_reported(self):
+        watcher = p4317q_watch.ChangeWatcher(p4317q.MonitorSession(self.port, timeout=TEST_TIMEOUT), interval=0)
+        seen = []
+        watcher.subscribe(seen.append)
+        try:
+            watcher.poll()
+            self.emulator.set_value("pxpsubinput", payload("dp"), 1)
+            watcher.poll()
+            self.assertEqual(watcher.session.port, None)
+        finally:
+            watcher.close()
+        self.assertEqual([str(event) for event in seen], ["pxpsubinput[2]: hdmi2 -> dp"])
+        self.assertEqual(watcher.missed, 0)
+
+class DropWatchTest(EmulatorTestCase):
+    emulator_options = { "drop": 0.05 }
+
+    def test_no_false_changes(self):
+        watcher = p4317q_watch.ChangeWatcher(self.open_session(), interval=0)
+        events = []
+        for round_number in range(15):
+            events += watcher.poll()
+        self.assertEqual([str(event) for event in events], [])
+
+    def test_change_is_seen(self):
+        watcher = p4317q_watch.ChangeWatcher(self.open_session(), ["videoinput"], interval=0)
+        while (len(watcher.snapshot) == 0):
+            watcher.poll()
+        self.emulator.set_value("videoinput", payload("dp"))
+        events = []
+        for round_number in range(10):
+            events += watcher.poll()
+        self.assertEqual([str(event) for event in events], ["videoinput: hdmi1 -> dp"])
+
+if (__name__ == "__main__"):
+    unittest.main()